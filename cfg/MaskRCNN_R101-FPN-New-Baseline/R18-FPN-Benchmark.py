@@ -0,0 +1,28 @@
+# Small stand-in of `R101-FPN-New-Baseline.py` with the same heads and class space, used with random weights by
+# `scripts/novel_object_detection/benchmark.py` to run the pipeline on CPU without the trained checkpoint.
+from detectron2.config import LazyCall as L
+from detectron2.modeling.backbone import ResNet
+
+from .mask_rcnn_fpn import model
+from .data import dataloader
+
+from .optim import SGD as optimizer
+from .train import train
+
+train.init_checkpoint = ""
+train.device = "cpu"
+
+model.backbone.bottom_up.stages = L(ResNet.make_default_stages)(depth=18, norm="FrozenBN")
+model.backbone.bottom_up.freeze_at = 0
+
+model.proposal_generator.head.conv_dims = [-1, -1]
+
+model.roi_heads.box_head.conv_dims = []
+model.roi_heads.box_head.fc_dims = [256]
+model.roi_heads.mask_head.conv_dims = [64, 64]
+
+# Set bbox localization head to be class-agnostic
+model.roi_heads.box_predictor.cls_agnostic_bbox_reg = True
+
+# Set mask head to be class-agnostic
+model.roi_heads.mask_head.num_classes = 1
@@ -0,0 +1,420 @@
+"""
+Binary, memory-mapped index of the ground-truth boxes of a LVIS or COCO style annotation file.
+
+Parsing `lvis_v1_val.json` (~192MB, mostly segmentation polygons) takes tens of seconds and GBs of RAM, and it is
+re-done by every evaluator and by the dataset registration. The index only keeps what box evaluation and test-time
+data loading need (boxes, areas, category ids, per-image annotation offsets, negative / not-exhaustive category lists
+and category frequencies) as `.npy` files that are loaded with `mmap_mode="r"`, plus a small `meta.json` with the
+image and category records.
+
+The index is written once next to the annotation file (`<json_file>.gtindex/`), validated against the parsed JSON
+after writing, and rebuilt whenever the sha256 of the JSON file changes. Segmentations are not stored: loaders built
+on top of the index are box-only.
+
+Usage to build the index ahead of time:
+    python datasets/gt_index.py path/to/lvis/lvis_v1_val.json
+"""
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from detectron2.data import DatasetCatalog, MetadataCatalog
+from detectron2.structures import BoxMode
+from lvis import LVIS
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+FREQUENCIES = ["r", "c", "f"]  # same order as `lvis.eval.Params.img_count_lbl`
+
+ARRAY_NAMES = [
+    "img_ids",            # (I,) sorted image ids
+    "ann_offsets",        # (I + 1,) annotations of image i are ann_*[ann_offsets[i]:ann_offsets[i + 1]]
+    "ann_ids",            # (N,)
+    "ann_image_ids",      # (N,)
+    "ann_category_ids",   # (N,)
+    "ann_bboxes",         # (N, 4) XYWH_ABS
+    "ann_areas",          # (N,)
+    "ann_iscrowd",        # (N,)
+    "ann_ignore",         # (N,) optional LVIS "ignore" flag
+    "neg_offsets",        # (I + 1,) LVIS `neg_category_ids` of image i
+    "neg_category_ids",
+    "nel_offsets",        # (I + 1,) LVIS `not_exhaustive_category_ids` of image i
+    "nel_category_ids",
+    "cat_ids",            # (C,) sorted category ids
+    "cat_frequency",      # (C,) index into `FREQUENCIES`, -1 if unknown (COCO)
+]
+
+
+def default_index_dir(json_file):
+    return json_file + ".gtindex"
+
+
+def file_sha256(path, chunk_size=1 << 24):
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class GTIndex:
+    """Memory-mapped view of an index written by `build_gt_index()`."""
+
+    def __init__(self, index_dir):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        for name in ARRAY_NAMES:
+            setattr(self, name, np.load(os.path.join(index_dir, name + ".npy"), mmap_mode="r"))
+
+        self.images = self.meta["images"]  # sorted by id, without the per-image category lists
+        self.categories = self.meta["categories"]
+        self.kind = self.meta["kind"]
+
+    @property
+    def json_sha256(self):
+        return self.meta["json_sha256"]
+
+    def check(self):
+        """Cheap structural consistency check of the loaded arrays against `meta.json`."""
+        num_imgs, num_anns = self.meta["num_images"], self.meta["num_annotations"]
+        assert self.meta["format_version"] == FORMAT_VERSION, "Unsupported index format"
+        assert len(self.img_ids) == num_imgs and len(self.images) == num_imgs
+        assert len(self.cat_ids) == len(self.categories) == len(self.cat_frequency)
+        for offsets in (self.ann_offsets, self.neg_offsets, self.nel_offsets):
+            assert len(offsets) == num_imgs + 1 and offsets[0] == 0
+        assert self.ann_offsets[-1] == num_anns == len(self.ann_ids) == len(self.ann_bboxes) == len(self.ann_areas)
+        assert self.neg_offsets[-1] == len(self.neg_category_ids)
+        assert self.nel_offsets[-1] == len(self.nel_category_ids)
+
+    def image_lists(self, offsets, values):
+        values = values.tolist()
+        offsets = offsets.tolist()
+        return [values[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+
+    def to_dataset_dict(self):
+        """
+        Rebuild a box-only version of the json content ("images", "categories", "annotations"), with images sorted
+        by id and annotations grouped per image in their original order.
+        """
+        images = [dict(img) for img in self.images]
+        if self.kind == "lvis":
+            neg_lists = self.image_lists(self.neg_offsets, self.neg_category_ids)
+            nel_lists = self.image_lists(self.nel_offsets, self.nel_category_ids)
+            for img, neg, nel in zip(images, neg_lists, nel_lists):
+                img["neg_category_ids"] = neg
+                img["not_exhaustive_category_ids"] = nel
+
+        annotations = [
+            {"id": ann_id, "image_id": image_id, "category_id": category_id, "bbox": bbox, "area": area}
+            for ann_id, image_id, category_id, bbox, area in zip(
+                self.ann_ids.tolist(),
+                self.ann_image_ids.tolist(),
+                self.ann_category_ids.tolist(),
+                self.ann_bboxes.tolist(),
+                self.ann_areas.tolist(),
+            )
+        ]
+        if self.kind == "coco":
+            for ann, iscrowd in zip(annotations, self.ann_iscrowd.tolist()):
+                ann["iscrowd"] = iscrowd
+        for ann_idx in np.flatnonzero(self.ann_ignore).tolist():
+            annotations[ann_idx]["ignore"] = 1
+
+        return {"images": images, "categories": [dict(cat) for cat in self.categories], "annotations": annotations}
+
+
+def _arrays_from_dataset(dataset):
+    images = sorted(dataset["images"], key=lambda img: img["id"])
+    img_ids = np.array([img["id"] for img in images], dtype=np.int64)
+
+    anns = dataset.get("annotations", [])
+    ann_image_ids = np.array([ann["image_id"] for ann in anns], dtype=np.int64)
+    # group annotations per image, keeping their original order within an image
+    order = np.argsort(np.searchsorted(img_ids, ann_image_ids), kind="mergesort")
+    ann_offsets = np.searchsorted(ann_image_ids[order], img_ids, side="left")
+    ann_offsets = np.append(ann_offsets, len(anns)).astype(np.int64)
+    anns = [anns[i] for i in order]
+
+    def lists_to_csr(field):
+        lists = [img.get(field, []) for img in images]
+        offsets = np.cumsum([0] + [len(values) for values in lists]).astype(np.int64)
+        values = np.array([value for values in lists for value in values], dtype=np.int64)
+        return offsets, values
+
+    neg_offsets, neg_category_ids = lists_to_csr("neg_category_ids")
+    nel_offsets, nel_category_ids = lists_to_csr("not_exhaustive_category_ids")
+
+    categories = sorted(dataset["categories"], key=lambda cat: cat["id"])
+    cat_frequency = [
+        FREQUENCIES.index(cat["frequency"]) if cat.get("frequency") in FREQUENCIES else -1 for cat in categories
+    ]
+
+    arrays = {
+        "img_ids": img_ids,
+        "ann_offsets": ann_offsets,
+        "ann_ids": np.array([ann["id"] for ann in anns], dtype=np.int64),
+        "ann_image_ids": ann_image_ids[order],
+        "ann_category_ids": np.array([ann["category_id"] for ann in anns], dtype=np.int64),
+        "ann_bboxes": np.array([ann["bbox"] for ann in anns], dtype=np.float64).reshape(-1, 4),
+        "ann_areas": np.array([ann["area"] for ann in anns], dtype=np.float64),
+        "ann_iscrowd": np.array([ann.get("iscrowd", 0) for ann in anns], dtype=np.uint8),
+        "ann_ignore": np.array([ann.get("ignore", 0) for ann in anns], dtype=np.uint8),
+        "neg_offsets": neg_offsets,
+        "neg_category_ids": neg_category_ids,
+        "nel_offsets": nel_offsets,
+        "nel_category_ids": nel_category_ids,
+        "cat_ids": np.array([cat["id"] for cat in categories], dtype=np.int64),
+        "cat_frequency": np.array(cat_frequency, dtype=np.int8),
+    }
+
+    lists = ("neg_category_ids", "not_exhaustive_category_ids")
+    meta_images = [{k: v for k, v in img.items() if k not in lists} for img in images]
+    return arrays, meta_images, categories
+
+
+def build_gt_index(json_file, index_dir=None):
+    """
+    Convert `json_file` into a memory-mapped index in `index_dir` (default: `<json_file>.gtindex`), validate it
+    against the parsed JSON and return it as `GTIndex`. An existing index is replaced atomically.
+    """
+    index_dir = index_dir or default_index_dir(json_file)
+    logger.info("Building ground-truth index of {} in {}".format(json_file, index_dir))
+
+    json_sha256 = file_sha256(json_file)
+    with open(json_file, "r") as f:
+        dataset = json.load(f)
+
+    arrays, images, categories = _arrays_from_dataset(dataset)
+    meta = {
+        "format_version": FORMAT_VERSION,
+        "kind": "lvis" if any("neg_category_ids" in img for img in dataset["images"]) else "coco",
+        "json_file": os.path.abspath(json_file),
+        "json_sha256": json_sha256,
+        "num_images": len(images),
+        "num_annotations": len(arrays["ann_ids"]),
+        "images": images,
+        "categories": categories,
+    }
+
+    parent_dir = os.path.dirname(os.path.abspath(index_dir))
+    tmp_dir = tempfile.mkdtemp(prefix=".gtindex-", dir=parent_dir)
+    try:
+        for name in ARRAY_NAMES:
+            np.save(os.path.join(tmp_dir, name + ".npy"), arrays[name])
+        with open(os.path.join(tmp_dir, "meta.json"), "w") as f:
+            json.dump(meta, f)
+
+        _validate(GTIndex(tmp_dir), dataset, arrays)
+
+        if os.path.isdir(index_dir):
+            stale_dir = tempfile.mkdtemp(prefix=".gtindex-stale-", dir=parent_dir)
+            os.replace(index_dir, os.path.join(stale_dir, "index"))
+            shutil.rmtree(stale_dir, ignore_errors=True)
+        os.replace(tmp_dir, index_dir)
+    except BaseException:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        raise
+
+    return GTIndex(index_dir)
+
+
+def _validate(gt_index, dataset, arrays):
+    """Check the written index against the arrays it was built from and against the raw JSON content."""
+    gt_index.check()
+    for name in ARRAY_NAMES:
+        if not np.array_equal(getattr(gt_index, name), arrays[name]):
+            raise ValueError("Ground-truth index array {} does not match the source json".format(name))
+
+    anns = dataset.get("annotations", [])
+    assert len(anns) == len(gt_index.ann_ids) and len(dataset["images"]) == len(gt_index.img_ids)
+    by_id = {ann["id"]: ann for ann in anns}
+    for ann_id, image_id, category_id, bbox, area in zip(
+            gt_index.ann_ids.tolist(), gt_index.ann_image_ids.tolist(), gt_index.ann_category_ids.tolist(),
+            gt_index.ann_bboxes.tolist(), gt_index.ann_areas.tolist(),
+    ):
+        ann = by_id[ann_id]
+        if (ann["image_id"], ann["category_id"], list(map(float, ann["bbox"])), float(ann["area"])) != (
+                image_id, category_id, bbox, area
+        ):
+            raise ValueError("Ground-truth index does not match annotation {} of the source json".format(ann_id))
+
+
+def load_gt_index(json_file, index_dir=None, build=True):
+    """
+    Return the `GTIndex` of `json_file`, (re)building it if it is missing, stale (json hash changed) or unreadable.
+    Returns None if the index cannot be used and `build` is False or building fails (e.g. read-only dataset dir).
+    """
+    index_dir = index_dir or default_index_dir(json_file)
+    if os.path.isdir(index_dir):
+        try:
+            gt_index = GTIndex(index_dir)
+            gt_index.check()
+            if gt_index.json_sha256 == file_sha256(json_file):
+                return gt_index
+            logger.info("Ground-truth index {} is stale, {} changed".format(index_dir, json_file))
+        except Exception as e:
+            logger.warning("Could not load ground-truth index {}: {}".format(index_dir, e))
+
+    if not build:
+        return None
+    try:
+        return build_gt_index(json_file, index_dir)
+    except OSError as e:
+        logger.warning("Could not build ground-truth index of {}, falling back to json: {}".format(json_file, e))
+        return None
+
+
+def load_lvis_api(json_file, use_gt_index=True):
+    """`lvis.LVIS` of `json_file`, built from the ground-truth index when possible (box-only)."""
+    gt_index = load_gt_index(json_file) if use_gt_index else None
+    if gt_index is None:
+        return LVIS(json_file)
+    return CachedLVIS(gt_index)
+
+
+def load_coco_api(json_file, use_gt_index=True):
+    """`pycocotools.coco.COCO` of `json_file`, built from the ground-truth index when possible (box-only)."""
+    from pycocotools.coco import COCO
+
+    gt_index = load_gt_index(json_file) if use_gt_index else None
+    with contextlib.redirect_stdout(io.StringIO()):
+        if gt_index is None:
+            return COCO(json_file)
+        coco_api = COCO()
+        coco_api.dataset = gt_index.to_dataset_dict()
+        coco_api.createIndex()
+    coco_api.gt_index = gt_index
+    return coco_api
+
+
+class CachedLVIS(LVIS):
+    """
+    `LVIS` API built from a `GTIndex` instead of the json file. Annotations have no "segmentation", so it can only be
+    used for box evaluation. `VectorizedLVISEval` reads the gts directly from `self.gt_index`.
+    """
+
+    def __init__(self, gt_index):
+        self.logger = logging.getLogger(__name__)
+        self.logger.info("Loading annotations from {}.".format(gt_index.index_dir))
+        self.gt_index = gt_index
+        self.dataset = gt_index.to_dataset_dict()
+        self._create_index()
+
+
+def load_lvis_json_cached(json_file, image_root, dataset_name=None):
+    """
+    Box-only equivalent of `detectron2.data.datasets.load_lvis_json` reading from the ground-truth index. Falls
+    back to `load_lvis_json` if the index cannot be used.
+    """
+    from detectron2.data.datasets import load_lvis_json
+
+    gt_index = load_gt_index(json_file)
+    if gt_index is None:
+        return load_lvis_json(json_file, image_root, dataset_name)
+
+    meta = MetadataCatalog.get(dataset_name) if dataset_name is not None else None
+    id_map = meta.get("thing_dataset_id_to_contiguous_id") if meta is not None else None
+
+    neg_lists = gt_index.image_lists(gt_index.neg_offsets, gt_index.neg_category_ids)
+    nel_lists = gt_index.image_lists(gt_index.nel_offsets, gt_index.nel_category_ids)
+    offsets = gt_index.ann_offsets.tolist()
+    bboxes = gt_index.ann_bboxes.tolist()
+    category_ids = gt_index.ann_category_ids.tolist()
+
+    dataset_dicts = []
+    for img_idx, img_dict in enumerate(gt_index.images):
+        # Same as `load_lvis_json`: the split folder ("train2017", "val2017") comes from the coco_url field
+        split_folder, file_name = img_dict["coco_url"].split("/")[-2:]
+        record = {
+            "file_name": os.path.join(image_root + split_folder, file_name),
+            "height": img_dict["height"],
+            "width": img_dict["width"],
+            "not_exhaustive_category_ids": nel_lists[img_idx],
+            "neg_category_ids": neg_lists[img_idx],
+            "image_id": img_dict["id"],
+        }
+        record["annotations"] = [
+            {
+                "bbox": bboxes[ann_idx],
+                "bbox_mode": BoxMode.XYWH_ABS,
+                "category_id": id_map[category_ids[ann_idx]] if id_map else category_ids[ann_idx] - 1,
+            }
+            for ann_idx in range(offsets[img_idx], offsets[img_idx + 1])
+        ]
+        dataset_dicts.append(record)
+
+    logger.info("Loaded {} images in the LVIS format from {}".format(len(dataset_dicts), gt_index.index_dir))
+    return dataset_dicts
+
+
+def load_coco_json_cached(json_file, image_root, dataset_name):
+    """
+    Box-only equivalent of `detectron2.data.datasets.load_coco_json` for splits whose metadata already defines
+    `thing_dataset_id_to_contiguous_id`. Falls back to `load_coco_json` if the index cannot be used.
+    """
+    from detectron2.data.datasets import load_coco_json
+
+    gt_index = load_gt_index(json_file)
+    if gt_index is None:
+        return load_coco_json(json_file, image_root, dataset_name)
+
+    id_map = MetadataCatalog.get(dataset_name).thing_dataset_id_to_contiguous_id
+    offsets = gt_index.ann_offsets.tolist()
+    bboxes = gt_index.ann_bboxes.tolist()
+    category_ids = gt_index.ann_category_ids.tolist()
+    iscrowd = gt_index.ann_iscrowd.tolist()
+
+    dataset_dicts = []
+    for img_idx, img_dict in enumerate(gt_index.images):
+        record = {
+            "file_name": os.path.join(image_root, img_dict["file_name"]),
+            "height": img_dict["height"],
+            "width": img_dict["width"],
+            "image_id": img_dict["id"],
+        }
+        record["annotations"] = [
+            {
+                "iscrowd": iscrowd[ann_idx],
+                "bbox": bboxes[ann_idx],
+                "category_id": id_map[category_ids[ann_idx]],
+                "bbox_mode": BoxMode.XYWH_ABS,
+            }
+            for ann_idx in range(offsets[img_idx], offsets[img_idx + 1])
+        ]
+        dataset_dicts.append(record)
+
+    logger.info("Loaded {} images in COCO format from {}".format(len(dataset_dicts), gt_index.index_dir))
+    return dataset_dicts
+
+
+def register_lvis_from_gt_index(dataset_name):
+    """Point an already registered LVIS split (e.g. the builtin "lvis_v1_val") to `load_lvis_json_cached`."""
+    metadata = MetadataCatalog.get(dataset_name)
+    json_file, image_root = metadata.json_file, metadata.image_root
+
+    DatasetCatalog.remove(dataset_name)
+    DatasetCatalog.register(dataset_name, lambda: load_lvis_json_cached(json_file, image_root, dataset_name))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Build the binary ground-truth index of annotation files")
+    parser.add_argument("json_files", nargs="+", type=str)
+    args = parser.parse_args()
+
+    for json_file in args.json_files:
+        gt_index = build_gt_index(json_file)
+        print("{}: {} images, {} annotations -> {}".format(
+            json_file, gt_index.meta["num_images"], gt_index.meta["num_annotations"], gt_index.index_dir
+        ))
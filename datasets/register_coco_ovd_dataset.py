@@ -1,6 +1,8 @@
 import os
+from detectron2.data import DatasetCatalog, MetadataCatalog
 from detectron2.data.datasets.register_coco import register_coco_instances
 from detectron2.data.datasets.builtin_meta import _get_coco_instances_meta
+from datasets.gt_index import load_coco_json_cached
 
 coco_meta = _get_coco_instances_meta()
 
@@ -11,10 +13,18 @@ CUSTOM_SPLITS_COCO = {
     "coco_ovd_val": ("coco/val2017", "coco/annotations/ovd_instances_val2017_basetarget.json"),
 }
 
+# Evaluation splits only need boxes, they are loaded from the binary ground-truth index (see `datasets/gt_index.py`)
+BOX_ONLY_SPLITS = ["coco_ovd_val"]
+
 for key, (image_root, json_file) in CUSTOM_SPLITS_COCO.items():
-    register_coco_instances(
+    json_file = os.path.join(_root, json_file)
+    image_root = os.path.join(_root, image_root)
+    if key not in BOX_ONLY_SPLITS:
+        register_coco_instances(key, coco_meta, json_file, image_root)
+        continue
+
+    DatasetCatalog.register(
         key,
-        coco_meta,
-        os.path.join(_root, json_file),
-        os.path.join(_root, image_root),
-    )
\ No newline at end of file
+        lambda key=key, json_file=json_file, image_root=image_root: load_coco_json_cached(json_file, image_root, key),
+    )
+    MetadataCatalog.get(key).set(json_file=json_file, image_root=image_root, evaluator_type="coco", **coco_meta)
@@ -2,7 +2,7 @@ import os
 
 from detectron2.data.datasets.lvis import get_lvis_instances_meta
 from detectron2.data import DatasetCatalog, MetadataCatalog
-from detectron2.data.datasets import load_lvis_json
+from datasets.gt_index import load_lvis_json_cached
 
 _root = os.getenv("DETECTRON2_DATASETS", "datasets")
 
@@ -16,7 +16,7 @@ try:
 except:
     DatasetCatalog.register(
         name="lvis_v1_val_subset",
-        func=lambda: load_lvis_json(
+        func=lambda: load_lvis_json_cached(
             json_file=json_path_val,
             image_root=image_root_val,
             dataset_name="lvis_v1_val_subset"
@@ -0,0 +1,100 @@
+"""
+Synthetic LVIS v1 style dataset, used by `scripts/novel_object_detection/benchmark.py` to run the pipeline and its
+evaluation without the LVIS / COCO files.
+
+Images are random noise with filled rectangles of random colors, one gt box per rectangle with a random LVIS v1
+category; the categories are the real LVIS v1 ones so that the class space (and the COCO -> LVIS mapping) of the
+pipeline is unchanged. The dataset is generated once per set of parameters under `root` and is deterministic given
+`seed`.
+"""
+import json
+import os
+
+import cv2
+import numpy as np
+
+from detectron2.data import DatasetCatalog, MetadataCatalog
+from detectron2.data.datasets.lvis import get_lvis_instances_meta
+from detectron2.data.datasets.lvis_v1_categories import LVIS_CATEGORIES as LVIS_V1_CATEGORIES
+from datasets.gt_index import load_lvis_json_cached
+
+SPLIT_FOLDER = "synthetic"
+
+
+def generate_synthetic_lvis(root, num_images=20, image_size=(480, 640), max_objects=8, seed=0):
+    """
+    Writes `num_images` jpg images of `image_size` (height, width) to `<root>/synthetic/` and their annotations in
+    the LVIS format to `<root>/lvis_v1_synthetic_<num_images>_<height>x<width>_<seed>.json`, unless it exists.
+
+    Returns:
+        json_file, image_root: as expected by `load_lvis_json`
+    """
+    height, width = image_size
+    json_file = os.path.join(root, "lvis_v1_synthetic_{}_{}x{}_{}.json".format(num_images, height, width, seed))
+    image_root = os.path.join(root, "")
+    if os.path.isfile(json_file):
+        return json_file, image_root
+
+    os.makedirs(os.path.join(root, SPLIT_FOLDER), exist_ok=True)
+    rng = np.random.RandomState(seed)
+    cat_ids = np.array([cat["id"] for cat in LVIS_V1_CATEGORIES])
+
+    images, annotations = [], []
+    for image_id in range(1, num_images + 1):
+        image = rng.randint(0, 256, size=(height, width, 3), dtype=np.uint8)
+        image_cat_ids = []
+        for _ in range(rng.randint(1, max_objects + 1)):
+            w, h = rng.randint(16, width // 2), rng.randint(16, height // 2)
+            x, y = rng.randint(0, width - w), rng.randint(0, height - h)
+            color = tuple(int(c) for c in rng.randint(0, 256, size=3))
+            cv2.rectangle(image, (x, y), (x + w - 1, y + h - 1), color, thickness=-1)
+
+            cat_id = int(rng.choice(cat_ids))
+            image_cat_ids.append(cat_id)
+            annotations.append({
+                "id": len(annotations) + 1,
+                "image_id": image_id,
+                "category_id": cat_id,
+                "bbox": [x, y, w, h],
+                "area": w * h,
+                "segmentation": [[x, y, x + w, y, x + w, y + h, x, y + h]],
+            })
+
+        file_name = "{:012d}.jpg".format(image_id)
+        cv2.imwrite(os.path.join(root, SPLIT_FOLDER, file_name), image)
+        neg_cat_ids = rng.choice(np.setdiff1d(cat_ids, image_cat_ids), size=5, replace=False)
+        images.append({
+            "id": image_id,
+            "height": height,
+            "width": width,
+            "coco_url": "http://images.cocodataset.org/{}/{}".format(SPLIT_FOLDER, file_name),
+            "not_exhaustive_category_ids": [],
+            "neg_category_ids": sorted(int(cat_id) for cat_id in neg_cat_ids),
+        })
+
+    categories = [
+        {"id": cat["id"], "name": cat["name"], "synonyms": cat["synonyms"], "frequency": cat["frequency"]}
+        for cat in LVIS_V1_CATEGORIES
+    ]
+    tmp_file = json_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump({"images": images, "annotations": annotations, "categories": categories}, f)
+    os.replace(tmp_file, json_file)
+    return json_file, image_root
+
+
+def register_synthetic_lvis(dataset_name, root, **kwargs):
+    """
+    Generates the dataset (see `generate_synthetic_lvis` for `kwargs`) and registers it as `dataset_name`, with the
+    LVIS v1 metadata and the "lvis" evaluator type.
+    """
+    json_file, image_root = generate_synthetic_lvis(root, **kwargs)
+
+    if dataset_name in DatasetCatalog.list():
+        DatasetCatalog.remove(dataset_name)
+        MetadataCatalog.remove(dataset_name)
+    DatasetCatalog.register(dataset_name, lambda: load_lvis_json_cached(json_file, image_root, dataset_name))
+    MetadataCatalog.get(dataset_name).set(
+        json_file=json_file, image_root=image_root, evaluator_type="lvis", **get_lvis_instances_meta("lvis_v1")
+    )
+    return json_file, image_root
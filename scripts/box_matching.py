@@ -0,0 +1,33 @@
+"""
+Vectorized building blocks of the COCO/LVIS matching of detections to ground truth, shared by the LVIS evaluators of
+`novel_object_detection/lvis_eval_utils.py` and the COCO AP50 evaluator of
+`open_vocab_detection/coco_eval_utils/fast_ap50_eval.py`.
+"""
+import numpy as np
+
+
+def last_argmax(values, mask):
+    """Index of the last maximum of `values` along the last axis among the `mask`ed entries."""
+    scores = np.where(mask, values, -np.inf)
+    last = scores.shape[-1] - 1 - np.argmax(scores[..., ::-1], axis=-1)
+    return last, mask.any(axis=-1)
+
+
+def bbox_iou(dt_boxes, gt_boxes, gt_crowd=None):
+    """
+    Batched version of `pycocotools.mask.iou` for boxes in (x, y, w, h) format; the union of a crowd gt is the
+    detection area. dt_boxes: (P, D, 4), gt_boxes: (P, G, 4), gt_crowd: (P, G) or None (no crowd gt) -> (P, D, G)
+    """
+    dx, dy, dw, dh = [dt_boxes[:, :, None, i] for i in range(4)]
+    gx, gy, gw, gh = [gt_boxes[:, None, :, i] for i in range(4)]
+
+    w = np.minimum(dw + dx, gw + gx) - np.maximum(dx, gx)
+    h = np.minimum(dh + dy, gh + gy) - np.maximum(dy, gy)
+    overlap = (w > 0) & (h > 0)
+    inter = w * h
+    union = dw * dh + gw * gh - inter
+    if gt_crowd is not None:
+        union = np.where(gt_crowd[:, None, :], dw * dh, union)
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(overlap, inter / union, 0.0)
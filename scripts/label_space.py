@@ -0,0 +1,121 @@
+"""
+Mappings between the label spaces of the pipelines: the COCO classes of the RCNN to LVIS (`get_coco_to_lvis_mapping`),
+the COCO OVD class order of the CLIP and GDINO prompts to COCO (`get_ovd_id_to_coco_id`), and the contiguous ids of
+the datasets back to their category ids in the evaluators.
+
+`LabelMap` keeps a mapping as a dense lookup tensor, so that the labels of all the detections of an image are mapped
+with one indexing operation instead of a Python loop over the boxes. It can also be read like the dict it is built
+from (`label_map[idx]`, `.get()`, `.items()`). Labels absent from the mapping are mapped to `missing`, as the COCO
+classes without an LVIS counterpart are; with `strict=True` they raise a KeyError instead, as the dict lookups of the
+evaluators did, so that a bug of the label space fails loudly instead of producing results of an invalid category.
+"""
+import torch
+
+
+class LabelMap:
+    def __init__(self, mapping, size=None, missing=-1):
+        """
+        Args:
+            mapping (dict[int, int]): source label -> target label
+            size (int): number of source labels, 1 + the largest key of `mapping` by default
+            missing (int): target of the source labels absent from `mapping`
+        """
+        self._mapping = {int(key): int(value) for key, value in mapping.items()}
+        if size is None:
+            size = max(self._mapping, default=-1) + 1
+        self.missing = missing
+        self.table = torch.full((size,), missing, dtype=torch.int64)
+        if len(self._mapping) > 0:
+            self.table[torch.tensor(list(self._mapping))] = torch.tensor(list(self._mapping.values()))
+        self._tables = {}  # copies of `table` on other devices
+
+    @classmethod
+    def from_names(cls, source_names, target_names, normalize=None, missing=-1):
+        """
+        Maps every source class to the target class of the same name (after `normalize`), or to `missing`. The target
+        names are indexed once, the first of duplicate names is kept.
+        """
+        normalize = normalize or (lambda name: name)
+        target_idx = {}
+        for idx, name in enumerate(target_names):
+            target_idx.setdefault(normalize(name), idx)
+        mapping = {idx: target_idx.get(normalize(name), missing) for idx, name in enumerate(source_names)}
+        return cls(mapping, size=len(source_names), missing=missing)
+
+    def _table(self, device):
+        device = torch.device(device)
+        if device.type == "cpu":
+            return self.table
+        if device not in self._tables:
+            self._tables[device] = self.table.to(device)
+        return self._tables[device]
+
+    def __call__(self, labels, strict=False):
+        """
+        Maps a tensor of labels of any shape, on its device; labels absent from the mapping are mapped to `missing`,
+        or raise a KeyError with `strict`.
+        """
+        labels = torch.as_tensor(labels, dtype=torch.int64)
+        table = self._table(labels.device)
+        if len(table) == 0:
+            mapped = torch.full_like(labels, self.missing)
+        else:
+            inside = (labels >= 0) & (labels < len(table))
+            mapped = torch.where(inside, table[labels.clamp(0, len(table) - 1)], torch.full_like(labels, self.missing))
+        if strict:
+            # labels explicitly mapped to `missing` are mapped, only those absent from the mapping raise
+            unmapped = [
+                label for label in labels[mapped == self.missing].unique().tolist() if label not in self._mapping
+            ]
+            if len(unmapped) > 0:
+                raise KeyError("Labels absent from the label map: {}".format(unmapped))
+        return mapped
+
+    def __getitem__(self, label):
+        return self._mapping[int(label)]
+
+    def __setitem__(self, label, target):
+        label, target = int(label), int(target)
+        self._mapping[label] = target
+        if label >= len(self.table):
+            table = torch.full((label + 1,), self.missing, dtype=torch.int64)
+            table[:len(self.table)] = self.table
+            self.table = table
+        self.table[label] = target
+        self._tables = {}
+
+    def __contains__(self, label):
+        return int(label) in self._mapping
+
+    def __len__(self):
+        return len(self._mapping)
+
+    def __iter__(self):
+        return iter(self._mapping)
+
+    def get(self, label, default=None):
+        return self._mapping.get(int(label), default)
+
+    def items(self):
+        return self._mapping.items()
+
+    def inverse(self):
+        """Target label -> source label; the first source label is kept when several have the same target."""
+        mapping = {}
+        for key, value in self._mapping.items():
+            if value != self.missing:
+                mapping.setdefault(value, key)
+        return LabelMap(mapping, missing=self.missing)
+
+
+def remap_category_ids(results, label_map, strict=True):
+    """
+    Maps the "category_id" of every result dict of an evaluator (in place) with one lookup of `label_map`; a category
+    absent from it raises a KeyError unless `strict` is False.
+    """
+    category_ids = label_map(
+        torch.tensor([result["category_id"] for result in results], dtype=torch.int64), strict=strict
+    )
+    for result, category_id in zip(results, category_ids.tolist()):
+        result["category_id"] = category_id
+    return results
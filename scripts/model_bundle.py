@@ -0,0 +1,190 @@
+"""
+Single memory-mapped file holding the weights of several models.
+
+Each loader of the pipeline reads and unpickles its own checkpoint into private memory. A bundle stores the
+`state_dict()` of every model (and extra tensors such as the CLIP text features) as raw, 64-byte aligned arrays
+after a JSON header:
+
+    [8 bytes: header length, little endian][header JSON][padding][tensor data ...]
+
+`ModelBundle` maps the file copy-on-write and `assign()` makes the parameters and buffers of a freshly built model
+views of it, so that no weight is read before it is used and processes on the same host share the physical pages
+(until they write to them). Building the models themselves is made cheap with `skip_init()`, as their random
+initialization is overwritten anyway.
+"""
+import contextlib
+import json
+import os
+import struct
+import threading
+
+import numpy as np
+import torch
+from torch import nn
+
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+
+# torch dtype -> (name in the header, numpy dtype the bytes are viewed as)
+_DTYPES = {
+    torch.float64: ("float64", np.float64),
+    torch.float32: ("float32", np.float32),
+    torch.float16: ("float16", np.float16),
+    torch.bfloat16: ("bfloat16", np.int16),
+    torch.int64: ("int64", np.int64),
+    torch.int32: ("int32", np.int32),
+    torch.int16: ("int16", np.int16),
+    torch.int8: ("int8", np.int8),
+    torch.uint8: ("uint8", np.uint8),
+    torch.bool: ("bool", np.bool_),
+}
+_NUMPY_DTYPES = {name: np_dtype for name, np_dtype in _DTYPES.values()}
+
+
+def write_model_bundle(path, models, tensors=None, metadata=None):
+    """
+    Args:
+        path (str): bundle file, written atomically
+        models (dict[str, nn.Module]): name -> model, stored as "<name>.<state_dict key>"
+        tensors (dict[str, Tensor]): extra tensors stored under their own name
+        metadata (dict): json-serializable, e.g. the checkpoints the bundle was built from
+    """
+    entries = {}
+    for name, model in models.items():
+        for key, tensor in model.state_dict().items():
+            entries["{}.{}".format(name, key)] = tensor
+    for name, tensor in (tensors or {}).items():
+        entries[name] = tensor
+
+    header = {"format_version": FORMAT_VERSION, "metadata": metadata or {}, "tensors": {}}
+    arrays = []
+    offset = 0
+    stored = {}  # storage already written (tied weights) -> its entry
+    for name, tensor in entries.items():
+        key = (tensor.device, tensor.data_ptr(), tensor.dtype, tuple(tensor.shape), tensor.stride())
+        if key in stored:
+            header["tensors"][name] = header["tensors"][stored[key]]
+            continue
+        tensor = tensor.detach().to("cpu").contiguous()
+        dtype_name, np_dtype = _DTYPES[tensor.dtype]
+        if tensor.dtype == torch.bfloat16:
+            tensor = tensor.view(torch.int16)
+        array = tensor.numpy()
+        header["tensors"][name] = {"dtype": dtype_name, "shape": list(array.shape), "offset": offset}
+        arrays.append((offset, array))
+        stored[key] = name
+        offset += -(-array.nbytes // ALIGNMENT) * ALIGNMENT
+
+    header_bytes = json.dumps(header).encode("utf-8")
+    data_start = -(-(8 + len(header_bytes)) // ALIGNMENT) * ALIGNMENT
+
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(struct.pack("<Q", len(header_bytes)))
+        f.write(header_bytes)
+        for array_offset, array in arrays:
+            f.seek(data_start + array_offset)
+            f.write(array.tobytes())
+        f.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+
+class ModelBundle:
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            header_length = struct.unpack("<Q", f.read(8))[0]
+            header = json.loads(f.read(header_length).decode("utf-8"))
+        if header["format_version"] != FORMAT_VERSION:
+            raise ValueError("{} has format version {}, expected {}".format(
+                path, header["format_version"], FORMAT_VERSION
+            ))
+        self.metadata = header["metadata"]
+        self._entries = header["tensors"]
+        self._data_start = -(-(8 + header_length) // ALIGNMENT) * ALIGNMENT
+        # copy-on-write: pages are shared between processes until a process writes to them
+        self._buffer = np.memmap(path, dtype=np.uint8, mode="c")
+
+    def names(self, prefix=""):
+        return [name for name in self._entries if name.startswith(prefix)]
+
+    def tensor(self, name):
+        """Tensor `name`, a view of the mapped file."""
+        entry = self._entries[name]
+        np_dtype = _NUMPY_DTYPES[entry["dtype"]]
+        count = int(np.prod(entry["shape"]))
+        start = self._data_start + entry["offset"]
+        array = self._buffer[start:start + count * np.dtype(np_dtype).itemsize].view(np_dtype).reshape(entry["shape"])
+        tensor = torch.from_numpy(array)
+        if entry["dtype"] == "bfloat16":
+            tensor = tensor.view(torch.bfloat16)
+        return tensor
+
+    def state_dict(self, prefix):
+        """State dict of the model stored under `prefix`, with views of the mapped file."""
+        return {name[len(prefix) + 1:]: self.tensor(name) for name in self.names(prefix + ".")}
+
+    def assign(self, model, prefix):
+        """
+        Replaces the parameters and buffers of `model` by the views of the model stored under `prefix`, without
+        copying. Raises if the bundle and the model do not have the same keys and shapes.
+        """
+        state_dict = self.state_dict(prefix)
+        expected = model.state_dict()
+        missing = sorted(set(expected) - set(state_dict))
+        unexpected = sorted(set(state_dict) - set(expected))
+        if missing or unexpected:
+            raise KeyError("{} does not match {}: missing {}, unexpected {}".format(
+                prefix, type(model).__name__, missing[:10], unexpected[:10]
+            ))
+
+        for key, tensor in state_dict.items():
+            if tensor.shape != expected[key].shape:
+                raise ValueError("{}.{} has shape {} in the bundle, {} in the model".format(
+                    prefix, key, tuple(tensor.shape), tuple(expected[key].shape)
+                ))
+            module_path, _, leaf = key.rpartition(".")
+            module = model.get_submodule(module_path) if module_path else model
+            if leaf in module._parameters:
+                module._parameters[leaf] = nn.Parameter(tensor, requires_grad=False)
+            else:
+                module._buffers[leaf] = tensor
+        return model
+
+
+_INIT_FUNCTIONS = [
+    "uniform_", "normal_", "trunc_normal_", "constant_", "ones_", "zeros_", "eye_", "dirac_",
+    "xavier_uniform_", "xavier_normal_", "kaiming_uniform_", "kaiming_normal_", "orthogonal_", "sparse_",
+]
+_skip_init_lock = threading.Lock()
+_skip_init_depth = 0
+_init_functions = {}
+
+
+@contextlib.contextmanager
+def skip_init(enabled=True):
+    """
+    Makes the `torch.nn.init` functions no-ops, for models whose weights are assigned right after being built. The
+    patch is process-wide and reference-counted, so models can be built from several threads (`ModelRegistry`).
+    """
+    global _skip_init_depth
+    if not enabled:
+        yield
+        return
+
+    with _skip_init_lock:
+        if _skip_init_depth == 0:
+            for name in _INIT_FUNCTIONS:
+                if hasattr(nn.init, name):
+                    _init_functions[name] = getattr(nn.init, name)
+                    setattr(nn.init, name, lambda tensor, *args, **kwargs: tensor)
+        _skip_init_depth += 1
+    try:
+        yield
+    finally:
+        with _skip_init_lock:
+            _skip_init_depth -= 1
+            if _skip_init_depth == 0:
+                for name, function in _init_functions.items():
+                    setattr(nn.init, name, function)
+                _init_functions.clear()
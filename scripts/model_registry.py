@@ -0,0 +1,113 @@
+"""
+Lazily loaded models of the pipelines.
+
+Loading Grounding DINO, Mask R-CNN, SigLIP (with the text features of the whole vocabulary) and SAM ViT-H one after
+the other takes minutes, mostly checkpoint I/O and deserialization. `ModelRegistry` only records how to build each
+model: a model is loaded on first access (`registry["sam"]`), and `preload()` loads independent models concurrently
+in a thread pool so that their I/O overlaps. Loading one model is never repeated, even when a `preload()` and an
+access race for it.
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+
+class ModelRegistry:
+    def __init__(self):
+        self._loaders = OrderedDict()
+        self._dependencies = {}
+        self._futures = {}
+        self._lock = threading.Lock()
+        self.load_times = OrderedDict()
+
+    def register(self, name, loader, dependencies=()):
+        """
+        Args:
+            loader (callable): called with the loaded values of `dependencies` (in order), returns the model
+            dependencies (tuple[str]): names of registered entries `loader` needs
+        """
+        for dependency in dependencies:
+            if dependency not in self._loaders:
+                raise KeyError("{} depends on {}, which is not registered".format(name, dependency))
+        self._loaders[name] = loader
+        self._dependencies[name] = tuple(dependencies)
+
+    def names(self):
+        return list(self._loaders.keys())
+
+    def is_loaded(self, name):
+        future = self._futures.get(name)
+        return future is not None and future.done()
+
+    def get(self, name):
+        """Returns the model `name`, loading it in the calling thread if no other thread is already loading it."""
+        if name not in self._loaders:
+            raise KeyError("{} is not registered, available: {}".format(name, self.names()))
+        future, owner = self._claim(name)
+        if owner:
+            self._load(name, future)
+        return future.result()
+
+    __getitem__ = get
+
+    def preload(self, names=None, max_workers=4, wait=True):
+        """
+        Loads `names` (all registered entries by default) and their dependencies in a pool of `max_workers` threads.
+        Entries are submitted after their dependencies, so that a worker only ever waits for loads that already
+        started. With `wait=False` the loads continue in the background and `get()` waits for them when needed.
+        """
+        order = self._load_order(self.names() if names is None else names)
+        executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="model_registry")
+        for name in order:
+            future, owner = self._claim(name)
+            if owner:
+                executor.submit(self._load, name, future)
+        executor.shutdown(wait=False)
+
+        if wait:
+            for name in order:
+                self._futures[name].result()
+
+    def _claim(self, name):
+        """Returns the future of `name` and whether the caller is the one that has to load it."""
+        with self._lock:
+            future = self._futures.get(name)
+            if future is not None:
+                return future, False
+            future = Future()
+            self._futures[name] = future
+            return future, True
+
+    def _load(self, name, future):
+        try:
+            dependencies = [self.get(dependency) for dependency in self._dependencies[name]]
+            start = time.perf_counter()
+            model = self._loaders[name](*dependencies)
+            self.load_times[name] = time.perf_counter() - start
+            logger.info("Loaded {} in {:.1f}s".format(name, self.load_times[name]))
+        except BaseException as e:
+            future.set_exception(e)
+        else:
+            future.set_result(model)
+
+    def _load_order(self, names):
+        order = []
+
+        def visit(name, path):
+            if name in order:
+                return
+            if name in path:
+                raise ValueError("Circular dependency: {}".format(" -> ".join(path + [name])))
+            for dependency in self._dependencies[name]:
+                visit(dependency, path + [name])
+            order.append(name)
+
+        for name in names:
+            if name not in self._loaders:
+                raise KeyError("{} is not registered, available: {}".format(name, self.names()))
+            visit(name, [])
+        return order
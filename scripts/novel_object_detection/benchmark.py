@@ -0,0 +1,253 @@
+"""
+CPU benchmark of the NOD pipeline, runnable without the trained checkpoints or a GPU.
+
+Every model is built through the loaders of `load_models.py` with a small configuration and random weights
+(`cfg/GroundingDINO/GDINO_benchmark.py`, `cfg/MaskRCNN_R101-FPN-New-Baseline/R18-FPN-Benchmark.py`,
+`cfg/SigLIP/SigLIP-benchmark.json` and the "tiny" SAM), and the images come from a synthetic LVIS v1 dataset
+registered in detectron2 (`datasets/synthetic_lvis.py`). The class space is the full LVIS v1 vocabulary, so the
+per-image work outside of the networks (prompts, crops, fusion, SAM prompts, evaluation) is that of a real run.
+
+Measured: model load times, per-stage latency (p50/p95/p99) and candidate counts of `inference_gdino` over the
+dataset loop and of `NOD.infer`, images/s, evaluation time and peak RSS. Results are compared to a stored baseline
+and the script exits with status 1 when a p50 latency or a throughput regresses by more than `--tolerance`.
+
+Usage, from the project root (the BERT text encoder of Grounding DINO is still loaded from the HuggingFace cache):
+    python scripts/novel_object_detection/benchmark.py --save-baseline   # on the reference commit
+    python scripts/novel_object_detection/benchmark.py                   # on the change to check
+"""
+import os
+import sys
+import json
+import argparse
+import platform
+import resource
+import time
+
+proj_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../"))
+sys.path.append(proj_path)
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+import open_clip
+import torch
+import detectron2.data.transforms as T
+
+from collections import OrderedDict
+from pathlib import Path
+from detectron2.data import build_detection_test_loader, get_detection_dataset_dicts, DatasetMapper
+from segment_anything.utils.transforms import ResizeLongestSide
+
+from load_models import load_gdino_model, load_fully_supervised_trained_model, load_clip_model, load_sam_model
+from utils import get_text_prompt_list_for_g_dino, get_coco_to_lvis_mapping
+from evaluation import CustomEvaluator, LVISEvaluatorCustom, _run_generic_evaluation_loop
+from profiling import StageProfiler
+from nod_model import NOD
+from datasets.synthetic_lvis import register_synthetic_lvis
+
+DATASET_NAME = "lvis_v1_synthetic"
+
+GDINO_CFG = "cfg/GroundingDINO/GDINO_benchmark.py"
+RCNN_CFG = "cfg/MaskRCNN_R101-FPN-New-Baseline/R18-FPN-Benchmark.py"
+CLIP_CFG = "cfg/SigLIP/SigLIP-benchmark.json"
+SAM_MODEL_TYPE = "tiny"
+
+
+def load_benchmark_models(device):
+    """Builds the random-weight models with the loaders of `main.py`; returns them and their load times in s."""
+    torch.manual_seed(0)
+    load_times = OrderedDict()
+
+    start = time.perf_counter()
+    model = load_gdino_model(GDINO_CFG, None, device).to(device)
+    load_times["gdino"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    rcnn_model, cfg = load_fully_supervised_trained_model(RCNN_CFG, None)
+    load_times["rcnn"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    open_clip.add_model_config(CLIP_CFG)
+    clip_model, preprocess, text_features, _ = load_clip_model(
+        DATASET_NAME, device, model_name=Path(CLIP_CFG).stem, pretrained=None
+    )
+    load_times["clip"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    sam = load_sam_model(device, None, model_type=SAM_MODEL_TYPE)
+    load_times["sam"] = time.perf_counter() - start
+
+    return (model, rcnn_model, cfg, clip_model, preprocess, text_features, sam), load_times
+
+
+def build_param_dict(models, out_dir, class_len_per_prompt, device, lvis_data_split = DATASET_NAME):
+    """Same `param_dict` as `main.py`."""
+    model, rcnn_model, cfg, clip_model, preprocess, text_features, sam = models
+    text_prompt_list, positive_map_list = get_text_prompt_list_for_g_dino(
+        lvis_data_split, model.tokenizer, class_len_per_prompt
+    )
+
+    param_dict = {}
+    param_dict["visualize"] = False
+    param_dict["out_dir"] = out_dir
+    param_dict["lvis_data_split"] = lvis_data_split
+    param_dict["class_len_per_prompt"] = class_len_per_prompt
+    param_dict["positive_map_list"] = positive_map_list
+    param_dict["rcnn_model"] = rcnn_model
+
+    param_dict["clip_model"] = clip_model
+    param_dict["preprocess"] = preprocess
+    param_dict["text_features"] = text_features
+    param_dict["clip_model_name"] = Path(CLIP_CFG).stem
+    param_dict["device"] = device
+
+    param_dict["coco_to_lvis"] = get_coco_to_lvis_mapping(cfg, lvis_data_split)
+
+    param_dict["sam"] = sam
+    param_dict["resize_transform"] = ResizeLongestSide(sam.image_encoder.img_size)
+
+    return text_prompt_list, param_dict
+
+
+def run_benchmark(args):
+    device = "cpu"
+    torch.set_num_threads(args.num_threads)
+    out_dir = os.path.normpath(os.path.join(script_dir, "../../outputs/benchmark"))
+    Path(out_dir).mkdir(parents=True, exist_ok=True)
+
+    json_file, image_root = register_synthetic_lvis(
+        DATASET_NAME,
+        args.data_dir or os.path.join(out_dir, "data"),
+        num_images=args.num_images,
+        image_size=tuple(args.image_size),
+    )
+
+    models, load_times = load_benchmark_models(device)
+    model = models[0]
+    text_prompt_list, param_dict = build_param_dict(models, out_dir, args.class_len_per_prompt, device)
+
+    results = OrderedDict()
+    results["environment"] = OrderedDict([
+        ("torch", torch.__version__),
+        ("num_threads", torch.get_num_threads()),
+        ("cpu_count", os.cpu_count()),
+        ("machine", platform.machine()),
+        ("num_images", args.num_images),
+        ("image_size", list(args.image_size)),
+    ])
+    results["load_s"] = load_times
+
+    # Dataset loop of `main.py`: `inference_gdino` on every image, followed by the LVIS evaluation
+    test_loader = build_detection_test_loader(
+        dataset = get_detection_dataset_dicts(names = DATASET_NAME, filter_empty=False),
+        mapper= DatasetMapper(
+            is_train = False,
+            augmentations=[
+                T.ResizeShortestEdge(short_edge_length=800, max_size=1333),
+            ],
+            image_format="BGR",
+        ),
+        num_workers=0,
+    )
+    evaluator = CustomEvaluator(
+        evaluator = LVISEvaluatorCustom(dataset_name = DATASET_NAME, distributed = False, output_dir = None)
+    )
+    evaluator.reset()
+
+    param_dict["profiler"] = StageProfiler(num_warmup = args.num_warmup)
+    start = time.perf_counter()
+    _run_generic_evaluation_loop(test_loader, evaluator, model, text_prompt_list, param_dict)
+    loop_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    evaluator.evaluate()
+    results["evaluation_s"] = time.perf_counter() - start
+
+    results["inference_gdino"] = param_dict["profiler"].summary()
+    param_dict["profiler"].export(out_dir, prefix = "benchmark_inference_gdino")
+
+    # Single image API of `inference_single_image.py`
+    param_dict["profiler"] = StageProfiler(num_warmup = args.num_warmup)
+    nod_model = NOD(param_dict, model)
+    image_files = sorted((Path(image_root) / "synthetic").iterdir())
+    start = time.perf_counter()
+    for image_file in image_files:
+        nod_model.infer(str(image_file), text_prompt_list = text_prompt_list, visualize = False, out_dir = out_dir)
+    nod_time = time.perf_counter() - start
+
+    results["nod_infer"] = param_dict["profiler"].summary()
+    param_dict["profiler"].export(out_dir, prefix = "benchmark_nod_infer")
+
+    results["throughput_img_s"] = OrderedDict([
+        ("inference_gdino", args.num_images / loop_time),
+        ("nod_infer", len(image_files) / nod_time),
+    ])
+    # ru_maxrss is in KB on Linux
+    results["max_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    return results
+
+
+def compare_to_baseline(results, baseline, tolerance):
+    """
+    Returns the rows (name, baseline, current, relative change, regressed) of the p50 latency of every stage and the
+    throughput of both pipelines; latencies regress when they grow and throughputs when they drop by > `tolerance`.
+    """
+    rows = []
+    for pipeline in ("inference_gdino", "nod_infer"):
+        for stage, stats in results[pipeline].items():
+            if stage not in baseline.get(pipeline, {}):
+                continue
+            before, after = baseline[pipeline][stage]["p50_ms"], stats["p50_ms"]
+            change = after / before - 1 if before > 0 else 0.0
+            rows.append(("{}/{} p50_ms".format(pipeline, stage), before, after, change, change > tolerance))
+
+        before, after = baseline["throughput_img_s"][pipeline], results["throughput_img_s"][pipeline]
+        change = after / before - 1
+        rows.append(("{} img/s".format(pipeline), before, after, change, change < -tolerance))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CPU benchmark with small random-weight models on synthetic images")
+    parser.add_argument("--num-images", type=int, default=20)
+    parser.add_argument("--image-size", type=int, nargs=2, default=[480, 640], metavar=("HEIGHT", "WIDTH"))
+    parser.add_argument("--num-warmup", type=int, default=2, help="images left out of the latency summaries")
+    parser.add_argument("--num-threads", type=int, default=4, help="torch CPU threads, fixed for reproducibility")
+    parser.add_argument("--class-len-per-prompt", type=int, default=81)
+    parser.add_argument("--data-dir", type=str, default="", help="where the synthetic dataset is generated")
+    parser.add_argument("--baseline", type=str, default=os.path.join(script_dir, "benchmark_baseline.json"))
+    parser.add_argument("--save-baseline", action="store_true", help="save the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="relative change counted as a regression")
+    parser.add_argument("--output", type=str, default="", help="json file to save the results")
+    args = parser.parse_args()
+
+    results = run_benchmark(args)
+    print(json.dumps(results, indent=4))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=4)
+        print("Saved baseline to {}".format(args.baseline))
+        sys.exit(0)
+
+    if not os.path.isfile(args.baseline):
+        print("No baseline at {}, run with --save-baseline first".format(args.baseline))
+        sys.exit(0)
+
+    with open(args.baseline, "r") as f:
+        baseline = json.load(f)
+    if baseline["environment"] != results["environment"]:
+        print("Warning: baseline environment differs: {}".format(baseline["environment"]))
+
+    rows = compare_to_baseline(results, baseline, args.tolerance)
+    print("{:<44}{:>12}{:>12}{:>10}".format("metric", "baseline", "current", "change"))
+    for name, before, after, change, regressed in rows:
+        print("{:<44}{:>12.2f}{:>12.2f}{:>+9.1%}{}".format(
+            name, before, after, change, "  REGRESSION" if regressed else ""
+        ))
+
+    sys.exit(1 if any(row[-1] for row in rows) else 0)
@@ -0,0 +1,51 @@
+"""
+Clusters the SigLIP class embeddings of the vocabulary, offline, for the coarse-to-fine crop classification of
+`HierarchicalClassIndex` (see `class_index.py`).
+
+The embeddings are the `text_features` of `load_clip_model` for `lvis_data_split` (`params.json`): every class is the
+mean of the templates of its synonyms from `lvis_original_class_to_synonyms.pkl`, so synonyms of a class are never split
+across clusters. They are clustered by k-means into `--num-clusters` clusters (sqrt(num_classes) by default) and the
+assignments are saved for `class_clusters_file` in `params.json`.
+
+Usage, from the project root, with the checkpoints set in `params.json`:
+    python scripts/novel_object_detection/build_class_clusters.py --output class_clusters.pt
+"""
+import os
+import sys
+import argparse
+import math
+
+proj_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../"))
+sys.path.append(proj_path)
+
+import torch
+
+from main import build_model_registry, lvis_data_split
+from class_index import kmeans
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Clusters of the class embeddings for the coarse-to-fine classifier")
+    parser.add_argument("--output", type=str, required=True)
+    parser.add_argument("--num-clusters", type=int, default=0, help="sqrt(num_classes) by default")
+    parser.add_argument("--num-iters", type=int, default=50)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    _, _, text_features, class_names = build_model_registry(device)["clip"]
+    text_features = text_features.float().to("cpu")
+
+    num_clusters = args.num_clusters or int(round(math.sqrt(len(text_features))))
+    centroids, assignments = kmeans(text_features, num_clusters, args.num_iters, args.seed)
+    sizes = torch.bincount(assignments, minlength = num_clusters)
+
+    torch.save({
+        "data_split": lvis_data_split,
+        "class_names": list(class_names),
+        "assignments": assignments,
+        "centroids": centroids,
+    }, args.output)
+    print("Saved {} clusters of {} classes (sizes {} to {}) to {}".format(
+        num_clusters, len(text_features), int(sizes.min()), int(sizes.max()), args.output
+    ))
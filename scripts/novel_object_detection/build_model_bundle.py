@@ -0,0 +1,57 @@
+"""
+Writes the weights of the four models of `main.py` (GDINO, Mask R-CNN, SigLIP with the text features of the
+vocabulary of `lvis_data_split`, SAM) into a single memory-mapped bundle, see `scripts/model_bundle.py`.
+
+Usage, from the project root, with the checkpoints set in `params.json`:
+    python scripts/novel_object_detection/build_model_bundle.py --output path/to/models.bundle
+then set `"model_bundle": "path/to/models.bundle"` in `params.json`.
+"""
+import os
+import sys
+import json
+import argparse
+
+proj_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../"))
+sys.path.append(proj_path)
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+params_path = os.path.join(script_dir, "params.json")
+
+with open(params_path, "r") as f:
+    params = json.load(f)
+
+os.environ['DETECTRON2_DATASETS'] = params["detectron2_dir"]
+
+import torch
+
+from load_models import load_gdino_model, load_fully_supervised_trained_model, load_clip_model, load_sam_model
+from datasets.register_lvis_val_subset import lvis_meta_val_subset # to register the custom lvis_v1_val_subset dataset.
+from scripts.model_bundle import write_model_bundle, ModelBundle
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Bundle the weights of all models into one memory-mapped file")
+    parser.add_argument("--output", type=str, required=True)
+    args = parser.parse_args()
+
+    # the text features are computed with the full text tower, on GPU when available
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    lvis_data_split = params["lvis_data_split"]
+
+    model = load_gdino_model("cfg/GroundingDINO/GDINO.py", params["gdino_checkpoint"], device)
+    rcnn_model, cfg = load_fully_supervised_trained_model(params["cfg_file"], params["rcnn_weight_dir"])
+    clip_model, preprocess, text_features, lvis_classes = load_clip_model(lvis_data_split, device)
+    sam = load_sam_model(device, params["sam_checkpoint"])
+
+    write_model_bundle(
+        args.output,
+        models = {"gdino": model, "rcnn": rcnn_model, "clip": clip_model, "sam": sam},
+        tensors = {f"text_features.{lvis_data_split}": text_features},
+        metadata = {
+            name: params[name] for name in ("gdino_checkpoint", "cfg_file", "rcnn_weight_dir", "sam_checkpoint")
+        },
+    )
+
+    bundle = ModelBundle(args.output)
+    print("Wrote {} tensors ({:.2f} GB) to {}".format(
+        len(bundle.names()), os.path.getsize(args.output) / 2 ** 30, args.output
+    ))
@@ -0,0 +1,284 @@
+"""
+Top-k classification of image embeddings against large vocabularies.
+
+`classify_clip_features` scores every crop against every class in one dense (N, num_classes) matmul, which is fine for
+the 1203 LVIS classes but not for vocabularies of 20k+ classes (ImageNet-21k). Indexes of the class embeddings
+return the same (values, indices) as `classify_clip_features(..., k)`:
+- `ExactClassIndex` scores the classes by blocks of `block_size` and keeps a running top-k (`merge_topk`), so its memory
+  is bounded by N x block_size and its results are exact;
+- `IVFPQClassIndex` is approximate: the classes are clustered by k-means into inverted lists and their residuals to the
+  list centroid are product-quantized. A query only scans the lists of its `nprobe` closest centroids, with one lookup
+  table of inner products per PQ sub-space, and the `rerank` best candidates are re-scored with their exact embedding.
+- `HierarchicalClassIndex` classifies coarse-to-fine: a query is scored against the centroids of clusters of the class
+  embeddings (built offline by `build_class_clusters.py`, or on construction), then only against the members of its
+  `num_probe_clusters` best clusters. With about sqrt(num_classes) clusters, the cost per query grows as
+  sqrt(num_classes), and it is exact when the probed clusters cover the vocabulary.
+The scores are the SigLIP sigmoid of `classify_clip_features`, `sigmoid(similarity * logit_scale.exp() + logit_bias)`:
+the sigmoid is increasing, so the top-k of the similarities is that of the scores.
+
+`class_index_benchmark.py` measures their recall and latency against the dense scores.
+"""
+import math
+
+import torch
+
+from sharding import merge_topk
+
+
+def build_class_index(kind, text_features, clip_model, **kwargs):
+    """
+    Index `kind` ("exact", "ivfpq" or "hierarchical") of `text_features`, calibrated with the logit scale and bias of
+    `clip_model`.
+    """
+    index_classes = {"exact": ExactClassIndex, "ivfpq": IVFPQClassIndex, "hierarchical": HierarchicalClassIndex}
+    if kind not in index_classes:
+        raise ValueError("Unknown class index {}, available: {}".format(kind, list(index_classes)))
+    return index_classes[kind](
+        text_features, clip_model.logit_scale.exp().item(), clip_model.logit_bias.item(), **kwargs
+    )
+
+
+def kmeans(x, num_clusters, num_iters=20, seed=0):
+    """Lloyd's k-means of the rows of `x`; returns the (num_clusters, D) centroids and the (N,) assignments."""
+    generator = torch.Generator().manual_seed(seed)
+    centroids = x[torch.randperm(len(x), generator = generator)[:num_clusters]].clone()
+    for _ in range(num_iters):
+        assignments = nearest_centroids(x, centroids)
+        sums = torch.zeros_like(centroids).index_add_(0, assignments, x)
+        counts = torch.bincount(assignments, minlength = len(centroids)).to(x.dtype)
+        nonempty = counts > 0  # an empty cluster keeps its centroid
+        centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+    return centroids, nearest_centroids(x, centroids)
+
+
+def nearest_centroids(x, centroids, chunk_size=8192):
+    """Index of the closest (L2) centroid of every row of `x`, by chunks of rows."""
+    centroid_norms = (centroids ** 2).sum(dim = 1)
+    return torch.cat([
+        (centroid_norms[None, :] - 2 * x[start:start + chunk_size] @ centroids.T).argmin(dim = 1)
+        for start in range(0, len(x), chunk_size)
+    ])
+
+
+class ExactClassIndex:
+    kind = "exact"
+
+    def __init__(self, text_features, logit_scale, logit_bias, block_size=8192):
+        """
+        Args:
+            text_features (Tensor): (num_classes, D) normalized class embeddings
+            logit_scale (float): `clip_model.logit_scale.exp()`
+            logit_bias (float): `clip_model.logit_bias`
+        """
+        self.text_features = text_features.float()
+        self.logit_scale = logit_scale
+        self.logit_bias = logit_bias
+        self.block_size = block_size
+
+    def __len__(self):
+        return len(self.text_features)
+
+    def scores(self, similarities):
+        return torch.sigmoid(similarities * self.logit_scale + self.logit_bias)
+
+    @torch.no_grad()
+    def search(self, img_features, k=1):
+        """
+        Returns:
+            values (Tensor): (N, k) sigmoid scores, in descending order
+            indices (Tensor): (N, k) classes
+        """
+        img_features = img_features.float().to(self.text_features.device)
+        k = min(k, len(self))
+        values, indices = None, None
+        for start in range(0, len(self), self.block_size):
+            similarities = img_features @ self.text_features[start:start + self.block_size].T
+            block_values, block_indices = similarities.topk(min(k, similarities.shape[1]), dim = 1)
+            block_indices = block_indices + start
+            if values is not None:
+                block_values, block_indices, _ = merge_topk(
+                    torch.cat([values, block_values], dim = 1), torch.cat([indices, block_indices], dim = 1), k
+                )
+            values, indices = block_values, block_indices
+        return self.scores(values), indices
+
+
+class IVFPQClassIndex(ExactClassIndex):
+    kind = "ivfpq"
+
+    def __init__(
+        self,
+        text_features,
+        logit_scale,
+        logit_bias,
+        num_lists=None,
+        num_subspaces=16,
+        num_codes=256,
+        nprobe=8,
+        rerank=64,
+        num_iters=20,
+        seed=0,
+    ):
+        """
+        Args:
+            num_lists (int): number of inverted lists, sqrt(num_classes) by default
+            num_subspaces (int): PQ sub-spaces, a divisor of the embedding size D
+            num_codes (int): centroids per PQ sub-space
+            nprobe (int): inverted lists scanned per query
+            rerank (int): best PQ candidates re-scored with their exact embedding
+        """
+        super().__init__(text_features, logit_scale, logit_bias)
+        self.nprobe = nprobe
+        self.rerank = rerank
+
+        x = self.text_features.to("cpu")
+        num_classes, dim = x.shape
+        if dim % num_subspaces != 0:
+            raise ValueError("The embedding size {} is not divisible by {} sub-spaces".format(dim, num_subspaces))
+        num_lists = min(num_lists or max(1, int(round(math.sqrt(num_classes)))), num_classes)
+
+        self.centroids, self.assignments = kmeans(x, num_lists, num_iters, seed)
+        residuals = x - self.centroids[self.assignments]
+
+        sub_dim = dim // num_subspaces
+        codebooks = []
+        codes = []
+        for subspace in range(num_subspaces):
+            codebook, subspace_codes = kmeans(
+                residuals[:, subspace * sub_dim:(subspace + 1) * sub_dim], min(num_codes, num_classes), num_iters, seed
+            )
+            codebooks.append(codebook)
+            codes.append(subspace_codes)
+        self.codebooks = torch.stack(codebooks)  # (num_subspaces, num_codes, sub_dim)
+        self.codes = torch.stack(codes, dim = 1)  # (num_classes, num_subspaces)
+
+        # members of every inverted list, contiguous in `list_members`
+        self.list_members = self.assignments.argsort()
+        self.list_offsets = torch.cat([
+            torch.zeros(1, dtype = torch.int64), torch.bincount(self.assignments, minlength = num_lists).cumsum(0)
+        ]).tolist()
+
+        device = self.text_features.device
+        self.centroids = self.centroids.to(device)
+        self.codebooks = self.codebooks.to(device)
+        self.codes = self.codes.to(device)
+        self.assignments = self.assignments.to(device)
+        self.list_members = self.list_members.to(device)
+
+    @torch.no_grad()
+    def search(self, img_features, k=1):
+        img_features = img_features.float().to(self.text_features.device)
+        k = min(k, len(self))
+        num_subspaces, _, sub_dim = self.codebooks.shape
+
+        coarse = img_features @ self.centroids.T  # (N, num_lists)
+        probes = coarse.topk(min(self.nprobe, coarse.shape[1]), dim = 1).indices.tolist()
+        # inner products of every query sub-vector with every PQ centroid: (N, num_subspaces, num_codes)
+        lookup_tables = torch.einsum(
+            "nsd,scd->nsc", img_features.view(len(img_features), num_subspaces, sub_dim), self.codebooks
+        )
+        subspaces = torch.arange(num_subspaces, device = img_features.device)
+
+        values, indices = [], []
+        for query, (query_features, query_probes) in enumerate(zip(img_features, probes)):
+            candidates = torch.cat([
+                self.list_members[self.list_offsets[probe]:self.list_offsets[probe + 1]] for probe in query_probes
+            ])
+            if len(candidates) < k:  # too few classes in the probed lists
+                query_values, query_indices = ExactClassIndex.search(self, query_features[None], k)
+                values.append(query_values[0])
+                indices.append(query_indices[0])
+                continue
+            approximate = coarse[query, self.assignments[candidates]] + \
+                lookup_tables[query][subspaces[None, :], self.codes[candidates]].sum(dim = 1)
+            candidates = candidates[approximate.topk(min(max(k, self.rerank), len(candidates))).indices]
+            similarities = self.text_features[candidates] @ query_features
+            query_values, positions = similarities.topk(k)
+            values.append(self.scores(query_values))
+            indices.append(candidates[positions])
+        return torch.stack(values), torch.stack(indices)
+
+
+class HierarchicalClassIndex(ExactClassIndex):
+    kind = "hierarchical"
+
+    def __init__(
+        self,
+        text_features,
+        logit_scale,
+        logit_bias,
+        num_clusters=None,
+        num_probe_clusters=4,
+        assignments=None,
+        num_iters=20,
+        seed=0,
+    ):
+        """
+        Args:
+            num_clusters (int): clusters of classes, sqrt(num_classes) by default
+            num_probe_clusters (int): clusters whose members a query is scored against
+            assignments (Tensor): (num_classes,) cluster of every class, e.g. of `build_class_clusters.py`; k-means of
+                `text_features` by default
+        """
+        super().__init__(text_features, logit_scale, logit_bias)
+        self.num_probe_clusters = num_probe_clusters
+
+        x = self.text_features.to("cpu")
+        if assignments is None:
+            num_clusters = min(num_clusters or max(1, int(round(math.sqrt(len(x))))), len(x))
+            _, assignments = kmeans(x, num_clusters, num_iters, seed)
+        assignments = assignments.to("cpu", torch.int64)
+        num_clusters = int(assignments.max()) + 1
+
+        # the centroid of a cluster is the normalized mean of its members, to be scored like a class
+        sums = torch.zeros(num_clusters, x.shape[1]).index_add_(0, assignments, x)
+        self.centroids = torch.nn.functional.normalize(sums, dim = -1).to(self.text_features.device)
+        self.assignments = assignments
+        # (num_clusters, max_cluster_size) members of every cluster, padded with -1
+        sizes = torch.bincount(assignments, minlength = num_clusters)
+        order = assignments.argsort()
+        cluster_starts = torch.cat([torch.zeros(1, dtype = torch.int64), sizes.cumsum(0)[:-1]])
+        slots = torch.arange(len(x)) - cluster_starts[assignments[order]]
+        self.members = torch.full((num_clusters, int(sizes.max())), -1, dtype = torch.int64)
+        self.members[assignments[order], slots] = order
+
+    @classmethod
+    def load(cls, path, text_features, clip_model, num_probe_clusters=4):
+        """Index of `text_features` with the clusters saved by `build_class_clusters.py`."""
+        clusters = torch.load(path, map_location = "cpu")
+        if len(clusters["assignments"]) != len(text_features):
+            raise ValueError("{} clusters {} classes, the vocabulary has {}".format(
+                path, len(clusters["assignments"]), len(text_features)
+            ))
+        return cls(
+            text_features,
+            clip_model.logit_scale.exp().item(),
+            clip_model.logit_bias.item(),
+            num_probe_clusters = num_probe_clusters,
+            assignments = clusters["assignments"],
+        )
+
+    @torch.no_grad()
+    def search(self, img_features, k=1):
+        img_features = img_features.float().to(self.text_features.device)
+        num_clusters = len(self.centroids)
+        if self.num_probe_clusters >= num_clusters:  # every class is scored
+            return ExactClassIndex.search(self, img_features, k)
+        k = min(k, len(self))
+
+        probes = (img_features @ self.centroids.T).topk(self.num_probe_clusters, dim = 1).indices.to("cpu")
+        # top-k of every (query, probed cluster), merged per query; empty slots of small clusters stay at -inf
+        shape = (len(img_features), self.num_probe_clusters, k)
+        values = torch.full(shape, -float("inf"), device = img_features.device)
+        indices = torch.full(shape, -1, dtype = torch.int64, device = img_features.device)
+        for cluster in probes.unique().tolist():
+            queries, slots = (probes == cluster).nonzero(as_tuple = True)
+            members = self.members[cluster]
+            members = members[members >= 0].to(img_features.device)
+            similarities = img_features[queries.to(img_features.device)] @ self.text_features[members].T
+            cluster_values, positions = similarities.topk(min(k, len(members)), dim = 1)
+            values[queries, slots, :positions.shape[1]] = cluster_values
+            indices[queries, slots, :positions.shape[1]] = members[positions]
+
+        values, indices, _ = merge_topk(values.flatten(1), indices.flatten(1), k)
+        return self.scores(values), indices
@@ -0,0 +1,169 @@
+"""
+Recall and latency of the class-embedding indexes of `class_index.py` against the dense scores of
+`classify_clip_features`.
+
+The class embeddings are either loaded (`--text-features`, a tensor saved with `torch.save`, e.g. the SigLIP text
+features of an ImageNet-21k vocabulary) or synthetic: `--num-classes` normalized embeddings drawn around
+`--num-topics` random directions, as the text embeddings of related classes are. The queries stand for crops: noisy
+copies of random class embeddings. Reported, for the dense matmul, `ExactClassIndex`, `IVFPQClassIndex` at every
+`--nprobe` and `HierarchicalClassIndex` at every `--num-probe-clusters`: build time, latency per query batch (p50),
+recall@1 and recall@k of the dense top-k, and the largest score difference with the dense scores.
+
+Usage, from the project root (no model or GPU needed):
+    python scripts/novel_object_detection/class_index_benchmark.py --num-classes 21841 --nprobe 1 4 8 16
+"""
+import os
+import sys
+import json
+import argparse
+import time
+
+proj_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../"))
+sys.path.append(proj_path)
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from collections import OrderedDict
+
+from class_index import ExactClassIndex, IVFPQClassIndex, HierarchicalClassIndex
+
+
+def synthetic_embeddings(num_classes, num_topics, dim, spread, generator):
+    topics = torch.randn(num_topics, dim, generator = generator)
+    embeddings = topics[torch.randint(num_topics, (num_classes,), generator = generator)]
+    return F.normalize(embeddings + spread * torch.randn(num_classes, dim, generator = generator), dim = -1)
+
+
+def timed(search, queries, k, num_repeats):
+    """Results of `search(queries, k)` and its p50 latency in ms over `num_repeats` runs."""
+    latencies = []
+    for _ in range(num_repeats):
+        start = time.perf_counter()
+        values, indices = search(queries, k)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return values, indices, float(np.percentile(latencies, 50))
+
+
+def recall(indices, reference, k):
+    """Recall@1 of the top-1 and recall@k of the top-k of `reference`."""
+    recall_1 = (indices[:, 0] == reference[:, 0]).float().mean().item()
+    recall_k = np.mean([
+        len(set(row.tolist()) & set(ref_row.tolist())) / k for row, ref_row in zip(indices[:, :k], reference[:, :k])
+    ])
+    return recall_1, float(recall_k)
+
+
+def run_benchmark(args):
+    torch.set_num_threads(args.num_threads)
+    generator = torch.Generator().manual_seed(args.seed)
+    if args.text_features:
+        text_features = F.normalize(torch.load(args.text_features, map_location = "cpu").float(), dim = -1)
+    else:
+        text_features = synthetic_embeddings(args.num_classes, args.num_topics, args.dim, args.spread, generator)
+    targets = torch.randint(len(text_features), (args.num_queries,), generator = generator)
+    queries = F.normalize(
+        text_features[targets]
+        + args.query_noise * torch.randn(args.num_queries, text_features.shape[1], generator = generator),
+        dim = -1,
+    )
+
+    def dense(queries, k):
+        # `classify_clip_features`, in float32
+        scores = torch.sigmoid(queries @ text_features.T * args.logit_scale + args.logit_bias)
+        return scores.topk(k, dim = 1)
+
+    results = OrderedDict([
+        ("num_classes", len(text_features)),
+        ("dim", text_features.shape[1]),
+        ("num_queries", args.num_queries),
+        ("k", args.k),
+        ("methods", []),
+    ])
+    ref_values, ref_indices, latency = timed(dense, queries, args.k, args.num_repeats)
+    results["methods"].append(OrderedDict([("method", "dense"), ("build_s", 0.0), ("p50_ms", latency)]))
+
+    start = time.perf_counter()
+    exact = ExactClassIndex(text_features, args.logit_scale, args.logit_bias, block_size = args.block_size)
+    exact_build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    ivfpq = IVFPQClassIndex(
+        text_features, args.logit_scale, args.logit_bias, num_subspaces = args.num_subspaces, rerank = args.rerank
+    )
+    ivfpq_build_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    hierarchical = HierarchicalClassIndex(text_features, args.logit_scale, args.logit_bias)
+    hierarchical_build_time = time.perf_counter() - start
+
+    # the same index, probed more or less
+    runs = [("exact", exact, exact_build_time, {})]
+    runs += [("ivfpq_nprobe_{}".format(nprobe), ivfpq, ivfpq_build_time, {"nprobe": nprobe}) for nprobe in args.nprobe]
+    runs += [
+        (
+            "hierarchical_probe_{}".format(num_probes), hierarchical, hierarchical_build_time,
+            {"num_probe_clusters": num_probes},
+        )
+        for num_probes in args.num_probe_clusters
+    ]
+    for name, index, build_time, probe_settings in runs:
+        index.__dict__.update(probe_settings)
+        values, indices, latency = timed(index.search, queries, args.k, args.num_repeats)
+        recall_1, recall_k = recall(indices, ref_indices, args.k)
+        # the scores of the classes both return must be those of the dense formula
+        same_top1 = indices[:, 0] == ref_indices[:, 0]
+        score_error = float("nan")
+        if same_top1.any():
+            score_error = (values[:, 0] - ref_values[:, 0]).abs()[same_top1].max().item()
+        results["methods"].append(OrderedDict([
+            ("method", name),
+            ("build_s", build_time),
+            ("p50_ms", latency),
+            ("recall_at_1", recall_1),
+            ("recall_at_k", recall_k),
+            ("max_score_error", score_error),
+        ]))
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recall and latency of the class-embedding indexes")
+    parser.add_argument("--text-features", type=str, default="", help="torch.save'd (num_classes, D) class embeddings")
+    parser.add_argument("--num-classes", type=int, default=21841, help="synthetic classes (ImageNet-21k by default)")
+    parser.add_argument("--num-topics", type=int, default=500, help="directions the synthetic classes are drawn around")
+    parser.add_argument("--dim", type=int, default=1152, help="embedding size (SigLIP ViT-SO400M)")
+    parser.add_argument("--spread", type=float, default=0.7, help="spread of the synthetic classes around a topic")
+    parser.add_argument("--num-queries", type=int, default=256, help="crops per batch")
+    parser.add_argument("--query-noise", type=float, default=0.05)
+    parser.add_argument("--k", type=int, default=5)
+    parser.add_argument("--block-size", type=int, default=8192)
+    parser.add_argument("--num-subspaces", type=int, default=16)
+    parser.add_argument("--rerank", type=int, default=64)
+    parser.add_argument("--nprobe", type=int, nargs="+", default=[1, 4, 8, 16])
+    parser.add_argument("--num-probe-clusters", type=int, nargs="+", default=[1, 4, 16])
+    # only the scores depend on them: the SigLIP initialization, t' = log 10 and b = -10
+    parser.add_argument("--logit-scale", type=float, default=10.0, help="logit_scale.exp() of the model")
+    parser.add_argument("--logit-bias", type=float, default=-10.0)
+    parser.add_argument("--num-repeats", type=int, default=5)
+    parser.add_argument("--num-threads", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=str, default="", help="json file to save the results")
+    args = parser.parse_args()
+
+    results = run_benchmark(args)
+    print("{} classes of size {}, {} queries, k = {}".format(
+        results["num_classes"], results["dim"], results["num_queries"], results["k"]
+    ))
+    print("{:<20}{:>10}{:>10}{:>10}{:>10}{:>12}".format("method", "build_s", "p50_ms", "R@1", "R@k", "score_err"))
+    for row in results["methods"]:
+        print("{:<20}{:>10.2f}{:>10.2f}{:>10}{:>10}{:>12}".format(
+            row["method"], row["build_s"], row["p50_ms"],
+            *["{:.3f}".format(row[key]) if key in row else "-" for key in ("recall_at_1", "recall_at_k")],
+            "{:.1e}".format(row["max_score_error"]) if "max_score_error" in row else "-",
+        ))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=4)
@@ -11,15 +11,20 @@ import detectron2.data.transforms as T
 
 from tqdm import tqdm
 
+from detectron2.config import CfgNode
+from detectron2.data import MetadataCatalog
 from detectron2.utils.logger import log_every_n_seconds, create_small_table
 from detectron2.evaluation import DatasetEvaluator, LVISEvaluator
 from detectron2.evaluation.coco_evaluation import instances_to_coco_json
 from detectron2.utils.file_io import PathManager
-from lvis import LVISEval
 from collections import OrderedDict
 
 from ground_dino_utils import inference_gdino
+from nod_model import NOD
 from utils import read_image
+from lvis_eval_utils import LVISEvalCustom, VectorizedLVISEval
+from datasets.gt_index import CachedLVIS, load_lvis_api
+from scripts.label_space import LabelMap, remap_category_ids
 
 @torch.no_grad()
 def inference_single_image(model, image_path, text_prompt_list, param_dict, image_format = "BGR"):
@@ -46,7 +51,7 @@ def inference_single_image(model, image_path, text_prompt_list, param_dict, imag
 
     inputs.append(data_dict)
 
-    _ = inference_gdino(model, inputs, text_prompt_list, param_dict)
+    _ = inference_gdino(NOD(param_dict, model), inputs, text_prompt_list, param_dict)
 
 @torch.no_grad()
 def inference(data_loader, evaluator_discovery, model, text_prompt_list, param_dict):
@@ -66,12 +71,26 @@ def _run_generic_evaluation_loop(data_loader, evaluator, model, text_prompt_list
     total = len(data_loader)  # inference data loader must have a fixed length
     num_warmup = min(5, total - 1)
 
+    # detections of the images seen before, keyed by the bytes of the image file, see `result_cache.py`
+    result_cache = param_dict.get("result_cache")
+    # the stages of the pipeline, shared with the inference scripts and the server
+    nod_model = NOD(param_dict, model)
+
     start_time = time.perf_counter()
     for idx, inputs in enumerate(tqdm(data_loader)):
         if idx == num_warmup:
             start_time = time.perf_counter()
 
-        outputs = inference_gdino(model, inputs, text_prompt_list, param_dict)
+        outputs = None
+        if result_cache is not None:
+            cache_key = nod_model.result_cache_key(inputs[0]["file_name"], None, text_prompt_list)
+            instances = result_cache.get(cache_key)
+            if instances is not None:
+                outputs = [{"instances": instances}]
+        if outputs is None:
+            outputs = inference_gdino(nod_model, inputs, text_prompt_list, param_dict)
+            if result_cache is not None:
+                result_cache.put(cache_key, outputs[0]["instances"])
         if torch.cuda.is_available():
             torch.cuda.synchronize()
 
@@ -102,6 +121,13 @@ def _run_generic_evaluation_loop(data_loader, evaluator, model, text_prompt_list
         total_time_str, total_time / (total - num_warmup)
     ))
 
+    if result_cache is not None:
+        logger.info("Result cache: {}".format(dict(result_cache.stats())))
+
+    profiler = param_dict.get("profiler")
+    if profiler is not None and profiler.enabled:
+        logger.info("Per-stage latency (ms) and peak GPU memory (MB):\n" + profiler.format_summary())
+
 
 
 class NpEncoder(json.JSONEncoder):
@@ -124,12 +150,21 @@ class CustomEvaluator(DatasetEvaluator):
     cache the inputs/outputs inside the `process()`. Other evaluators may be supported as is, but it is not guaranteed.
     """
 
-    def __init__(self, evaluator):
+    def __init__(self, evaluator, online_evaluator=None, online_eval_period=0):
+        """
+        Args:
+            online_evaluator (OnlineLVISEval): if given, also fed with every image in `process()`
+            online_eval_period (int): log its approximate results every `online_eval_period` images (0: never)
+        """
         self.evaluator = evaluator
+        self.online_evaluator = online_evaluator
+        self.online_eval_period = online_eval_period
 
         self._debug_dumped = 0
 
     def reset(self):
+        if self.online_evaluator is not None:
+            self.online_evaluator.reset()
         return self.evaluator.reset()
 
     def process(self, inputs, outputs):
@@ -141,13 +176,40 @@ class CustomEvaluator(DatasetEvaluator):
 
             self.evaluator._predictions.append(prediction)
 
+            if self.online_evaluator is not None:
+                num_images = self.online_evaluator.num_images
+                self.online_evaluator.process(input["image_id"], prediction["instances"])
+                # images that are not in the GT are skipped by the online evaluator and must not log again
+                added = self.online_evaluator.num_images > num_images
+                num_images = self.online_evaluator.num_images
+                if added and self.online_eval_period > 0 and num_images % self.online_eval_period == 0:
+                    self.log_online_results()
+
+    def log_online_results(self):
+        """Log the approximate AP of the images processed so far, for all classes and for each class subset."""
+        online_evaluator = self.online_evaluator
+        online_evaluator.accumulate()
+        results = online_evaluator.summarize()
+
+        table = OrderedDict((metric, results[metric] * 100) for metric in ["AP", "AP50", "AP75", "APr", "APc", "APf"])
+        for name, subset_results in online_evaluator.results_subsets.items():
+            for metric in ["AP", "APr"]:
+                table["{} {}".format(name, metric)] = subset_results[metric] * 100
+
+        logger = logging.getLogger(__name__)
+        logger.info(
+            "Online estimate after {} images: \n".format(online_evaluator.num_images) + create_small_table(table)
+        )
+
     def evaluate(self):
         return self.evaluator.evaluate()
 
 
 class LVISEvaluatorCustom(LVISEvaluator):
     """
-    Modifies the default LVISEvaluator by supporting printing evaluation results for a subset of classes only.
+    Modifies the default LVISEvaluator by supporting printing evaluation results for named subsets of classes.
+    Categories are evaluated in a process pool when `num_workers > 1`. Box ground truth is loaded from the binary
+    ground-truth index of `datasets.gt_index` when `use_gt_index` is True, the json is only parsed for mask evaluation.
     """
 
     def __init__(
@@ -158,10 +220,42 @@ class LVISEvaluatorCustom(LVISEvaluator):
             output_dir=None,
             *,
             max_dets_per_image=None,
-            known_class_ids=None
+            class_subsets=None,
+            num_workers=0,
+            use_gt_index=True
     ):
-        super().__init__(dataset_name, tasks, distributed, output_dir, max_dets_per_image=max_dets_per_image)
-        self.known_class_ids = known_class_ids
+        """
+        Same as `LVISEvaluator.__init__`, re-copied to build `self._lvis_api` with `load_lvis_api()` instead of
+        parsing the json file.
+        """
+        self._logger = logging.getLogger(__name__)
+
+        if tasks is not None and isinstance(tasks, CfgNode):
+            self._logger.warn(
+                "COCO Evaluator instantiated using config, this is deprecated behavior."
+                " Please pass in explicit arguments instead."
+            )
+            self._tasks = None  # Infering it from predictions should be better
+        else:
+            self._tasks = tasks
+
+        self._distributed = distributed
+        self._output_dir = output_dir
+        self._max_dets_per_image = max_dets_per_image
+
+        self._cpu_device = torch.device("cpu")
+
+        self._metadata = MetadataCatalog.get(dataset_name)
+        self._json_file = PathManager.get_local_path(self._metadata.json_file)
+        self._lvis_api = load_lvis_api(
+            self._json_file, use_gt_index=use_gt_index and "segm" not in (self._tasks or ())
+        )
+        # Test set json files do not contain annotations (evaluation must be
+        # performed using the LVIS evaluation server).
+        self._do_evaluation = len(self._lvis_api.get_ann_ids()) > 0
+
+        self.class_subsets = class_subsets
+        self.num_workers = num_workers
 
     def _eval_predictions(self, predictions):
         """
@@ -176,11 +270,8 @@ class LVISEvaluatorCustom(LVISEvaluator):
         # LVIS evaluator can be used to evaluate results for COCO dataset categories.
         # In this case `_metadata` variable will have a field with COCO-specific category mapping.
         if hasattr(self._metadata, "thing_dataset_id_to_contiguous_id"):
-            reverse_id_mapping = {
-                v: k for k, v in self._metadata.thing_dataset_id_to_contiguous_id.items()
-            }
-            for result in lvis_results:
-                result["category_id"] = reverse_id_mapping[result["category_id"]]
+            reverse_id_mapping = LabelMap(self._metadata.thing_dataset_id_to_contiguous_id).inverse()
+            remap_category_ids(lvis_results, reverse_id_mapping)
         else:
             # unmap the category ids for LVIS (from 0-indexed to 1-indexed)
             for result in lvis_results:
@@ -197,6 +288,11 @@ class LVISEvaluatorCustom(LVISEvaluator):
             self._logger.info("Annotations are not available for evaluation.")
             return
 
+        if "segm" in tasks and isinstance(self._lvis_api, CachedLVIS):
+            from lvis import LVIS
+            self._logger.info("[Evaluator new] Loading {} for mask evaluation ...".format(self._json_file))
+            self._lvis_api = LVIS(self._json_file)
+
         self._logger.info("[Evaluator new] Evaluating predictions ...")
         for task in sorted(tasks):
             res = _evaluate_predictions_on_lvis(
@@ -206,17 +302,22 @@ class LVISEvaluatorCustom(LVISEvaluator):
                 task,
                 max_dets_per_image=self._max_dets_per_image,
                 class_names=self._metadata.get("thing_classes"),
-                known_class_ids=self.known_class_ids,
+                class_subsets=self.class_subsets,
+                num_workers=self.num_workers,
             )
             self._results[task] = res
 
 
 def _evaluate_predictions_on_lvis(
-        logger, lvis_gt, lvis_results, iou_type, max_dets_per_image=None, class_names=None, known_class_ids=None
+        logger, lvis_gt, lvis_results, iou_type, max_dets_per_image=None, class_names=None, class_subsets=None,
+        num_workers=0,
 ):
     """
-    Same as the original implementation, except that extra evaluation on only known or only novel classes is performed
-    if `known_class_ids` is provided. For that replaces object of `LVISEval` with `LVISEvalCustom`.
+    Same as the original implementation, except that extra evaluation on named subsets of classes (e.g. only known or
+    only novel classes) is performed if `class_subsets` is provided. For that replaces object of `LVISEval` with
+    `LVISEvalCustom`.
+    Both are backed by the vectorized `VectorizedLVISEval` engine, which evaluates the categories in a process pool
+    of `num_workers` workers when `num_workers > 1`.
     """
 
     metrics = {
@@ -240,14 +341,14 @@ def _evaluate_predictions_on_lvis(
     if max_dets_per_image is None:
         max_dets_per_image = 300  # Default for LVIS dataset
 
-    from lvis import LVISEval, LVISResults
+    from lvis import LVISResults
 
     logger.info(f"[Evaluator new] Evaluating with max detections per image = {max_dets_per_image}")
     lvis_results = LVISResults(lvis_gt, lvis_results, max_dets=max_dets_per_image)
-    if known_class_ids is not None:
-        lvis_eval = LVISEvalCustom(lvis_gt, lvis_results, iou_type, known_class_ids)
+    if class_subsets is not None:
+        lvis_eval = LVISEvalCustom(lvis_gt, lvis_results, iou_type, class_subsets, num_workers=num_workers)
     else:
-        lvis_eval = LVISEval(lvis_gt, lvis_results, iou_type)
+        lvis_eval = VectorizedLVISEval(lvis_gt, lvis_results, iou_type, num_workers=num_workers)
     lvis_eval.run()
     lvis_eval.print_results()
 
@@ -256,106 +357,12 @@ def _evaluate_predictions_on_lvis(
     results = {metric: float(results[metric] * 100) for metric in metrics}
     logger.info("[Evaluator new] Evaluation results for {}: \n".format(iou_type) + create_small_table(results))
 
-    if known_class_ids is not None:  # Print results for known and novel classes separately
-        for results, subtitle in [
-            (lvis_eval.results_known, "known classes only"),
-            (lvis_eval.results_novel, "novel classes only"),
-        ]:
-            results = {metric: float(results[metric] * 100) for metric in metrics}
-            logger.info("Evaluation results for {} ({}): \n".format(iou_type, subtitle) + create_small_table(results))
+    if class_subsets is not None:  # Print results for each subset of classes separately
+        for name, subset_results in lvis_eval.results_subsets.items():
+            subset_results = {metric: float(subset_results[metric] * 100) for metric in metrics}
+            logger.info(
+                "Evaluation results for {} ({} classes only): \n".format(iou_type, name)
+                + create_small_table(subset_results)
+            )
 
     return results
-
-
-class LVISEvalCustom(LVISEval):
-    """
-    Extends `LVISEval` with printing results for known and novel classes only when `known_class_ids` is provided.
-    """
-
-    def __init__(self, lvis_gt, lvis_dt, iou_type="segm", known_class_ids=None):
-        super().__init__(lvis_gt, lvis_dt, iou_type)
-
-        # Remap categories list following the mapping applied to train data, - that is list all categories in a
-        # consecutive order and use their indices; see: `lvis-api/lvis/eval.py` line 109:
-        # https://github.com/lvis-dataset/lvis-api/blob/35f09cd7c5f313a9bf27b329ca80effe2b0c8a93/lvis/eval.py#L109
-        if known_class_ids is None:
-            self.known_class_ids = None
-        else:
-            self.known_class_ids = [self.params.cat_ids.index(c) for c in known_class_ids]
-
-    def _summarize(
-            self, summary_type, iou_thr=None, area_rng="all", freq_group_idx=None, subset_class_ids=None
-    ):
-        """Extends the default version by supporting calculating the results only for the subset of classes."""
-
-        if subset_class_ids is None:  # Use all classes
-            subset_class_ids = list(range(len(self.params.cat_ids)))
-
-        aidx = [
-            idx
-            for idx, _area_rng in enumerate(self.params.area_rng_lbl)
-            if _area_rng == area_rng
-        ]
-
-        if summary_type == 'ap':
-            s = self.eval["precision"]
-            if iou_thr is not None:
-                tidx = np.where(iou_thr == self.params.iou_thrs)[0]
-                s = s[tidx]
-            if freq_group_idx is not None:
-                subset_class_ids = list(set(subset_class_ids).intersection(self.freq_groups[freq_group_idx]))
-                s = s[:, :, subset_class_ids, aidx]
-            else:
-                s = s[:, :, subset_class_ids, aidx]
-        else:
-            s = self.eval["recall"]
-            if iou_thr is not None:
-                tidx = np.where(iou_thr == self.params.iou_thrs)[0]
-                s = s[tidx]
-            s = s[:, subset_class_ids, aidx]
-
-        if len(s[s > -1]) == 0:
-            mean_s = -1
-        else:
-            mean_s = np.mean(s[s > -1])
-        return mean_s
-
-    def summarize(self):
-        """Extends the default version by supporting calculating the results only for the subset of classes."""
-
-        if not self.eval:
-            raise RuntimeError("Please run accumulate() first.")
-
-        if self.known_class_ids is None:
-            eval_groups = [(self.results, None)]
-        else:
-            cat_ids_mapped_list = list(range(len(self.params.cat_ids)))
-            novel_class_ids = list(set(cat_ids_mapped_list).difference(self.known_class_ids))
-            self.results_known = OrderedDict()
-            self.results_novel = OrderedDict()
-            eval_groups = [
-                (self.results, None),
-                (self.results_known, self.known_class_ids),
-                (self.results_novel, novel_class_ids),
-            ]
-
-        max_dets = self.params.max_dets
-
-        for container, subset_class_ids in eval_groups:
-            container["AP"]   = self._summarize('ap', subset_class_ids=subset_class_ids)
-            container["AP50"] = self._summarize('ap', iou_thr=0.50, subset_class_ids=subset_class_ids)
-            container["AP75"] = self._summarize('ap', iou_thr=0.75, subset_class_ids=subset_class_ids)
-            container["APs"]  = self._summarize('ap', area_rng="small", subset_class_ids=subset_class_ids)
-            container["APm"]  = self._summarize('ap', area_rng="medium", subset_class_ids=subset_class_ids)
-            container["APl"]  = self._summarize('ap', area_rng="large", subset_class_ids=subset_class_ids)
-            container["APr"]  = self._summarize('ap', freq_group_idx=0, subset_class_ids=subset_class_ids)
-            container["APc"]  = self._summarize('ap', freq_group_idx=1, subset_class_ids=subset_class_ids)
-            container["APf"]  = self._summarize('ap', freq_group_idx=2, subset_class_ids=subset_class_ids)
-
-            key = "AR@{}".format(max_dets)
-            container[key] = self._summarize('ar', subset_class_ids=subset_class_ids)
-
-            for area_rng in ["small", "medium", "large"]:
-                key = "AR{}@{}".format(area_rng[0], max_dets)
-                container[key] = self._summarize('ar', area_rng=area_rng, subset_class_ids=subset_class_ids)
-
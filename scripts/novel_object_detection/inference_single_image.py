@@ -28,8 +28,7 @@ os.environ['DETECTRON2_DATASETS'] = detectron2_dir
 import torch
 import detectron2.data.transforms as T
 
-from groundingdino.util.inference import load_model
-from load_models import load_fully_supervised_trained_model, load_clip_model, load_sam_model
+from load_models import load_gdino_model, load_fully_supervised_trained_model, load_clip_model, load_sam_model
 from utils import get_text_prompt_list_for_g_dino, get_coco_to_lvis_mapping
 from evaluation import CustomEvaluator, LVISEvaluatorCustom, inference_single_image
 
@@ -41,6 +40,12 @@ from segment_anything.utils.transforms import ResizeLongestSide
 from tqdm import tqdm
 
 from nod_model import NOD
+from class_index import build_class_index
+from video_stream import read_video_frames
+from main import build_result_cache
+from profiling import StageProfiler
+
+VIDEO_SUFFIXES = {".mp4", ".avi", ".mov", ".mkv", ".webm"}
 
 warnings.filterwarnings('ignore', category=UserWarning)
 warnings.filterwarnings('ignore', category=FutureWarning)
@@ -53,7 +58,7 @@ def setup(outputs_dir, gdino_checkpoint, cfg_file, rcnn_weight_dir, sam_checkpoi
     lvis_data_split = "lvis_v1_val"
 
 
-    model = load_model("cfg/GroundingDINO/GDINO.py", gdino_checkpoint)
+    model = load_gdino_model("cfg/GroundingDINO/GDINO.py", gdino_checkpoint, device)
     model = model.to(device)
 
     rcnn_model, cfg = load_fully_supervised_trained_model(cfg_file, rcnn_weight_dir)
@@ -65,12 +70,6 @@ def setup(outputs_dir, gdino_checkpoint, cfg_file, rcnn_weight_dir, sam_checkpoi
     sam = load_sam_model(device, sam_checkpoint)
     resize_transform = ResizeLongestSide(sam.image_encoder.img_size)
 
-    known_class_ids=[3, 12, 34, 35, 36, 41, 45, 58, 60, 76, 77, 80, 90, 94, 99, 118, 127, 133, 139, 154, 169, 173, 183,
-                            207, 217, 225, 230, 232, 271, 296, 344, 367, 378, 387, 421, 422, 445, 469, 474, 496, 534, 569,
-                            611, 615, 631, 687, 703, 705, 716, 735, 739, 766, 793, 816, 837, 881, 912, 923, 943, 961, 962,
-                            964, 976, 982, 1000, 1019, 1037, 1071, 1077, 1079, 1095, 1097, 1102, 1112, 1115, 1123, 1133,
-                            1139, 1190, 1202]
-
     tokenizer = model.tokenizer
 
     text_prompt_list, positive_map_list = get_text_prompt_list_for_g_dino(lvis_data_split, tokenizer, class_len_per_prompt)
@@ -98,29 +97,106 @@ def setup(outputs_dir, gdino_checkpoint, cfg_file, rcnn_weight_dir, sam_checkpoi
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Inference on a single image")
     parser.add_argument("--image_path", type=str, help="Path to the image", required=True, default=None)
+    parser.add_argument("--profile", action="store_true", help="Report the latency and memory of every stage")
+    parser.add_argument(
+        "--classes", type=str, nargs="+", default=None,
+        help="Custom vocabulary, e.g. --classes 'license plate' 'traffic cone'; the LVIS classes by default",
+    )
+    parser.add_argument("--classes-file", type=str, default=None, help="Custom vocabulary, one class per line")
+    parser.add_argument(
+        "--class-index", type=str, default=None, choices=["exact", "ivfpq", "hierarchical"],
+        help="Classify the crops with an index of the class embeddings of --classes, for very large vocabularies",
+    )
+    parser.add_argument(
+        "--vocabulary-store", type=str, default=None,
+        help="Vocabulary store edited with manage_vocabulary.py; --classes are added to it and saved",
+    )
+    parser.add_argument(
+        "--vocabulary-shards", type=int, default=1,
+        help="Run the GDINO prompts and the CLIP classification of an image as this many parallel shards",
+    )
+    parser.add_argument(
+        "--keyframe-interval", type=int, default=30,
+        help="For a video, run the whole vocabulary on one frame in this many, the classes it found on the others",
+    )
+    parser.add_argument(
+        "--unordered", action="store_true",
+        help="For several images, process them as soon as they are decoded instead of in order",
+    )
+    parser.add_argument(
+        "--result-cache", type=str, default=None,
+        help="Directory of a disk cache of the detections, so that images seen before are not processed again",
+    )
+    parser.add_argument(
+        "--tile-size", type=int, default=0,
+        help="Run images larger than this as overlapping tiles of this size, e.g. 1333 for 4K images (0: no tiling)",
+    )
+    parser.add_argument("--tile-overlap", type=int, default=256, help="Overlap of the tiles in pixels")
+    parser.add_argument("--tile-batch-size", type=int, default=4, help="Tiles run together, which bounds the memory")
     args = parser.parse_args()
     image_path = Path(args.image_path)
 
     model, text_prompt_list, param_dict = setup(outputs_dir, gdino_checkpoint, cfg_file, rcnn_weight_dir, sam_checkpoint, class_len_per_prompt)
 
-    text_prompt_list=["license plate ."]
+    param_dict["profiler"] = StageProfiler(enabled = args.profile)
+    param_dict["vocabulary_shards"] = args.vocabulary_shards
+    param_dict["result_cache"] = build_result_cache(params, args.result_cache) if args.result_cache else None
+    param_dict["tile_size"] = args.tile_size
+    param_dict["tile_overlap"] = args.tile_overlap
+    param_dict["tile_batch_size"] = args.tile_batch_size
+
     confidence_threshold = 0.2
 
     nod_modle = NOD(param_dict, model)
+    if args.classes_file:
+        with open(args.classes_file, "r") as f:
+            args.classes = [line.strip() for line in f if line.strip()]
+    if args.vocabulary_store:
+        store = nod_modle.open_vocabulary_store(args.vocabulary_store)
+        new_classes = [class_name for class_name in args.classes or [] if class_name not in store]
+        if new_classes:
+            store.add(new_classes)
+            store.save()
+        vocabulary = store.vocabulary()
+        if args.class_index:
+            vocabulary.class_index = build_class_index(args.class_index, vocabulary.text_features, nod_modle.clip_model)
+    else:
+        vocabulary = nod_modle.build_vocabulary(args.classes, class_index=args.class_index) if args.classes else None
 
     start_time = time.perf_counter()
-    if image_path.is_dir():
-        output = nod_modle.infer_multiple_images(
-            image_path,
+    if image_path.suffix.lower() in VIDEO_SUFFIXES:
+        stream = nod_modle.video_stream(
+            text_prompt_list, vocabulary = vocabulary, keyframe_interval = args.keyframe_interval
+        )
+        for frame in read_video_frames(image_path):
+            output = stream.process(
+                frame, visualize = True, out_dir = outputs_dir, confidence_threshold = confidence_threshold
+            )
+        print(f"{stream.num_frames} frames: {stream.stats}")
+    elif image_path.is_dir() or image_path.suffix.lower() == ".txt" or any(char in args.image_path for char in "*?["):
+        # a directory, a manifest file or a glob pattern: the next images are decoded while the current one runs
+        outputs = nod_modle.infer_multiple_images(
+            args.image_path,
             out_dir=outputs_dir,
             text_prompt_list=text_prompt_list,
             confidence_threshold=confidence_threshold,
+            vocabulary=vocabulary,
+            ordered=not args.unordered,
         )
+        for path, instances in outputs:
+            print(f"{path}: {len(instances)} detections")
     else:
         output = nod_modle.infer(
             str(image_path),
             out_dir=outputs_dir,
             text_prompt_list=text_prompt_list,
             confidence_threshold=confidence_threshold,
+            vocabulary=vocabulary,
         )
     print(f"elpased time : {time.perf_counter() - start_time}")
+    if param_dict["result_cache"] is not None:
+        print(f"result cache: {dict(param_dict['result_cache'].stats())}")
+
+    if args.profile:
+        print(param_dict["profiler"].format_summary())
+        param_dict["profiler"].export(outputs_dir)
@@ -0,0 +1,199 @@
+"""
+Client of `server.py`, and a load generator that sends it concurrent requests.
+
+`NODClient` keeps one HTTP/1.1 connection (TCP or Unix socket) open across requests. The load generator runs
+`--concurrency` clients in threads, each sending the images of `--images` (a file or a directory) in a loop until
+`--num-requests` are done, and reports the client-side latency percentiles, the throughput and the batch sizes the
+server formed.
+
+Usage, from the project root, with a server running:
+    python scripts/novel_object_detection/load_generator.py --images path/to/images --concurrency 8
+    python scripts/novel_object_detection/load_generator.py --unix-socket /tmp/nod.sock --images image.jpg
+"""
+import os
+import sys
+import json
+import argparse
+import http.client
+import socket
+import threading
+import time
+
+from collections import OrderedDict
+from pathlib import Path
+from urllib.parse import urlencode
+
+import numpy as np
+
+IMAGE_SUFFIXES = (".jpg", ".jpeg", ".png", ".bmp", ".webp")
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+class NODClient:
+    """Not thread-safe: use one client per thread."""
+
+    def __init__(self, host="127.0.0.1", port=8000, unix_socket="", timeout=600):
+        if unix_socket:
+            self._connection = UnixHTTPConnection(unix_socket, timeout=timeout)
+        else:
+            self._connection = http.client.HTTPConnection(host, port, timeout=timeout)
+
+    def detect(self, image_bytes, prompts=None, score_threshold=None, name=None, classes=None):
+        """
+        Args:
+            image_bytes (bytes): encoded image
+            prompts (list[str]): GDINO prompts, e.g. ["license plate ."]; the server's vocabulary by default
+            classes (list[str]): vocabulary of the request, e.g. ["license plate", "traffic cone"], instead of prompts
+        Returns:
+            dict: the JSON response of the server, see `server.py`
+        """
+        query = [("prompt", prompt) for prompt in prompts or []]
+        query += [("class", class_name) for class_name in classes or []]
+        if score_threshold is not None:
+            query.append(("score_threshold", score_threshold))
+        if name is not None:
+            query.append(("name", name))
+        path = "/detect" + ("?" + urlencode(query) if query else "")
+        return self._request("POST", path, image_bytes)
+
+    def stats(self):
+        return self._request("GET", "/stats")
+
+    def close(self):
+        self._connection.close()
+
+    def _request(self, method, path, body=None):
+        headers = {"Content-Type": "application/octet-stream"} if body is not None else {}
+        self._connection.request(method, path, body=body, headers=headers)
+        response = self._connection.getresponse()
+        content = json.loads(response.read().decode("utf-8"))
+        if response.status != 200:
+            raise RuntimeError("{} {} failed with {}: {}".format(method, path, response.status, content.get("error")))
+        return content
+
+
+def list_images(path):
+    path = Path(path)
+    if path.is_dir():
+        return sorted(str(f) for f in path.iterdir() if f.suffix.lower() in IMAGE_SUFFIXES)
+    return [str(path)]
+
+
+def run_load(args, images):
+    """Sends `args.num_requests` requests from `args.concurrency` threads; returns the per-request records."""
+    records = []
+    errors = []
+    lock = threading.Lock()
+    counter = iter(range(args.num_requests))
+
+    def worker():
+        client = NODClient(args.host, args.port, args.unix_socket)
+        try:
+            while True:
+                with lock:
+                    idx = next(counter, None)
+                if idx is None:
+                    return
+                name, image_bytes = images[idx % len(images)]
+                start = time.perf_counter()
+                try:
+                    response = client.detect(
+                        image_bytes, args.prompt, args.score_threshold, name = name, classes = args.class_names
+                    )
+                except Exception as e:
+                    with lock:
+                        errors.append(str(e))
+                    continue
+                record = {
+                    "latency_ms": (time.perf_counter() - start) * 1000,
+                    "queue_ms": response["queue_ms"],
+                    "inference_ms": response["inference_ms"],
+                    "batch_size": response["batch_size"],
+                    "num_detections": len(response["detections"]),
+                }
+                with lock:
+                    records.append(record)
+        finally:
+            client.close()
+
+    threads = [threading.Thread(target=worker) for _ in range(args.concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return records, errors
+
+
+def summarize(records, errors, wall_time):
+    latencies = np.asarray([record["latency_ms"] for record in records])
+    summary = OrderedDict([
+        ("num_requests", len(records)),
+        ("num_errors", len(errors)),
+        ("throughput_req_s", len(records) / wall_time),
+    ])
+    if len(records) > 0:
+        summary.update([
+            ("latency_p50_ms", float(np.percentile(latencies, 50))),
+            ("latency_p95_ms", float(np.percentile(latencies, 95))),
+            ("latency_p99_ms", float(np.percentile(latencies, 99))),
+            ("mean_queue_ms", float(np.mean([record["queue_ms"] for record in records]))),
+            ("mean_inference_ms", float(np.mean([record["inference_ms"] for record in records]))),
+            # client-side overhead: everything but the queue and the pipeline (HTTP, decoding, JSON)
+            ("mean_overhead_ms", float(np.mean([
+                record["latency_ms"] - record["queue_ms"] - record["inference_ms"] for record in records
+            ]))),
+            ("mean_batch_size", float(np.mean([record["batch_size"] for record in records]))),
+        ])
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Concurrent requests to the NOD inference server")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--unix-socket", type=str, default="")
+    parser.add_argument("--images", type=str, required=True, help="an image or a directory of images")
+    parser.add_argument("--num-requests", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=4, help="number of clients sending requests at once")
+    parser.add_argument("--prompt", type=str, action="append", default=None, help="GDINO prompt, can be repeated")
+    parser.add_argument(
+        "--class", dest="class_names", type=str, action="append", default=None, help="vocabulary class, can be repeated"
+    )
+    parser.add_argument("--score-threshold", type=float, default=None)
+    parser.add_argument("--output", type=str, default="", help="json file to save the summary")
+    args = parser.parse_args()
+
+    images = []
+    for image_file in list_images(args.images):
+        with open(image_file, "rb") as f:
+            images.append((os.path.basename(image_file), f.read()))
+    if len(images) == 0:
+        print("No image found in {}".format(args.images))
+        sys.exit(1)
+
+    start = time.perf_counter()
+    records, errors = run_load(args, images)
+    summary = summarize(records, errors, time.perf_counter() - start)
+
+    client = NODClient(args.host, args.port, args.unix_socket)
+    summary["server"] = client.stats()
+    client.close()
+
+    print(json.dumps(summary, indent=4))
+    for error in errors[:5]:
+        print("Error: {}".format(error))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(summary, f, indent=4)
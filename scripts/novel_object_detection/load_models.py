@@ -1,6 +1,7 @@
 import open_clip
 import torch
 import pickle
+from functools import partial
 
 from detectron2.data import MetadataCatalog
 
@@ -8,109 +9,174 @@ from detectron2.config import LazyConfig, instantiate
 from detectron2.engine import default_setup
 from detectron2.checkpoint import DetectionCheckpointer
 from segment_anything import sam_model_registry
+from segment_anything.build_sam import _build_sam
+from groundingdino.models import build_model
+from groundingdino.util.slconfig import SLConfig
+from groundingdino.util.utils import clean_state_dict
 from utils import article, processed_name
-
-def load_fully_supervised_trained_model(cfg_file, weight_dir):
-    # Load the model weights of supevised training phase
-    opts = [f'train.output_dir={weight_dir}', f'train.init_checkpoint={weight_dir}/model_final.pth']
+from scripts.model_bundle import skip_init
+
+# Small SAM used with random weights by `benchmark.py`; the prompt encoder and mask decoder are the same as for "vit_h"
+sam_model_registry = dict(
+    sam_model_registry,
+    tiny=partial(
+        _build_sam, encoder_embed_dim=64, encoder_depth=2, encoder_num_heads=2, encoder_global_attn_indexes=[1]
+    ),
+)
+
+CLIP_TEMPLATES = [
+    "There is {article} {} in the scene.",
+    "There is the {} in the scene.",
+    "a photo of {article} {} in the scene.",
+    "a photo of the {} in the scene.",
+    "a photo of one {} in the scene.",
+    "itap of {article} {}.",
+    "itap of my {}.",
+    "itap of the {}.",
+    "a photo of {article} {}.",
+    "a photo of my {}.",
+    "a photo of the {}.",
+    "a photo of one {}.",
+    "a photo of many {}.",
+    "a good photo of {article} {}.",
+    "a good photo of the {}.",
+    "a bad photo of {article} {}.",
+    "a bad photo of the {}.",
+    "a photo of a nice {}.",
+    "a photo of the nice {}.",
+    "a photo of a cool {}.",
+    "a photo of the cool {}.",
+    "a photo of a weird {}.",
+    "a photo of the weird {}.",
+    "a photo of a small {}.",
+    "a photo of the small {}.",
+    "a photo of a large {}.",
+    "a photo of the large {}.",
+    "a photo of a clean {}.",
+    "a photo of the clean {}.",
+    "a photo of a dirty {}.",
+    "a photo of the dirty {}.",
+    "a bright photo of {article} {}.",
+    "a bright photo of the {}.",
+    "a dark photo of {article} {}.",
+    "a dark photo of the {}.",
+    "a photo of a hard to see {}.",
+    "a photo of the hard to see {}.",
+    "a low resolution photo of {article} {}.",
+    "a low resolution photo of the {}.",
+    "a cropped photo of {article} {}.",
+    "a cropped photo of the {}.",
+    "a close-up photo of {article} {}.",
+    "a close-up photo of the {}.",
+    "a jpeg corrupted photo of {article} {}.",
+    "a jpeg corrupted photo of the {}.",
+    "a blurry photo of {article} {}.",
+    "a blurry photo of the {}.",
+    "a pixelated photo of {article} {}.",
+    "a pixelated photo of the {}.",
+    "a black and white photo of the {}.",
+    "a black and white photo of {article} {}.",
+    "a plastic {}.",
+    "the plastic {}.",
+    "a toy {}.",
+    "the toy {}.",
+    "a plushie {}.",
+    "the plushie {}.",
+    "a cartoon {}.",
+    "the cartoon {}.",
+    "an embroidered {}.",
+    "the embroidered {}.",
+    "a painting of the {}.",
+    "a painting of a {}."
+]
+
+def load_gdino_model(cfg_file, gdino_checkpoint, device, bundle=None):
+    # Same as `groundingdino.util.inference.load_model`, without `gdino_checkpoint` the weights are random.
+    # With a `ModelBundle` (see `scripts/model_bundle.py`), the weights are views of the bundle instead
+    args = SLConfig.fromfile(cfg_file)
+    args.device = device
+    with skip_init(bundle is not None):
+        model = build_model(args)
+    if bundle is not None:
+        bundle.assign(model, "gdino")
+    elif gdino_checkpoint:
+        checkpoint = torch.load(gdino_checkpoint, map_location="cpu")
+        model.load_state_dict(clean_state_dict(checkpoint["model"]), strict=False)
+    model.eval()
+    return model
+
+def load_fully_supervised_trained_model(cfg_file, weight_dir, bundle=None):
+    # Load the model weights of supevised training phase, without `weight_dir` the weights are random
+    if weight_dir:
+        opts = [f'train.output_dir={weight_dir}', f'train.init_checkpoint={weight_dir}/model_final.pth']
+    else:
+        opts = []
 
     cfg = LazyConfig.load(cfg_file)
     cfg = LazyConfig.apply_overrides(cfg, opts)
     default_setup(cfg, None)
 
+    if bundle is not None:
+        with skip_init():
+            model = instantiate(cfg.model)
+        bundle.assign(model, "rcnn")
+        model.to(cfg.train.device)
+        return model, cfg
+
     model = instantiate(cfg.model)
     model.to(cfg.train.device)
 
     DetectionCheckpointer(model).load(cfg.train.init_checkpoint)
     return model, cfg
 
-def load_clip_model(data_split, device):
-    # Load the SigLIP model
-    clip_model, _, preprocess = open_clip.create_model_and_transforms('ViT-SO400M-14-SigLIP', pretrained='webli')
-    tokenizer = open_clip.get_tokenizer('ViT-SO400M-14-SigLIP')
+def load_clip_model(data_split, device, model_name='ViT-SO400M-14-SigLIP', pretrained='webli', bundle=None):
+    # Load the SigLIP model, `pretrained=None` keeps random weights
+    lvis_metadata = MetadataCatalog.get(data_split)
+    lvis_classes = lvis_metadata.get("thing_classes")
 
-    clip_model = clip_model.to(device)
+    if bundle is not None:  # weights and text features of the vocabulary are read from the bundle
+        with skip_init():
+            clip_model, _, preprocess = open_clip.create_model_and_transforms(model_name, pretrained=None)
+        clip_model = bundle.assign(clip_model, "clip").to(device)
+        text_features = bundle.tensor(f"text_features.{data_split}").to(device)
+        return clip_model, preprocess, text_features, lvis_classes
 
+    clip_model, _, preprocess = open_clip.create_model_and_transforms(model_name, pretrained=pretrained)
+    tokenizer = open_clip.get_tokenizer(model_name)
+
+    clip_model = clip_model.to(device)
 
-    lvis_metadata = MetadataCatalog.get(data_split)
-    lvis_classes = lvis_metadata.get("thing_classes")
 
     with open('lvis_original_class_to_synonyms.pkl', 'rb') as f:
         class_names_to_synonyms = pickle.load(f)
 
-    templates = [
-        "There is {article} {} in the scene.",
-        "There is the {} in the scene.",
-        "a photo of {article} {} in the scene.",
-        "a photo of the {} in the scene.",
-        "a photo of one {} in the scene.",
-        "itap of {article} {}.",
-        "itap of my {}.",
-        "itap of the {}.",
-        "a photo of {article} {}.",
-        "a photo of my {}.",
-        "a photo of the {}.",
-        "a photo of one {}.",
-        "a photo of many {}.",
-        "a good photo of {article} {}.",
-        "a good photo of the {}.",
-        "a bad photo of {article} {}.",
-        "a bad photo of the {}.",
-        "a photo of a nice {}.",
-        "a photo of the nice {}.",
-        "a photo of a cool {}.",
-        "a photo of the cool {}.",
-        "a photo of a weird {}.",
-        "a photo of the weird {}.",
-        "a photo of a small {}.",
-        "a photo of the small {}.",
-        "a photo of a large {}.",
-        "a photo of the large {}.",
-        "a photo of a clean {}.",
-        "a photo of the clean {}.",
-        "a photo of a dirty {}.",
-        "a photo of the dirty {}.",
-        "a bright photo of {article} {}.",
-        "a bright photo of the {}.",
-        "a dark photo of {article} {}.",
-        "a dark photo of the {}.",
-        "a photo of a hard to see {}.",
-        "a photo of the hard to see {}.",
-        "a low resolution photo of {article} {}.",
-        "a low resolution photo of the {}.",
-        "a cropped photo of {article} {}.",
-        "a cropped photo of the {}.",
-        "a close-up photo of {article} {}.",
-        "a close-up photo of the {}.",
-        "a jpeg corrupted photo of {article} {}.",
-        "a jpeg corrupted photo of the {}.",
-        "a blurry photo of {article} {}.",
-        "a blurry photo of the {}.",
-        "a pixelated photo of {article} {}.",
-        "a pixelated photo of the {}.",
-        "a black and white photo of the {}.",
-        "a black and white photo of {article} {}.",
-        "a plastic {}.",
-        "the plastic {}.",
-        "a toy {}.",
-        "the toy {}.",
-        "a plushie {}.",
-        "the plushie {}.",
-        "a cartoon {}.",
-        "the cartoon {}.",
-        "an embroidered {}.",
-        "the embroidered {}.",
-        "a painting of the {}.",
-        "a painting of a {}."
-    ]
+    text_features = encode_class_synonyms(
+        clip_model, tokenizer, [class_names_to_synonyms[classname] for classname in lvis_classes], device
+    ) # shape: (1203, 1152)
+    
+    return clip_model, preprocess, text_features, lvis_classes
+
+def load_sam_model(device, sam_checkpoint, model_type="vit_h", bundle=None):
+    # `sam_checkpoint=None` keeps random weights
+    if bundle is not None:
+        with skip_init():
+            sam = sam_model_registry[model_type](checkpoint=None)
+        bundle.assign(sam, "sam")
+    else:
+        sam = sam_model_registry[model_type](checkpoint=sam_checkpoint)
+    sam.to(device=device)
 
+    return sam
+
+def encode_class_synonyms(clip_model, tokenizer, synonyms_list, device):
+    # SigLIP embedding of every class: the mean over its synonyms of the mean over `CLIP_TEMPLATES`, normalized
     with torch.no_grad(), torch.cuda.amp.autocast():
         text_features = []
-        for classname in lvis_classes:
+        for synonyms in synonyms_list:
             syn_features = []
-            for syn in class_names_to_synonyms[classname]:
+            for syn in synonyms:
                 texts = [template.format(processed_name(syn, rm_dot=True),
-                        article=article(syn)) for template in templates]
+                        article=article(syn)) for template in CLIP_TEMPLATES]
                 texts = [
                     'This is ' + text if text.startswith('a') or text.startswith('the') else text
                     for text in texts
@@ -127,14 +193,6 @@ def load_clip_model(data_split, device):
             syn_feature /= syn_feature.norm() # shape: (1152)
             text_features.append(syn_feature)
 
-        text_features = torch.stack(text_features, dim=0).to(device) # shape: (1203, 1152)
-    
-    return clip_model, preprocess, text_features, lvis_classes
-
-def load_sam_model(device, sam_checkpoint):
-    model_type = "vit_h"
-
-    sam = sam_model_registry[model_type](checkpoint=sam_checkpoint)
-    sam.to(device=device)
+        text_features = torch.stack(text_features, dim=0).to(device)
 
-    return sam
\ No newline at end of file
+    return text_features
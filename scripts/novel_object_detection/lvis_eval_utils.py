@@ -0,0 +1,801 @@
+import datetime
+import json
+import multiprocessing as mp
+import numpy as np
+import pycocotools.mask as mask_utils
+
+from collections import OrderedDict
+from multiprocessing import shared_memory
+from lvis import LVISEval
+from lvis.eval import Params
+
+from scripts.box_matching import bbox_iou, last_argmax
+
+
+class VectorizedLVISEval(LVISEval):
+    """
+    Drop-in replacement of `LVISEval` with NumPy-vectorized `evaluate()` and `accumulate()`.
+
+    The reference implementation computes IoUs and runs the greedy matching once per (image, category, area range)
+    in pure Python. Here the annotations are flattened into arrays once, IoUs are computed for a whole batch of
+    (image, category) pairs at a time and the greedy matching is run for all pairs, area ranges and IoU thresholds
+    simultaneously, looping only over the detection rank. The LVIS federated semantics (detections are only evaluated
+    for categories that are either present or in `neg_category_ids` of the image, and unmatched detections of
+    `not_exhaustive_category_ids` are ignored) and all tie-breaking rules of the reference are preserved, so the
+    resulting `self.eval["precision"]`/`self.eval["recall"]` are identical to the ones of `LVISEval`.
+
+    Categories are evaluated independently, so with `num_workers > 1` they are partitioned across a process pool. The
+    workers read the flattened gts and dts from shared memory and only send back the per-category precision/recall
+    arrays, hence `self.eval["dt_pointers"]` is left empty in that case. Only supported for `iou_type="bbox"`.
+    """
+
+    # Upper bound on the number of elements of the (pairs, area ranges, iou thresholds, gts) matching state
+    max_batch_elements = 2 ** 23
+
+    # Fields of the flattened gts/dts read by `_evaluate_category()` for bbox evaluation
+    shared_gt_fields = ("key", "area", "ignore", "bbox")
+    shared_dt_fields = ("key", "id", "area", "score", "not_exhaustive", "bbox")
+
+    def __init__(self, lvis_gt, lvis_dt, iou_type="segm", num_workers=0):
+        super().__init__(lvis_gt, lvis_dt, iou_type)
+        self.num_workers = num_workers
+
+    def evaluate(self):
+        """
+        Run the matching for every category and store per-category detection results in `self.eval_cats`.
+        """
+        if not self.params.use_cats:  # not used by LVIS, keep the reference behaviour
+            return super().evaluate()
+
+        self.logger.info("Running vectorized per category evaluation.")
+        self.logger.info("Evaluate annotation type *{}*".format(self.params.iou_type))
+
+        self.params.img_ids = list(np.unique(self.params.img_ids))
+
+        self._prepare_arrays()
+
+        if self.num_workers > 1 and self.params.iou_type == "bbox":
+            self.eval_cats = self._evaluate_parallel()
+        else:
+            if self.num_workers > 1:
+                self.logger.warn("Parallel evaluation is only supported for bbox, evaluating {} serially.".format(
+                    self.params.iou_type
+                ))
+            self.eval_cats = [self._evaluate_category(cat_idx) for cat_idx in range(len(self.params.cat_ids))]
+
+    def _evaluate_parallel(self):
+        """
+        Evaluate and accumulate chunks of categories in a process pool. The flattened gts and dts are placed in
+        shared memory once, instead of being pickled for every worker.
+        """
+        num_cats = len(self.params.cat_ids)
+        self.logger.info("Evaluating {} categories with {} workers.".format(num_cats, self.num_workers))
+
+        arrays = {"gt_cat_offsets": self._gt_cat_offsets, "dt_cat_offsets": self._dt_cat_offsets}
+        arrays.update({"gt_" + field: self._gt_data[field] for field in self.shared_gt_fields})
+        arrays.update({"dt_" + field: self._dt_data[field] for field in self.shared_dt_fields})
+        shms, spec = _share_arrays(arrays)
+
+        # Small chunks keep the workers balanced, frequent categories are much more expensive than rare ones
+        chunk_size = max(1, num_cats // (self.num_workers * 8))
+        chunks = [list(range(start, min(start + chunk_size, num_cats))) for start in range(0, num_cats, chunk_size)]
+
+        # "fork" avoids re-importing the `__main__` script (which loads all models) in every worker
+        ctx = mp.get_context("fork") if "fork" in mp.get_all_start_methods() else mp.get_context()
+        eval_cats = [None] * num_cats
+        try:
+            with ctx.Pool(
+                    self.num_workers,
+                    initializer=_init_eval_worker,
+                    initargs=(self.params, self.max_batch_elements, spec),
+            ) as pool:
+                for results in pool.imap_unordered(_evaluate_categories_worker, chunks):
+                    for cat_idx, cat_eval in results:
+                        eval_cats[cat_idx] = cat_eval
+        finally:
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+
+        return eval_cats
+
+    def _prepare_arrays(self):
+        """Flatten gts and dts of `self.params` into arrays sorted by (category, image)."""
+
+        params = self.params
+        cat_ids = params.cat_ids if params.cat_ids else None
+
+        gt_index = getattr(self.lvis_gt, "gt_index", None)  # set by `datasets.gt_index.CachedLVIS`
+        if gt_index is not None:
+            if params.iou_type != "bbox":
+                raise ValueError("The ground-truth index is box-only, load the json annotations for segm evaluation.")
+            gts = self._gt_arrays_from_index(gt_index)
+        else:
+            gts = self.lvis_gt.load_anns(self.lvis_gt.get_ann_ids(img_ids=params.img_ids, cat_ids=cat_ids))
+        dts = self.lvis_dt.load_anns(self.lvis_dt.get_ann_ids(img_ids=params.img_ids, cat_ids=cat_ids))
+
+        if params.iou_type == "segm":
+            self._to_mask(gts, self.lvis_gt)
+            self._to_mask(dts, self.lvis_dt)
+
+        if gt_index is None:
+            gts = _anns_to_arrays(gts, params.iou_type)
+        dt_scores = np.array([d["score"] for d in dts], dtype=np.float64)
+        dts = _anns_to_arrays(dts, params.iou_type)
+
+        num_imgs = len(params.img_ids)
+        img_index = {img_id: idx for idx, img_id in enumerate(params.img_ids)}
+        cat_index = {cat_id: idx for idx, cat_id in enumerate(params.cat_ids)}
+
+        gt_keys = _lookup(params.cat_ids, gts["category_id"]) * num_imgs + _lookup(params.img_ids, gts["image_id"])
+        dt_keys = _lookup(params.cat_ids, dts["category_id"]) * num_imgs + _lookup(params.img_ids, dts["image_id"])
+
+        # For federated dataset evaluation only keep dts for the categories which are either present in the image or
+        # listed in its negative categories; the detector is not penalized for the rest.
+        img_data = self.lvis_gt.load_imgs(ids=params.img_ids)
+        neg_keys = self._img_cat_keys(img_data, "neg_category_ids", img_index, cat_index)
+        nel_keys = self._img_cat_keys(img_data, "not_exhaustive_category_ids", img_index, cat_index)
+
+        keep = np.isin(dt_keys, np.union1d(gt_keys, neg_keys))
+        dt_pos = np.flatnonzero(keep)
+
+        # gts keep the order of `get_ann_ids`, dts are additionally sorted by decreasing score (stable), as in
+        # `LVISEval.evaluate_img`
+        gt_order = np.argsort(gt_keys, kind="mergesort")
+        dt_order = dt_pos[np.lexsort((dt_pos, -dt_scores[dt_pos], dt_keys[dt_pos]))]
+
+        self._gt_data = _collect(gts, gt_order, gt_keys)
+        self._dt_data = _collect(dts, dt_order, dt_keys)
+        self._dt_data["score"] = dt_scores[dt_order]
+        self._dt_data["not_exhaustive"] = np.isin(self._dt_data["key"], nel_keys)
+
+        num_cats = len(params.cat_ids)
+        cat_bounds = np.arange(num_cats + 1) * num_imgs
+        self._gt_cat_offsets = np.searchsorted(self._gt_data["key"], cat_bounds)
+        self._dt_cat_offsets = np.searchsorted(self._dt_data["key"], cat_bounds)
+
+        self.freq_groups = self._prepare_freq_group()
+
+    def _gt_arrays_from_index(self, gt_index):
+        """Same gts, in the same order, as `get_ann_ids(img_ids, cat_ids)` + `load_anns()`, read from the index."""
+
+        img_pos = np.searchsorted(gt_index.img_ids, self.params.img_ids)
+        starts = gt_index.ann_offsets[img_pos]
+        counts = gt_index.ann_offsets[img_pos + 1] - starts
+        ann_idx = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+
+        area = gt_index.ann_areas[ann_idx]
+        category_id = gt_index.ann_category_ids[ann_idx]
+        keep = np.isin(category_id, self.params.cat_ids) & (area > 0) & (area < float("inf"))
+        ann_idx = ann_idx[keep]
+
+        return {
+            "image_id": gt_index.ann_image_ids[ann_idx],
+            "category_id": category_id[keep],
+            "id": gt_index.ann_ids[ann_idx],
+            "area": area[keep],
+            "ignore": gt_index.ann_ignore[ann_idx].astype(bool),
+            "bbox": np.asarray(gt_index.ann_bboxes[ann_idx], dtype=np.float64).reshape(-1, 4),
+        }
+
+    @staticmethod
+    def _img_cat_keys(img_data, field, img_index, cat_index):
+        return np.array(
+            [
+                cat_index[cat_id] * len(img_index) + img_index[img["id"]]
+                for img in img_data
+                for cat_id in img[field]
+                if cat_id in cat_index
+            ],
+            dtype=np.int64,
+        )
+
+    def _evaluate_category(self, cat_idx):
+        """
+        Match all dts of one category against its gts over all images, area ranges and IoU thresholds.
+
+        Returns:
+            dict with the dt ids and scores sorted by decreasing score, boolean `tps`/`fps` of shape
+            (num_area_rngs, num_thrs, num_dts) in the same order and the number of non-ignored gts per area range.
+        """
+        params = self.params
+        area_rng = np.array(params.area_rng, dtype=np.float64)  # (A, 2)
+        num_thrs = len(params.iou_thrs)
+
+        gs, ge = self._gt_cat_offsets[cat_idx], self._gt_cat_offsets[cat_idx + 1]
+        ds, de = self._dt_cat_offsets[cat_idx], self._dt_cat_offsets[cat_idx + 1]
+
+        gt_area = self._gt_data["area"][gs:ge]
+        gt_ignore = self._gt_data["ignore"][gs:ge][None, :] | (gt_area[None, :] < area_rng[:, :1]) | (
+            gt_area[None, :] > area_rng[:, 1:]
+        )  # (A, num_gts)
+        num_gt = np.count_nonzero(~gt_ignore, axis=1)
+
+        num_dts = de - ds
+        dt_matched = np.zeros((len(area_rng), num_thrs, num_dts), dtype=bool)
+        dt_matched_ignored = np.zeros((len(area_rng), num_thrs, num_dts), dtype=bool)
+
+        gt_keys = self._gt_data["key"][gs:ge]
+        dt_keys = self._dt_data["key"][ds:de]
+        # (image, category) pairs with both gts and dts; the dts of the other images stay unmatched
+        pair_keys = np.intersect1d(gt_keys, dt_keys) if num_dts > 0 and ge > gs else np.zeros((0,), dtype=np.int64)
+        if len(pair_keys) > 0:
+            pair_gs = np.searchsorted(gt_keys, pair_keys, side="left")
+            pair_ge = np.searchsorted(gt_keys, pair_keys, side="right")
+            pair_ds = np.searchsorted(dt_keys, pair_keys, side="left")
+            pair_de = np.searchsorted(dt_keys, pair_keys, side="right")
+
+            # Process pairs with the most dts first, so that the pairs still active at a given dt rank form a prefix
+            pair_order = np.argsort(pair_ds - pair_de, kind="mergesort")
+            pair_gs, pair_ge = pair_gs[pair_order], pair_ge[pair_order]
+            pair_ds, pair_de = pair_ds[pair_order], pair_de[pair_order]
+
+            max_gts = int((pair_ge - pair_gs).max())
+            start = 0
+            while start < len(pair_keys):
+                max_dts = int(pair_de[start] - pair_ds[start])
+                chunk = max(1, self.max_batch_elements // (max_dts * max_gts * len(area_rng) * num_thrs))
+                batch = slice(start, start + chunk)
+                self._match_pairs(
+                    gs, ds, pair_gs[batch], pair_ge[batch], pair_ds[batch], pair_de[batch],
+                    gt_ignore, dt_matched, dt_matched_ignored,
+                )
+                start += chunk
+
+        # For LVIS we will ignore any unmatched detection if that category was not exhaustively annotated in gt.
+        dt_area = self._dt_data["area"][ds:de]
+        dt_ignore_mask = (
+            (dt_area[None, :] < area_rng[:, :1])
+            | (dt_area[None, :] > area_rng[:, 1:])
+            | self._dt_data["not_exhaustive"][ds:de][None, :]
+        )  # (A, num_dts)
+        dt_ignore = dt_matched_ignored | (~dt_matched & dt_ignore_mask[:, None, :])
+
+        # Sort all dts of the category by decreasing score; ties keep the image order and then the per-image order
+        dt_scores = self._dt_data["score"][ds:de]
+        dt_order = np.argsort(-dt_scores, kind="mergesort")
+
+        tps = (dt_matched & ~dt_ignore)[:, :, dt_order]
+        fps = (~dt_matched & ~dt_ignore)[:, :, dt_order]
+
+        return {
+            "dt_ids": self._dt_data["id"][ds:de][dt_order],
+            "dt_scores": dt_scores[dt_order],
+            "tps": tps,
+            "fps": fps,
+            "num_gt": num_gt,
+        }
+
+    def _match_pairs(
+            self, gs, ds, pair_gs, pair_ge, pair_ds, pair_de, gt_ignore, dt_matched, dt_matched_ignored
+    ):
+        """
+        Greedy matching of a batch of (image, category) pairs, equivalent to the inner loops of
+        `LVISEval.evaluate_img`: every dt, in decreasing score order, is matched to the not yet matched gt with the
+        highest IoU above the threshold (the last one on ties), preferring non-ignored gts over ignored ones.
+        Offsets are relative to the category slices starting at `gs`/`ds`; results are written in place.
+        """
+        num_dts = pair_de - pair_ds
+        num_gts = pair_ge - pair_gs
+        max_dts, max_gts = int(num_dts.max()), int(num_gts.max())
+
+        dt_range = np.arange(max_dts)
+        gt_range = np.arange(max_gts)
+        dt_valid = dt_range[None, :] < num_dts[:, None]
+        gt_valid = gt_range[None, :] < num_gts[:, None]
+        dt_idx = np.where(dt_valid, pair_ds[:, None] + dt_range[None, :], 0)  # (P, D)
+        gt_idx = np.where(gt_valid, pair_gs[:, None] + gt_range[None, :], 0)  # (P, G)
+
+        ious = self._compute_ious(ds + dt_idx, gs + gt_idx, num_dts, num_gts)
+        ious[~(dt_valid[:, :, None] & gt_valid[:, None, :])] = -1
+
+        iou_thrs = np.minimum(self.params.iou_thrs, 1 - 1e-10)[None, None, :, None]
+        pair_gt_ignore = gt_ignore[:, gt_idx].transpose(1, 0, 2)[:, :, None, :]  # (P, A, 1, G)
+
+        num_pairs = len(pair_gs)
+        num_areas, num_thrs = gt_ignore.shape[0], iou_thrs.shape[2]
+        gt_matched = np.zeros((num_pairs, num_areas, num_thrs, max_gts), dtype=bool)
+        pair_matched = np.zeros((num_pairs, num_areas, num_thrs, max_dts), dtype=bool)
+        pair_matched_ignored = np.zeros((num_pairs, num_areas, num_thrs, max_dts), dtype=bool)
+
+        # pairs are sorted by decreasing number of dts, so pairs with a dt of rank `d` are the first `num_active`
+        num_active_per_rank = np.searchsorted(-num_dts, -dt_range, side="left")
+        for d in dt_range:
+            k = num_active_per_rank[d]
+            iou = ious[:k, d][:, None, None, :]  # (k, 1, 1, G)
+            candidates = (iou >= iou_thrs) & ~gt_matched[:k]
+
+            match_regular, has_regular = last_argmax(iou, candidates & ~pair_gt_ignore[:k])
+            match_ignored, has_ignored = last_argmax(iou, candidates & pair_gt_ignore[:k])
+
+            match = np.where(has_regular, match_regular, match_ignored)
+            matched = has_regular | has_ignored
+
+            gt_matched[:k] |= (gt_range == match[..., None]) & matched[..., None]
+            pair_matched[:k, :, :, d] = matched
+            pair_matched_ignored[:k, :, :, d] = has_ignored & ~has_regular
+
+        dt_matched[:, :, dt_idx[dt_valid]] = pair_matched.transpose(1, 2, 0, 3)[:, :, dt_valid]
+        dt_matched_ignored[:, :, dt_idx[dt_valid]] = pair_matched_ignored.transpose(1, 2, 0, 3)[:, :, dt_valid]
+
+    def _compute_ious(self, dt_idx, gt_idx, num_dts, num_gts):
+        """IoUs of shape (P, D, G) between the padded dts and gts of a batch of pairs."""
+
+        if self.params.iou_type == "bbox":
+            return bbox_iou(self._dt_data["bbox"][dt_idx], self._gt_data["bbox"][gt_idx])
+
+        ious = np.zeros(dt_idx.shape + gt_idx.shape[1:], dtype=np.float64)
+        for p in range(len(dt_idx)):
+            dt = [self._dt_data["segmentation"][i] for i in dt_idx[p, :num_dts[p]]]
+            gt = [self._gt_data["segmentation"][i] for i in gt_idx[p, :num_gts[p]]]
+            ious[p, :num_dts[p], :num_gts[p]] = mask_utils.iou(dt, gt, [0] * len(gt))
+        return ious
+
+    def accumulate(self):
+        """
+        Accumulate per category evaluation results and store the result in self.eval.
+        """
+        if not self.params.use_cats:
+            return super().accumulate()
+
+        self.logger.info("Accumulating evaluation results.")
+
+        if not getattr(self, "eval_cats", None):
+            self.logger.warn("Please run evaluate first.")
+            self.eval_cats = []
+
+        num_thrs = len(self.params.iou_thrs)
+        num_recalls = len(self.params.rec_thrs)
+        num_cats = len(self.params.cat_ids)
+        num_area_rngs = len(self.params.area_rng)
+
+        # -1 for absent categories
+        precision = -np.ones((num_thrs, num_recalls, num_cats, num_area_rngs))
+        recall = -np.ones((num_thrs, num_cats, num_area_rngs))
+
+        dt_pointers = {cat_idx: {area_idx: {} for area_idx in range(num_area_rngs)} for cat_idx in range(num_cats)}
+
+        for cat_idx, cat_eval in enumerate(self.eval_cats):
+            if "precision" not in cat_eval:  # not already accumulated by a worker of `_evaluate_parallel()`
+                cat_eval = self._accumulate_category(cat_eval, dt_pointers[cat_idx])
+            precision[:, :, cat_idx, :] = cat_eval["precision"]
+            recall[:, cat_idx, :] = cat_eval["recall"]
+
+        self.eval = {
+            "params": self.params,
+            "counts": [num_thrs, num_recalls, num_cats, num_area_rngs],
+            "date": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "precision": precision,
+            "recall": recall,
+            "dt_pointers": dt_pointers,
+        }
+
+    def _accumulate_category(self, cat_eval, dt_pointers=None):
+        """
+        Precision of shape (num_thrs, num_recalls, num_area_rngs) and recall of shape (num_thrs, num_area_rngs) of a
+        single category, -1 for area ranges without gts.
+        """
+        num_thrs = len(self.params.iou_thrs)
+        num_area_rngs = len(self.params.area_rng)
+
+        precision = -np.ones((num_thrs, len(self.params.rec_thrs), num_area_rngs))
+        recall = -np.ones((num_thrs, num_area_rngs))
+
+        for area_idx in range(num_area_rngs):
+            num_gt = cat_eval["num_gt"][area_idx]
+            if num_gt == 0:
+                continue
+
+            tps = cat_eval["tps"][area_idx]
+            fps = cat_eval["fps"][area_idx]
+            if dt_pointers is not None:
+                dt_pointers[area_idx] = {"dt_ids": cat_eval["dt_ids"], "tps": tps, "fps": fps}
+
+            precision[:, :, area_idx], recall[:, area_idx] = _precision_recall(
+                tps, fps, num_gt, self.params.rec_thrs
+            )
+
+        return {"precision": precision, "recall": recall}
+
+    def summary_metrics(self):
+        return summary_metrics(self.params.max_dets)
+
+    def summarize_subsets(self, subsets):
+        """
+        Compute all the `summarize()` metrics for several subsets of classes in a single pass over `self.eval`.
+
+        Args:
+            subsets (list[list[int]]): indices into `self.params.cat_ids` of each subset
+
+        Returns:
+            list[OrderedDict]: metrics of each subset, with the same keys as `self.results`
+        """
+        if not self.eval:
+            raise RuntimeError("Please run accumulate() first.")
+
+        return summarize_precision_recall(
+            self.eval["precision"], self.eval["recall"], self.params, self.freq_groups, self.summary_metrics(), subsets
+        )
+
+    def summarize(self):
+        """Same metrics as `LVISEval.summarize()`, computed by `summarize_subsets()`."""
+        if not self.params.use_cats:
+            return super().summarize()
+
+        self.results.update(self.summarize_subsets([list(range(len(self.params.cat_ids)))])[0])
+
+
+def summary_metrics(max_dets):
+    """(name, summary type, iou threshold, area range, frequency group index) of the `LVISEval.summarize()` metrics."""
+    return [
+        ("AP", "ap", None, "all", None),
+        ("AP50", "ap", 0.50, "all", None),
+        ("AP75", "ap", 0.75, "all", None),
+        ("APs", "ap", None, "small", None),
+        ("APm", "ap", None, "medium", None),
+        ("APl", "ap", None, "large", None),
+        ("APr", "ap", None, "all", 0),
+        ("APc", "ap", None, "all", 1),
+        ("APf", "ap", None, "all", 2),
+        ("AR@{}".format(max_dets), "ar", None, "all", None),
+        ("ARs@{}".format(max_dets), "ar", None, "small", None),
+        ("ARm@{}".format(max_dets), "ar", None, "medium", None),
+        ("ARl@{}".format(max_dets), "ar", None, "large", None),
+    ]
+
+
+def summarize_precision_recall(precision, recall, params, freq_groups, metrics, subsets):
+    """
+    Mean of the valid (> -1) `precision` (num_thrs, num_recalls, num_cats, num_area_rngs) / `recall` (num_thrs,
+    num_cats, num_area_rngs) entries for every metric of `metrics` (see `summary_metrics()`) and
+    every subset of category indices of `subsets`.
+
+    The valid entries are summed and counted once per category, IoU threshold and area range; the mean of every
+    (subset, metric) pair is then a ratio of two masked sums over categories. Gives the same values as
+    `LVISEval._summarize()` on each subset, up to floating point summation order.
+    """
+    num_cats = len(params.cat_ids)
+
+    valid = precision > -1
+    sums_counts = {
+        "ap": (np.where(valid, precision, 0).sum(axis=1), valid.sum(axis=1)),
+        "ar": (np.where(recall > -1, recall, 0), (recall > -1).astype(np.int64)),
+    }
+
+    freq_masks = np.zeros((len(freq_groups), num_cats), dtype=bool)
+    for group_idx, cat_idxs in enumerate(freq_groups):
+        freq_masks[group_idx, cat_idxs] = True
+
+    metric_sums = np.zeros((len(metrics), num_cats))
+    metric_counts = np.zeros((len(metrics), num_cats))
+    for metric_idx, (_, summary_type, iou_thr, area_rng, freq_group_idx) in enumerate(metrics):
+        tidx = slice(None) if iou_thr is None else np.where(iou_thr == params.iou_thrs)[0]
+        aidx = params.area_rng_lbl.index(area_rng)
+        sums, counts = sums_counts[summary_type]
+        cat_mask = freq_masks[freq_group_idx] if freq_group_idx is not None else True
+        metric_sums[metric_idx] = sums[tidx, :, aidx].sum(axis=0) * cat_mask
+        metric_counts[metric_idx] = counts[tidx, :, aidx].sum(axis=0) * cat_mask
+
+    subset_masks = np.zeros((len(subsets), num_cats))
+    for subset_idx, cat_idxs in enumerate(subsets):
+        subset_masks[subset_idx, cat_idxs] = 1
+
+    subset_sums = subset_masks @ metric_sums.T  # (num_subsets, num_metrics)
+    subset_counts = subset_masks @ metric_counts.T
+    with np.errstate(divide="ignore", invalid="ignore"):
+        means = np.where(subset_counts > 0, subset_sums / subset_counts, -1)
+
+    return [
+        OrderedDict((name, float(mean)) for (name, *_), mean in zip(metrics, subset_means))
+        for subset_means in means
+    ]
+
+
+def load_class_subsets(path):
+    """
+    Read named class subsets from a json file, in their order of definition. Each subset is either a list of LVIS
+    category ids, or a dict with the names of previously defined subsets to "include" (default: all classes) and to
+    "exclude", e.g. `{"known": [3, 12, ...], "novel": {"exclude": ["known"]}}`.
+    """
+    with open(path, "r") as f:
+        return json.load(f, object_pairs_hook=OrderedDict)
+
+
+def resolve_class_subsets(class_subsets, cat_ids):
+    """Convert the subsets of `load_class_subsets()` to sorted lists of indices into `cat_ids`."""
+    cat_index = {cat_id: idx for idx, cat_id in enumerate(cat_ids)}
+    resolved = OrderedDict()
+    for name, subset in class_subsets.items():
+        if isinstance(subset, dict):
+            for other in subset.get("include", []) + subset.get("exclude", []):
+                if other not in resolved:
+                    raise ValueError("Class subset {} refers to {}, which must be defined before".format(name, other))
+            if "include" in subset:
+                cat_idxs = set().union(*[resolved[other] for other in subset["include"]])
+            else:
+                cat_idxs = set(range(len(cat_ids)))
+            for other in subset.get("exclude", []):
+                cat_idxs.difference_update(resolved[other])
+        else:
+            cat_idxs = {cat_index[cat_id] for cat_id in subset if cat_id in cat_index}
+        resolved[name] = sorted(cat_idxs)
+    return resolved
+
+
+# Per-process state of the `_evaluate_parallel()` workers
+_eval_worker = {}
+
+
+def _share_arrays(arrays):
+    """Copy the arrays into new shared memory blocks; returns the blocks and a picklable spec to attach to them."""
+    shms, spec = [], {}
+    for name, array in arrays.items():
+        array = np.ascontiguousarray(array)
+        shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+        np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+        shms.append(shm)
+        spec[name] = (shm.name, array.shape, array.dtype.str)
+    return shms, spec
+
+
+def _attach_arrays(spec):
+    shms, arrays = [], {}
+    for name, (shm_name, shape, dtype) in spec.items():
+        shm = shared_memory.SharedMemory(name=shm_name)
+        shms.append(shm)
+        arrays[name] = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+    return shms, arrays
+
+
+def _init_eval_worker(params, max_batch_elements, spec):
+    shms, arrays = _attach_arrays(spec)
+
+    # A bare evaluator holding only what `_evaluate_category()` and `_accumulate_category()` need
+    lvis_eval = VectorizedLVISEval.__new__(VectorizedLVISEval)
+    lvis_eval.params = params
+    lvis_eval.max_batch_elements = max_batch_elements
+    lvis_eval._gt_cat_offsets = arrays["gt_cat_offsets"]
+    lvis_eval._dt_cat_offsets = arrays["dt_cat_offsets"]
+    lvis_eval._gt_data = {field: arrays["gt_" + field] for field in VectorizedLVISEval.shared_gt_fields}
+    lvis_eval._dt_data = {field: arrays["dt_" + field] for field in VectorizedLVISEval.shared_dt_fields}
+
+    _eval_worker["shms"] = shms  # keep the mappings alive
+    _eval_worker["eval"] = lvis_eval
+
+
+def _evaluate_categories_worker(cat_idxs):
+    lvis_eval = _eval_worker["eval"]
+    return [(cat_idx, lvis_eval._accumulate_category(lvis_eval._evaluate_category(cat_idx))) for cat_idx in cat_idxs]
+
+
+def _anns_to_arrays(anns, iou_type):
+    arrays = {
+        "image_id": np.array([ann["image_id"] for ann in anns], dtype=np.int64),
+        "category_id": np.array([ann["category_id"] for ann in anns], dtype=np.int64),
+        "id": np.array([ann["id"] for ann in anns], dtype=np.int64),
+        "area": np.array([ann["area"] for ann in anns], dtype=np.float64),
+        "ignore": np.array([ann.get("ignore", 0) for ann in anns], dtype=bool),
+    }
+    if iou_type == "bbox":
+        arrays["bbox"] = np.array([ann["bbox"] for ann in anns], dtype=np.float64).reshape(-1, 4)
+    else:
+        arrays["segmentation"] = [ann["segmentation"] for ann in anns]
+    return arrays
+
+
+def _collect(arrays, order, keys):
+    data = {"key": keys[order]}
+    for name, values in arrays.items():
+        data[name] = [values[i] for i in order] if isinstance(values, list) else values[order]
+    return data
+
+
+def _lookup(sorted_ids, ids):
+    """Positions of `ids` in `sorted_ids`."""
+    return np.searchsorted(np.asarray(sorted_ids, dtype=np.int64), ids).astype(np.int64)
+
+
+def _precision_recall(tps, fps, num_gt, rec_thrs):
+    """
+    Vectorized version of the per-threshold loop of `LVISEval.accumulate`.
+    tps, fps: (num_thrs, num_dts) sorted by decreasing score -> precision (num_thrs, num_recalls), recall (num_thrs,)
+    """
+    num_thrs, num_dts = tps.shape
+    if num_dts == 0:
+        return np.zeros((num_thrs, len(rec_thrs))), np.zeros(num_thrs)
+
+    tp_sum = np.cumsum(tps, axis=1).astype(dtype=np.float64)
+    fp_sum = np.cumsum(fps, axis=1).astype(dtype=np.float64)
+
+    rc = tp_sum / num_gt
+    # np.spacing(1) ~= eps
+    pr = tp_sum / (fp_sum + tp_sum + np.spacing(1))
+    # Replace each precision value with the maximum precision value to the right of that recall level
+    pr = np.maximum.accumulate(pr[:, ::-1], axis=1)[:, ::-1]
+
+    precision = np.zeros((num_thrs, len(rec_thrs)))
+    for iou_thr_idx in range(num_thrs):
+        rec_thrs_insert_idx = np.searchsorted(rc[iou_thr_idx], rec_thrs, side="left")
+        valid = rec_thrs_insert_idx < num_dts
+        precision[iou_thr_idx, valid] = pr[iou_thr_idx, rec_thrs_insert_idx[valid]]
+
+    return precision, rc[:, -1]
+
+
+class LVISEvalCustom(VectorizedLVISEval):
+    """
+    Extends `LVISEval` with results for named subsets of classes (e.g. known and novel classes) when `class_subsets`
+    is provided, see `load_class_subsets()`. Every metric of `self.results` (incl. the r/c/f and area breakdowns) is
+    reported per subset in `self.results_subsets`.
+    """
+
+    def __init__(self, lvis_gt, lvis_dt, iou_type="segm", class_subsets=None, num_workers=0):
+        super().__init__(lvis_gt, lvis_dt, iou_type, num_workers=num_workers)
+
+        # Subsets are stored as indices into `self.params.cat_ids`, following the mapping applied to train data, - that
+        # is list all categories in a consecutive order and use their indices; see: `lvis-api/lvis/eval.py` line 109:
+        # https://github.com/lvis-dataset/lvis-api/blob/35f09cd7c5f313a9bf27b329ca80effe2b0c8a93/lvis/eval.py#L109
+        self.class_subsets = resolve_class_subsets(class_subsets or OrderedDict(), self.params.cat_ids)
+        self.results_subsets = OrderedDict()
+
+    def summarize(self):
+        """Extends the default version by calculating the results for every subset of classes in the same pass."""
+
+        if not self.eval:
+            raise RuntimeError("Please run accumulate() first.")
+
+        all_classes = list(range(len(self.params.cat_ids)))
+        results = self.summarize_subsets([all_classes] + list(self.class_subsets.values()))
+
+        self.results.update(results[0])
+        self.results_subsets = OrderedDict(zip(self.class_subsets.keys(), results[1:]))
+
+
+class OnlineLVISEval:
+    """
+    Approximate LVIS box AP updated image by image, to monitor a run while inference is still going.
+
+    Every call to `process()` matches the detections of one image against its gts with the `LVISEval` rules (top
+    `max_dets` detections, federated filtering with `neg_category_ids`, unmatched detections of
+    `not_exhaustive_category_ids` ignored, greedy matching with the same tie-breaking) and adds them to per-category
+    histograms of true / false positives over `num_score_bins` score bins. `accumulate()` + `summarize()` turn the
+    histograms into precision/recall curves, so the estimate only differs from the final `LVISEval` results on the
+    processed images by the quantization of the scores. Only the "all" area range is tracked.
+    """
+
+    def __init__(self, lvis_gt, class_subsets=None, max_dets=300, num_score_bins=200):
+        self.lvis_gt = lvis_gt
+
+        self.params = Params(iou_type="bbox")
+        self.params.cat_ids = sorted(lvis_gt.get_cat_ids())
+        self.params.area_rng = self.params.area_rng[:1]
+        self.params.area_rng_lbl = self.params.area_rng_lbl[:1]
+        self.params.max_dets = max_dets
+        self.num_score_bins = num_score_bins
+
+        self.cat_index = {cat_id: idx for idx, cat_id in enumerate(self.params.cat_ids)}
+        self.freq_groups = [[] for _ in self.params.img_count_lbl]
+        for idx, cat in enumerate(lvis_gt.load_cats(self.params.cat_ids)):
+            if cat.get("frequency") in self.params.img_count_lbl:
+                self.freq_groups[self.params.img_count_lbl.index(cat["frequency"])].append(idx)
+
+        self.class_subsets = resolve_class_subsets(class_subsets or OrderedDict(), self.params.cat_ids)
+        self.reset()
+
+    def reset(self):
+        num_thrs, num_cats = len(self.params.iou_thrs), len(self.params.cat_ids)
+        self.tp_hist = np.zeros((num_cats, num_thrs, self.num_score_bins), dtype=np.int32)
+        self.fp_hist = np.zeros((num_cats, num_thrs, self.num_score_bins), dtype=np.int32)
+        self.num_gt = np.zeros(num_cats, dtype=np.int64)
+        self.num_images = 0
+        self.eval = {}
+        self.results = OrderedDict()
+        self.results_subsets = OrderedDict()
+
+    def summary_metrics(self):
+        return [metric for metric in summary_metrics(self.params.max_dets) if metric[3] == "all"]
+
+    def process(self, image_id, instances):
+        """
+        Add the detections of one image.
+
+        Args:
+            image_id (int): id of an image of `lvis_gt`
+            instances (list[dict]): detections in the json format of `instances_to_coco_json()`, with "category_id"
+                the contiguous id, i.e. the index into the sorted category ids
+        """
+        if image_id not in self.lvis_gt.imgs:
+            return
+        self.num_images += 1
+
+        img = self.lvis_gt.imgs[image_id]
+        gts = [gt for gt in self.lvis_gt.img_ann_map[image_id] if 0 < gt["area"] < float("inf")]
+        gt_cats = np.array([self.cat_index[gt["category_id"]] for gt in gts], dtype=np.int64)
+        gt_boxes = np.array([gt["bbox"] for gt in gts], dtype=np.float64).reshape(-1, 4)
+        gt_ignore = np.array([gt.get("ignore", 0) for gt in gts], dtype=bool)
+        np.add.at(self.num_gt, gt_cats[~gt_ignore], 1)
+
+        if len(instances) == 0:
+            return
+
+        dt_scores = np.array([dt["score"] for dt in instances], dtype=np.float64)
+        order = np.argsort(-dt_scores, kind="mergesort")[:self.params.max_dets]
+        dt_scores = dt_scores[order]
+        dt_cats = np.array([instances[i]["category_id"] for i in order], dtype=np.int64)
+        dt_boxes = np.array([instances[i]["bbox"] for i in order], dtype=np.float64).reshape(-1, 4)
+        dt_bins = np.clip((dt_scores * self.num_score_bins).astype(np.int64), 0, self.num_score_bins - 1)
+
+        neg_cats = np.array(
+            [self.cat_index[cat_id] for cat_id in img.get("neg_category_ids", []) if cat_id in self.cat_index],
+            dtype=np.int64,
+        )
+        nel_cats = {self.cat_index[c] for c in img.get("not_exhaustive_category_ids", []) if c in self.cat_index}
+
+        # Federated evaluation: detections are only evaluated for categories present in the image or in its negatives
+        thr_idxs = np.arange(len(self.params.iou_thrs))[:, None]
+        for cat_idx in np.intersect1d(dt_cats, np.union1d(gt_cats, neg_cats)):
+            dt_idx = np.flatnonzero(dt_cats == cat_idx)  # already sorted by decreasing score
+            gt_idx = np.flatnonzero(gt_cats == cat_idx)
+            gt_idx = gt_idx[np.argsort(gt_ignore[gt_idx], kind="mergesort")]  # ignored gts last
+
+            ious = bbox_iou(dt_boxes[None, dt_idx], gt_boxes[None, gt_idx])[0]
+            matched, matched_ignored = self._match(ious, gt_ignore[gt_idx])
+
+            dt_ignore = matched_ignored | (~matched & (cat_idx in nel_cats))
+            np.add.at(self.tp_hist[cat_idx], (thr_idxs, dt_bins[None, dt_idx]), matched & ~dt_ignore)
+            np.add.at(self.fp_hist[cat_idx], (thr_idxs, dt_bins[None, dt_idx]), ~matched & ~dt_ignore)
+
+    def _match(self, ious, gt_ignore):
+        """
+        Greedy matching of `LVISEval.evaluate_img` for all IoU thresholds at once.
+        ious: (num_dts, num_gts), dts sorted by decreasing score
+        -> matched, matched to an ignored gt: (num_thrs, num_dts)
+        """
+        iou_thrs = np.minimum(self.params.iou_thrs, 1 - 1e-10)[:, None]
+        num_dts, num_gts = ious.shape
+        gt_taken = np.zeros((len(iou_thrs), num_gts), dtype=bool)
+        matched = np.zeros((len(iou_thrs), num_dts), dtype=bool)
+        matched_ignored = np.zeros((len(iou_thrs), num_dts), dtype=bool)
+        if num_gts == 0:  # negative category of the image
+            return matched, matched_ignored
+
+        for d in range(num_dts):
+            candidates = ~gt_taken & (ious[d] >= iou_thrs)
+            match_regular, has_regular = last_argmax(ious[d][None], candidates & ~gt_ignore)
+            match_ignored, has_ignored = last_argmax(ious[d][None], candidates & gt_ignore)
+            match = np.where(has_regular, match_regular, match_ignored)
+            has_match = has_regular | has_ignored
+            gt_taken[np.flatnonzero(has_match), match[has_match]] = True
+            matched[:, d] = has_match
+            matched_ignored[:, d] = has_ignored & ~has_regular
+
+        return matched, matched_ignored
+
+    def accumulate(self):
+        """Precision/recall curves from the score histograms, in the same layout as `LVISEval.eval`."""
+        num_thrs, num_cats = len(self.params.iou_thrs), len(self.params.cat_ids)
+        precision = -np.ones((num_thrs, len(self.params.rec_thrs), num_cats, 1))
+        recall = -np.ones((num_thrs, num_cats, 1))
+
+        for cat_idx in np.flatnonzero(self.num_gt):
+            # Score bins in decreasing order play the role of the sorted detections
+            precision[:, :, cat_idx, 0], recall[:, cat_idx, 0] = _precision_recall(
+                self.tp_hist[cat_idx, :, ::-1], self.fp_hist[cat_idx, :, ::-1], self.num_gt[cat_idx],
+                self.params.rec_thrs,
+            )
+
+        self.eval = {"params": self.params, "precision": precision, "recall": recall}
+
+    def summarize(self):
+        """Approximate metrics for all classes in `self.results` and for each class subset in `self.results_subsets`."""
+        if not self.eval:
+            raise RuntimeError("Please run accumulate() first.")
+
+        all_classes = list(range(len(self.params.cat_ids)))
+        results = summarize_precision_recall(
+            self.eval["precision"], self.eval["recall"], self.params, self.freq_groups, self.summary_metrics(),
+            [all_classes] + list(self.class_subsets.values()),
+        )
+        self.results = results[0]
+        self.results_subsets = OrderedDict(zip(self.class_subsets.keys(), results[1:]))
+        return self.results
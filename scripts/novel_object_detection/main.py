@@ -22,94 +22,170 @@ cfg_file = params["cfg_file"]
 rcnn_weight_dir = params["rcnn_weight_dir"]
 sam_checkpoint = params["sam_checkpoint"]
 gdino_checkpoint = params["gdino_checkpoint"]
+eval_num_workers = params["eval_num_workers"]
+class_subsets_file = params["class_subsets_file"]
+online_eval_period = params["online_eval_period"]
+stage_cache_dir = params["stage_cache_dir"]
+profile_stages = params["profile_stages"]
+model_load_workers = params["model_load_workers"]
+rcnn_box_only = params["rcnn_box_only"]
+model_bundle = params["model_bundle"]
+prefilter_topk = params["prefilter_topk"]
+prefilter_grid_size = params["prefilter_grid_size"]
+class_clusters_file = params["class_clusters_file"]
+class_cluster_probes = params["class_cluster_probes"]
 
 os.environ['DETECTRON2_DATASETS'] = detectron2_dir
 
 import torch
 import detectron2.data.transforms as T
 
-from groundingdino.util.inference import load_model
-from load_models import load_fully_supervised_trained_model, load_clip_model, load_sam_model
+from load_models import load_gdino_model, load_fully_supervised_trained_model, load_clip_model, load_sam_model
 from utils import get_text_prompt_list_for_g_dino, get_coco_to_lvis_mapping
 from evaluation import CustomEvaluator, LVISEvaluatorCustom, inference
+from lvis_eval_utils import OnlineLVISEval, load_class_subsets
+from stage_outputs import StageOutputCache
+from result_cache import ResultCache
+from profiling import StageProfiler
+from prefilter import ClassPrefilter
+from class_index import HierarchicalClassIndex
 
 from pathlib import Path
 from detectron2.data import build_detection_test_loader, get_detection_dataset_dicts, DatasetMapper
 from detectron2.evaluation import print_csv_format
 from datasets.register_lvis_val_subset import lvis_meta_val_subset # to register the custom lvis_v1_val_subset dataset.
+from datasets.gt_index import register_lvis_from_gt_index
 from segment_anything.utils.transforms import ResizeLongestSide
-from tqdm import tqdm
+from scripts.model_registry import ModelRegistry
+from scripts.model_bundle import ModelBundle
 
 warnings.filterwarnings('ignore', category=UserWarning)
 warnings.filterwarnings('ignore', category=FutureWarning)
 
-Path(outputs_dir).mkdir(parents=True, exist_ok=True)
-
-device = "cuda" if torch.cuda.is_available() else "cpu"
-
-
-model = load_model("cfg/GroundingDINO/GDINO.py", gdino_checkpoint)
-model = model.to(device)
-
-rcnn_model, cfg = load_fully_supervised_trained_model(cfg_file, rcnn_weight_dir)
-
-coco_to_lvis = get_coco_to_lvis_mapping(cfg, lvis_data_split)
-
-clip_model, preprocess, text_features, lvis_classes = load_clip_model(lvis_data_split, device)
-
-sam = load_sam_model(device, sam_checkpoint)
-resize_transform = ResizeLongestSide(sam.image_encoder.img_size)
-
-known_class_ids=[3, 12, 34, 35, 36, 41, 45, 58, 60, 76, 77, 80, 90, 94, 99, 118, 127, 133, 139, 154, 169, 173, 183,
-                         207, 217, 225, 230, 232, 271, 296, 344, 367, 378, 387, 421, 422, 445, 469, 474, 496, 534, 569,
-                         611, 615, 631, 687, 703, 705, 716, 735, 739, 766, 793, 816, 837, 881, 912, 923, 943, 961, 962,
-                         964, 976, 982, 1000, 1019, 1037, 1071, 1077, 1079, 1095, 1097, 1102, 1112, 1115, 1123, 1133,
-                         1139, 1190, 1202]
-
-test_loader = build_detection_test_loader(
-    dataset = get_detection_dataset_dicts(names = lvis_data_split, filter_empty=False),
-    mapper= DatasetMapper(
-        is_train = False,
-        augmentations=[
-            T.ResizeShortestEdge(short_edge_length=800, max_size=1333),
-        ],
-        image_format="BGR", # has to be 'BGR' for MaskRCNN-V2, 'RGB' for MaskRCNN-V1
-    ),
-    num_workers=4,
+def build_model_registry(device):
+    """
+    Models of the pipeline, each loaded on first access (see `scripts/model_registry.py`), from the checkpoints or
+    from the single `model_bundle` file when set (see `build_model_bundle.py`).
+    """
+    bundle = ModelBundle(model_bundle) if model_bundle else None
+
+    registry = ModelRegistry()
+    registry.register(
+        "gdino",
+        lambda: load_gdino_model("cfg/GroundingDINO/GDINO.py", gdino_checkpoint, device, bundle=bundle).to(device),
+    )
+    registry.register("rcnn", lambda: load_fully_supervised_trained_model(cfg_file, rcnn_weight_dir, bundle=bundle))
+    registry.register("clip", lambda: load_clip_model(lvis_data_split, device, bundle=bundle))
+    registry.register("sam", lambda: load_sam_model(device, sam_checkpoint, bundle=bundle))
+    return registry
+
+# settings of `params.json` which do not change the detections
+RESULT_CACHE_IGNORED_PARAMS = (
+    "detectron2_dir", "visualize", "eval_num_workers", "class_subsets_file", "online_eval_period", "stage_cache_dir",
+    "profile_stages", "model_load_workers", "model_bundle", "result_cache_dir", "result_cache_max_gb",
 )
 
-tokenizer = model.tokenizer
-
-text_prompt_list, positive_map_list = get_text_prompt_list_for_g_dino(lvis_data_split, tokenizer, class_len_per_prompt)
-
-discovery_evaluator = CustomEvaluator(
-    evaluator = LVISEvaluatorCustom(
+def build_result_cache(params, cache_dir = None, extra_config = None):
+    """
+    `ResultCache` of `cache_dir` (`result_cache_dir` by default), or None when it is not set. Every setting of
+    `params.json` is part of the keys, but those of `RESULT_CACHE_IGNORED_PARAMS`, and so are the `extra_config` ones.
+    """
+    cache_dir = cache_dir or params["result_cache_dir"]
+    if not cache_dir:
+        return None
+    config = {name: value for name, value in params.items() if name not in RESULT_CACHE_IGNORED_PARAMS}
+    config.update(extra_config or {})
+    return ResultCache(cache_dir, int(params["result_cache_max_gb"] * (1 << 30)), config = config)
+
+def main():
+    Path(outputs_dir).mkdir(parents=True, exist_ok=True)
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    if lvis_data_split != "lvis_v1_val_subset":  # builtin split, load its boxes from the binary ground-truth index
+        register_lvis_from_gt_index(lvis_data_split)
+
+    # the models load in the background while the dataset and the evaluator are prepared
+    registry = build_model_registry(device)
+    registry.preload(max_workers = model_load_workers, wait = False)
+
+    class_subsets = load_class_subsets(os.path.join(script_dir, class_subsets_file))
+
+    test_loader = build_detection_test_loader(
+        dataset = get_detection_dataset_dicts(names = lvis_data_split, filter_empty=False),
+        mapper= DatasetMapper(
+            is_train = False,
+            augmentations=[
+                T.ResizeShortestEdge(short_edge_length=800, max_size=1333),
+            ],
+            image_format="BGR", # has to be 'BGR' for MaskRCNN-V2, 'RGB' for MaskRCNN-V1
+        ),
+        num_workers=4,
+    )
+
+    lvis_evaluator = LVISEvaluatorCustom(
         dataset_name = lvis_data_split,
         distributed = False,
         output_dir = outputs_dir,
-        known_class_ids = known_class_ids,    
-    ),
-)
-
-param_dict = {}
-param_dict["visualize"] = visualize
-param_dict["out_dir"] = outputs_dir
-param_dict["lvis_data_split"] = lvis_data_split
-param_dict["class_len_per_prompt"] = class_len_per_prompt
-param_dict["positive_map_list"] = positive_map_list
-param_dict["rcnn_model"] = rcnn_model
-
-param_dict["clip_model"] = clip_model
-param_dict["preprocess"] = preprocess
-param_dict["text_features"] = text_features
-param_dict["device"] = device
-
-param_dict["coco_to_lvis"] = coco_to_lvis
+        class_subsets = class_subsets,
+        num_workers = eval_num_workers,
+    )
+
+    discovery_evaluator = CustomEvaluator(
+        evaluator = lvis_evaluator,
+        online_evaluator = OnlineLVISEval(lvis_evaluator._lvis_api, class_subsets) if online_eval_period > 0 else None,
+        online_eval_period = online_eval_period,
+    )
+
+    model = registry["gdino"]
+    rcnn_model, cfg = registry["rcnn"]
+    clip_model, preprocess, text_features, lvis_classes = registry["clip"]
+    sam = registry["sam"]
+
+    coco_to_lvis = get_coco_to_lvis_mapping(cfg, lvis_data_split)
+    resize_transform = ResizeLongestSide(sam.image_encoder.img_size)
+
+    tokenizer = model.tokenizer
+
+    text_prompt_list, positive_map_list = get_text_prompt_list_for_g_dino(
+        lvis_data_split, tokenizer, class_len_per_prompt
+    )
+
+    param_dict = {}
+    param_dict["visualize"] = visualize
+    param_dict["out_dir"] = outputs_dir
+    param_dict["lvis_data_split"] = lvis_data_split
+    param_dict["class_len_per_prompt"] = class_len_per_prompt
+    param_dict["positive_map_list"] = positive_map_list
+    param_dict["rcnn_model"] = rcnn_model
+    param_dict["rcnn_box_only"] = rcnn_box_only
+
+    param_dict["clip_model"] = clip_model
+    param_dict["preprocess"] = preprocess
+    param_dict["text_features"] = text_features
+    param_dict["device"] = device
+
+    param_dict["coco_to_lvis"] = coco_to_lvis
+
+    param_dict["sam"] = sam
+    param_dict["resize_transform"] = resize_transform
+
+    param_dict["stage_cache"] = StageOutputCache(stage_cache_dir) if stage_cache_dir else None
+    param_dict["result_cache"] = build_result_cache(params)
+    param_dict["profiler"] = StageProfiler(enabled = profile_stages, num_warmup = 5)
+    param_dict["prefilter"] = ClassPrefilter(
+        clip_model, preprocess, tokenizer, class_len_per_prompt, prefilter_topk, prefilter_grid_size, device
+    ) if prefilter_topk > 0 else None
+    # coarse-to-fine classification of the background crops, see `build_class_clusters.py`
+    param_dict["class_index"] = HierarchicalClassIndex.load(
+        class_clusters_file, text_features, clip_model, class_cluster_probes
+    ) if class_clusters_file else None
 
-param_dict["sam"] = sam
-param_dict["resize_transform"] = resize_transform
-
-if __name__ == "__main__":
     results = inference(test_loader, discovery_evaluator, model, text_prompt_list, param_dict)
     print_csv_format(results)
 
+    # stage_profile.jsonl, stage_profile_trace.json (chrome://tracing) and stage_profile_summary.json
+    param_dict["profiler"].export(outputs_dir)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""
+Edits a `VocabularyStore` (see `vocabulary.py`): classes are added, removed or renamed and the store is saved back
+atomically. Only the new or renamed classes are encoded with SigLIP (the LVIS classes are already known), and only the
+GDINO prompts of the chunks that changed are rebuilt, so that extending a vocabulary of thousands of classes by a few
+costs a few encodings.
+
+Usage, from the project root, with the checkpoints set in `params.json`:
+    python scripts/novel_object_detection/manage_vocabulary.py --store vocabulary.pt --add "license plate" "cone"
+    python scripts/novel_object_detection/manage_vocabulary.py --store vocabulary.pt --add-file new_classes.txt
+    python scripts/novel_object_detection/manage_vocabulary.py --store vocabulary.pt --remove "cone"
+    python scripts/novel_object_detection/manage_vocabulary.py --store vocabulary.pt --rename "license plate=plate"
+The store is then used with `inference_single_image.py --vocabulary-store vocabulary.pt`.
+"""
+import os
+import sys
+import argparse
+import time
+
+proj_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../"))
+sys.path.append(proj_path)
+
+import open_clip
+import torch
+
+from main import build_model_registry, class_len_per_prompt
+from vocabulary import VocabularyBuilder, VocabularyStore
+
+
+def read_classes(path):
+    with open(path, "r") as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Incremental edits of a vocabulary store")
+    parser.add_argument("--store", type=str, required=True, help="store file, created if it does not exist")
+    parser.add_argument("--add", type=str, nargs="+", default=[])
+    parser.add_argument("--add-file", type=str, default=None, help="classes to add, one per line")
+    parser.add_argument("--remove", type=str, nargs="+", default=[])
+    parser.add_argument("--rename", type=str, nargs="+", default=[], help="old=new pairs")
+    parser.add_argument("--clip-model-name", type=str, default="ViT-SO400M-14-SigLIP")
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    registry = build_model_registry(device)
+    clip_model, _, text_features, lvis_classes = registry["clip"]
+    builder = VocabularyBuilder(
+        clip_model,
+        open_clip.get_tokenizer(args.clip_model_name),
+        registry["gdino"].tokenizer,
+        device,
+        class_len_per_prompt,
+    )
+    builder.add_embeddings(lvis_classes, text_features)
+
+    store = VocabularyStore(builder, args.store)
+    num_classes = len(store)
+    start_time = time.perf_counter()
+
+    if args.remove:
+        store.remove(args.remove)
+    if args.rename:
+        store.rename(dict(pair.split("=", 1) for pair in args.rename))
+    added = args.add + (read_classes(args.add_file) if args.add_file else [])
+    if added:
+        store.add([class_name for class_name in added if class_name not in store])
+
+    store.save()
+    print("{}: {} -> {} classes in {} prompts, {} classes encoded, {} prompts rebuilt, {:.1f}s".format(
+        args.store, num_classes, len(store), len(store.chunks), store.num_encoded, store.num_prompts_built,
+        time.perf_counter() - start_time,
+    ))
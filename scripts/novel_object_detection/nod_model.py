@@ -1,22 +1,36 @@
 from __future__ import annotations
 
+import glob
 import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from pathlib import Path
 
 import numpy as np
+import open_clip
 import transforms as T2
 import torch
 import cv2
 import detectron2.data.transforms as T
-from sklearn.preprocessing import MinMaxScaler
 from PIL import Image
 from detectron2.data import MetadataCatalog
+from detectron2.data.catalog import Metadata
 from detectron2.structures import Instances, Boxes
 from torch import nn
 from torchvision.ops import box_convert
 from segment_anything.utils.amg import batched_mask_to_box
 
-from utils import BBoxVisualizer, get_clip_preds, read_image
+from utils import BBoxVisualizer, encode_clip_images, classify_clip_features, read_image
+from stage_outputs import fuse_stage_outputs
+from profiling import StageProfiler
+from sharding import shard_ranges, merge_topk
+from vocabulary import Vocabulary, VocabularyBuilder, VocabularyStore
+from class_index import build_class_index
+from tiling import tile_windows, merge_tile_detections
+from video_stream import NODVideoStream
+from result_cache import file_digest, array_digest
+from groundingdino.util.misc import NestedTensor, nested_tensor_from_tensor_list
 
 
 def prepare_image_for_GDINO(input, device = "cuda"):
@@ -32,13 +46,25 @@ def prepare_image_for_GDINO(input, device = "cuda"):
         ]
     )
     
-    image_src = Image.open(input["file_name"]).convert("RGB")
+    if "original_image" in input:
+        image_src = Image.fromarray(input["original_image"])
+    else:
+        image_src = Image.open(input["file_name"]).convert("RGB")
     image = np.asarray(image_src)
     image_transformed, _ = transform(image_src, None)
     image_transformed = image_transformed.to(device)
     return image_transformed[None], image
 
     
+def prompt_of_labels(labels, positive_map_list):
+    """
+    Index of the prompt of every label of the concatenated `positive_map_list`; the prompts may have different numbers
+    of classes (see `VocabularyStore`), with `class_len_per_prompt` classes each it is `labels // class_len_per_prompt`.
+    """
+    prompt_ends = torch.tensor([len(positive_map) for positive_map in positive_map_list]).cumsum(0)
+    return torch.searchsorted(prompt_ends, labels, right = True)
+
+
 class NOD:
     def __init__(self, param_dict: dict, gdino_model):
         self.gdino_model = gdino_model
@@ -52,6 +78,8 @@ class NOD:
         self.clip_model = param_dict["clip_model"]
         self.preprocess = param_dict["preprocess"]
         self.text_features = param_dict["text_features"]
+        # optional index of `text_features` the crops are classified with, see `class_index.py`
+        self.class_index = param_dict.get("class_index")
         self.device = param_dict["device"]
         self.coco_to_lvis = param_dict["coco_to_lvis"]
 
@@ -59,6 +87,36 @@ class NOD:
         self.sam = param_dict["sam"]
         self.resize_transform = param_dict["resize_transform"]
 
+        self.profiler = param_dict.get("profiler") or StageProfiler(enabled = False)
+
+        # custom vocabularies, see `build_vocabulary`
+        self.clip_model_name = param_dict.get("clip_model_name", "ViT-SO400M-14-SigLIP")
+        self.vocabulary_builder = None
+
+        # optional `ClassPrefilter`: GDINO is only prompted with the likely classes of every image
+        self.prefilter = param_dict.get("prefilter")
+
+        # the prompts of one image and the CLIP classification run as `vocabulary_shards` parallel shards, see
+        # `sharding.py`; on CPU, torch.set_num_threads(cores // vocabulary_shards) avoids oversubscription
+        self.vocabulary_shards = param_dict.get("vocabulary_shards", 1)
+        self._shard_executor = None
+        if self.vocabulary_shards > 1:
+            self._shard_executor = ThreadPoolExecutor(self.vocabulary_shards, thread_name_prefix = "vocabulary_shard")
+
+        # images larger than `tile_size` (0: never) are run as overlapping tiles, `tile_batch_size` at a time, see
+        # `tiling.py`
+        self.tile_size = param_dict.get("tile_size", 0)
+        self.tile_overlap = param_dict.get("tile_overlap", 256)
+        self.tile_batch_size = param_dict.get("tile_batch_size", 4)
+        self.tile_max_detections = param_dict.get("tile_max_detections", 1000)
+
+        # optional `ResultCache`: the detections of an image seen before are returned without running the pipeline
+        self.result_cache = param_dict.get("result_cache")
+
+        # optional `StageOutputCache`: the raw outputs of every stage are saved under the "image_id" of their input, for
+        # offline re-fusion (see `stage_outputs.py`)
+        self.stage_cache = param_dict.get("stage_cache")
+
         self.rcnn_model.eval()
 
         if not isinstance(self.rcnn_model.roi_heads.box_predictor, nn.ModuleList):  # baseline, non-centernet
@@ -79,6 +137,10 @@ class NOD:
             box_predictor.test_nms_thresh = 0.5
             box_predictor.test_score_thresh = 0.0001
 
+        # only the boxes, scores and classes are used: without `mask_on`, `StandardROIHeads` skips the mask pooling
+        # and the mask head, the boxes are the same
+        self.rcnn_model.roi_heads.mask_on = not param_dict.get("rcnn_box_only", True)
+
     @torch.no_grad()
     def infer(
         self,
@@ -87,24 +149,321 @@ class NOD:
         visualize: bool = True,
         out_dir: Path | None = None,
         confidence_threshold: float = 0.5,
+        image: np.ndarray | None = None,
+        vocabulary: Vocabulary | None = None,
+        image_digest: str | None = None,
+    ):
+        """
+        Detections of one image, read from `image_path` unless the decoded RGB `image` is given (`image_path` then
+        only names the image). With a `vocabulary` (see `vocabulary.py`), its prompts replace `text_prompt_list` and
+        the labels are indices in `vocabulary.class_names` instead of LVIS ids. With a `self.prefilter`, the prompts are
+        those of the likely classes of the vocabulary (LVIS by default) and `text_prompt_list` is ignored. Images larger
+        than `self.tile_size` are run with `infer_tiled`. With a `self.result_cache`, the detections of an image with
+        the same bytes and prompts are returned from the cache; a caller giving the decoded `image` of a file passes
+        the `file_digest` of its bytes as `image_digest`, so that the key is the same as that of the file. Returns a
+        list with one dict with key "instances".
+        """
+        cache_key = None
+        if self.result_cache is not None:
+            cache_key = self.result_cache_key(image_path, image, text_prompt_list, vocabulary, image_digest)
+            instances = self.result_cache.get(cache_key)
+            if instances is not None:
+                if visualize:
+                    if image is None:
+                        image = read_image(image_path, format = "RGB")
+                    input = {"original_image": image, "file_name": os.path.abspath(image_path)}
+                    self.visualize(input, instances, out_dir, confidence_threshold, vocabulary)
+                return [{"instances": instances}]
+
+        if self.tile_size > 0 and image is None:
+            image = read_image(image_path, format = "RGB")
+        if self.tile_size > 0 and max(image.shape[:2]) > self.tile_size:
+            outputs = self.infer_tiled(
+                image_path, text_prompt_list, visualize, out_dir, confidence_threshold, image = image,
+                vocabulary = vocabulary,
+            )
+        else:
+            outputs = self.infer_batch(
+                [image_path], [text_prompt_list], visualize, out_dir, confidence_threshold, images = [image],
+                vocabularies = [vocabulary],
+            )
+
+        if cache_key is not None:
+            self.result_cache.put(cache_key, outputs[0]["instances"])
+        return outputs
+
+    def result_cache_key(self, image_path, image, text_prompt_list, vocabulary = None, image_digest = None):
+        """
+        `self.result_cache` key of the detections of an image: the hash `image_digest` of its encoded bytes (that of
+        the file `image_path` when it is not given), the prompts or the vocabulary, and the settings of `NOD` the
+        detections depend on. The hash of the decoded pixels is only used for an `image` without encoded bytes, whose
+        key can not match that of a file.
+        """
+        if image_digest is None:
+            image_digest = array_digest(image) if image is not None else file_digest(image_path)
+        if vocabulary is not None:
+            prompts = (vocabulary.fingerprint, getattr(vocabulary.class_index, "kind", None))
+        else:
+            prompts = (list(text_prompt_list), type(self.class_index).__name__)
+        settings = (
+            self.lvis_data_split,
+            self.prefilter.topk if self.prefilter is not None else 0,
+            self.prefilter.grid_size if self.prefilter is not None else 0,
+            self.tile_size, self.tile_overlap, self.tile_max_detections,
+        )
+        return self.result_cache.key(image_digest, prompts, settings)
+
+    @torch.no_grad()
+    def infer_batch(
+        self,
+        image_paths: list[str],
+        text_prompt_lists: list[list[str]],
+        visualize: bool = False,
+        out_dir: Path | None = None,
+        confidence_threshold: float = 0.5,
+        images: list[np.ndarray | None] | None = None,
+        vocabularies: list[Vocabulary | None] | None = None,
+        return_stage_outputs: bool = False,
+    ):
+        """
+        Same as `infer` for several images, each with its own prompts or vocabulary. Every stage runs once for the
+        whole batch: the RCNN and the SAM image encoder on batched images, CLIP on the crops of all images and GDINO on
+        all (image, prompt) pairs. Images of different sizes are zero-padded to a common size for RCNN and GDINO, as in
+        training.
+
+        Returns:
+            list[dict]: one dict with key "instances" per image, and "stage_outputs" with `return_stage_outputs`: the
+                raw outputs of every stage before the fusion (see `stage_outputs.py`)
+        """
+        if images is None:
+            images = [None] * len(image_paths)
+        inputs = [
+            self.prepare_inputs(image_path, image = image)[0] for image_path, image in zip(image_paths, images)
+        ]
+        return self.infer_inputs(
+            inputs, text_prompt_lists, visualize, out_dir, confidence_threshold, vocabularies, return_stage_outputs
+        )
+
+    @torch.no_grad()
+    def infer_inputs(
+        self,
+        inputs: list[dict],
+        text_prompt_lists: list[list[str]],
+        visualize: bool = False,
+        out_dir: Path | None = None,
+        confidence_threshold: float = 0.5,
+        vocabularies: list[Vocabulary | None] | None = None,
+        return_stage_outputs: bool = False,
     ):
-        inputs = self.prepare_inputs(image_path)
+        """
+        Same as `infer_batch` for inputs already prepared, by `prepare_inputs` or by the `DatasetMapper` of an
+        evaluation loader, with the decoded RGB image as "original_image".
+        """
+        if vocabularies is None:
+            vocabularies = [None] * len(inputs)
+        text_prompt_lists = [
+            vocabulary.text_prompt_list if vocabulary is not None else text_prompt_list
+            for text_prompt_list, vocabulary in zip(text_prompt_lists, vocabularies)
+        ]
+        profiler = self.profiler
+        profiler.start_image(", ".join(input["file_name"] for input in inputs))
 
+        stage_outputs = self.run_rcnn(inputs)
+        for outputs, vocabulary in zip(stage_outputs, vocabularies):
+            outputs["rcnn_boxes"], outputs["rcnn_scores"], outputs["rcnn_classes"], _ = self.map_known_classes(
+                outputs["rcnn_boxes"], outputs["rcnn_scores"], outputs.pop("rcnn_coco_classes"), vocabulary
+            )
+        profiler.mark(
+            "rcnn",
+            num_boxes = sum(len(outputs["rcnn_boxes"]) + len(outputs["bg_boxes"]) for outputs in stage_outputs),
+            num_background_boxes = sum(len(outputs["bg_boxes"]) for outputs in stage_outputs),
+        )
+
+        crops = [self.extract_crops(input, outputs.pop("bg_boxes")) for input, outputs in zip(inputs, stage_outputs)]
+        profiler.mark("crop_extraction", num_crops = sum(len(crop_boxes) for _, crop_boxes in crops))
+
+        clip_preds = self.classify_crops(self.encode_crops([crop_images for crop_images, _ in crops]), vocabularies)
+        for outputs, (_, crop_boxes), (clip_scores, clip_classes) in zip(stage_outputs, crops, clip_preds):
+            outputs["clip_boxes"] = crop_boxes
+            outputs["clip_scores"] = clip_scores
+            outputs["clip_classes"] = clip_classes
+        profiler.mark("clip_encode", num_crops = sum(len(outputs["clip_boxes"]) for outputs in stage_outputs))
+
+        prompt_classes = None
+        if self.prefilter is not None:
+            view_features = self.prefilter.encode_views([input["original_image"] for input in inputs])
+            text_prompt_lists, prompt_classes = self.prefilter_prompts(view_features, stage_outputs, vocabularies)
+            profiler.mark("prefilter", num_classes = sum(len(class_ids) for _, class_ids in prompt_classes))
+
+        gdino_outputs = self.run_gdino(
+            inputs, text_prompt_lists, vocabularies = vocabularies, prompt_classes = prompt_classes
+        )
+        for outputs, (gdino_boxes, gdino_scores, gdino_classes) in zip(stage_outputs, gdino_outputs):
+            outputs["gdino_boxes"] = gdino_boxes
+            outputs["gdino_scores"] = gdino_scores
+            outputs["gdino_classes"] = gdino_classes
+        profiler.mark(
+            "gdino",
+            num_prompts = sum(len(text_prompt_list) for text_prompt_list in text_prompt_lists),
+            num_boxes = sum(len(outputs["gdino_boxes"]) for outputs in stage_outputs),
+        )
+
+        image_embeddings, sam_images = self.encode_sam(inputs)
+        profiler.mark("sam_encoder")
+
+        num_prompts = 0
+        for input, outputs, image_embedding, sam_image in zip(inputs, stage_outputs, image_embeddings, sam_images):
+            boxes = torch.cat([outputs["rcnn_boxes"], outputs["clip_boxes"], outputs["gdino_boxes"]], dim = 0)
+            outputs["sam_boxes"], outputs["sam_scores"] = self.refine_boxes_with_sam(
+                image_embedding[None], sam_image, boxes, (input["height"], input["width"])
+            )
+            num_prompts += len(boxes)
+        profiler.mark("sam_decoder", num_prompts = num_prompts)
+
+        if self.stage_cache is not None:
+            for input, outputs in zip(inputs, stage_outputs):
+                self.stage_cache.save(input["image_id"], (input["height"], input["width"]), outputs)
+            profiler.mark("stage_cache")
+
+        final_outputs = []
+        for input, outputs in zip(inputs, stage_outputs):
+            boxes, scores, labels = fuse_stage_outputs(outputs, topk = 300)
+
+            result = Instances((input["height"], input["width"]))
+            result.pred_boxes = Boxes(boxes)
+            result.scores = scores
+            result.pred_classes = labels
+            final_outputs.append({"instances": result})
+            if return_stage_outputs:
+                final_outputs[-1]["stage_outputs"] = outputs
+        profiler.mark(
+            "fusion",
+            num_candidates = sum(len(outputs["sam_scores"]) for outputs in stage_outputs),
+            num_kept = sum(len(output["instances"]) for output in final_outputs),
+        )
+
+        if visualize:
+            for input, output, vocabulary in zip(inputs, final_outputs, vocabularies):
+                self.visualize(input, output["instances"], out_dir, confidence_threshold, vocabulary)
+            profiler.mark("visualization")
+
+        profiler.end_image()
+        return final_outputs
+
+    @torch.no_grad()
+    def infer_tiled(
+        self,
+        image_path: str,
+        text_prompt_list: list[str] = ["dog ."],
+        visualize: bool = True,
+        out_dir: Path | None = None,
+        confidence_threshold: float = 0.5,
+        image: np.ndarray | None = None,
+        vocabulary: Vocabulary | None = None,
+    ):
+        """
+        Same as `infer` for a high-resolution image: the pipeline runs on the whole image and on its overlapping
+        windows of `self.tile_size` pixels (see `tiling.py`), `self.tile_batch_size` windows of the same size per
+        `infer_batch`, so that the memory does not grow with the image, and the detections of all views are merged by
+        class-wise NMS into at most `self.tile_max_detections`.
+        """
+        if image is None:
+            image = read_image(image_path, format = "RGB")
+        height, width = image.shape[:2]
+        windows = [(0, 0, width, height)]
+        if 0 < self.tile_size < max(height, width):
+            windows += tile_windows(height, width, self.tile_size, self.tile_overlap)
+
+        # the whole image is a batch of its own and the windows are batched with those of the same size (the inner
+        # windows and the smaller ones along the right and bottom borders), so that no view is padded to another
+        windows_by_size = OrderedDict()
+        for idx, (x0, y0, x1, y1) in enumerate(windows[1:], start = 1):
+            windows_by_size.setdefault((y1 - y0, x1 - x0), []).append(idx)
+        batches = [[0]] + [
+            idxs[start:start + self.tile_batch_size]
+            for idxs in windows_by_size.values()
+            for start in range(0, len(idxs), self.tile_batch_size)
+        ]
+
+        detections = [None] * len(windows)
+        for batch in batches:
+            batch_windows = [windows[idx] for idx in batch]
+            outputs = self.infer_batch(
+                [image_path] * len(batch_windows),
+                [text_prompt_list] * len(batch_windows),
+                visualize = False,
+                images = [np.ascontiguousarray(image[y0:y1, x0:x1]) for x0, y0, x1, y1 in batch_windows],
+                vocabularies = [vocabulary] * len(batch_windows),
+            )
+            for idx, output in zip(batch, outputs):
+                instances = output["instances"]
+                detections[idx] = (instances.pred_boxes.tensor, instances.scores, instances.pred_classes)
+
+        boxes, scores, labels = merge_tile_detections(
+            detections, windows, (height, width), max_detections = self.tile_max_detections
+        )
+        result = Instances((height, width))
+        result.pred_boxes = Boxes(boxes)
+        result.scores = scores
+        result.pred_classes = labels
+
+        if visualize:
+            input = {"original_image": image, "file_name": os.path.abspath(image_path)}
+            self.visualize(input, result, out_dir, confidence_threshold, vocabulary)
+        return [{"instances": result}]
+
+    def run_rcnn(self, inputs):
+        """
+        Runs the RCNN on a batch of `prepare_inputs` dicts.
+
+        Returns:
+            list[dict]: per image, the known-class detections "rcnn_boxes", "rcnn_scores", "rcnn_coco_classes" (see
+                `map_known_classes`) and the boxes of the background class 80, "bg_boxes", all on cpu
+        """
         outputs = self.rcnn_model(inputs)
-        rcnn_boxes = outputs[0]["instances"].pred_boxes.tensor.to("cpu") # format: (x1, y1, x2, y2)
-        rcnn_scores = outputs[0]["instances"].scores.to("cpu")
-        rcnn_classes = outputs[0]["instances"].pred_classes.to("cpu")
 
-        bg_boxes_idxs = rcnn_classes == 80
-        bg_boxes = rcnn_boxes[bg_boxes_idxs].to("cpu")
+        stage_outputs = []
+        for output in outputs:
+            rcnn_boxes = output["instances"].pred_boxes.tensor.to("cpu") # format: (x1, y1, x2, y2)
+            rcnn_scores = output["instances"].scores.to("cpu")
+            rcnn_classes = output["instances"].pred_classes.to("cpu")
+
+            bg_boxes_idxs = rcnn_classes == 80
 
-        known_boxes = rcnn_boxes[~bg_boxes_idxs].to("cpu")
-        known_scores = rcnn_scores[~bg_boxes_idxs].to("cpu")
-        known_classes = rcnn_classes[~bg_boxes_idxs].to("cpu")
+            stage_outputs.append({
+                "rcnn_boxes": rcnn_boxes[~bg_boxes_idxs],
+                "rcnn_scores": rcnn_scores[~bg_boxes_idxs],
+                "rcnn_coco_classes": rcnn_classes[~bg_boxes_idxs],
+                "bg_boxes": rcnn_boxes[bg_boxes_idxs],
+            })
+        return stage_outputs
 
-        known_classes = torch.tensor([self.coco_to_lvis[coco_class.item()] for coco_class in known_classes])
+    def map_known_classes(self, boxes, scores, coco_classes, vocabulary = None):
+        """
+        Maps the known RCNN classes to LVIS ids, or to the indices of `vocabulary`, whose classes the RCNN does not know
+        are dropped.
 
-        img = inputs[0]['image']
+        Returns:
+            boxes, scores, classes of the kept detections, and the (N,) mask of the kept detections
+        """
+        if vocabulary is None:
+            classes = self.coco_to_lvis(coco_classes)
+            keep = torch.ones(len(classes), dtype = torch.bool)
+        else:
+            classes = vocabulary.coco_to_vocab[coco_classes]
+            keep = classes >= 0
+        return boxes[keep], scores[keep], classes[keep], keep
+
+    def extract_crops(self, input, bg_boxes):
+        """
+        Crops of the boxes `bg_boxes` (original image coordinates) from the resized image of `input`, preprocessed
+        for CLIP. Empty crops are dropped.
+
+        Returns:
+            crop_images (Tensor): (N, 3, H, W) on `self.device`
+            crop_boxes (Tensor): (N, 4), the boxes of the kept crops
+        """
+        img = input['image']
         new_height = img.shape[1]
         new_width = img.shape[2]
         object_crop_1x_list = []
@@ -112,11 +471,11 @@ class NOD:
         for bbox_idx, bbox in enumerate(bg_boxes):
             x1, y1, x2, y2 = bbox
 
-            x1 = int(x1 * new_width / inputs[0]['width'])
-            x2 = int(x2 * new_width / inputs[0]['width'])
+            x1 = int(x1 * new_width / input['width'])
+            x2 = int(x2 * new_width / input['width'])
 
-            y1 = int(y1 * new_height / inputs[0]['height'])
-            y2 = int(y2 * new_height / inputs[0]['height'])
+            y1 = int(y1 * new_height / input['height'])
+            y2 = int(y2 * new_height / input['height'])
 
             cropped_image = img[:, y1:y2, x1:x2]
             cropped_img_arr = cropped_image.permute(1, 2, 0).numpy()
@@ -128,139 +487,332 @@ class NOD:
 
                 object_crop_1x_list.append(image)
                 selected_idx.append(bbox_idx)
-    
-        selected_idx = torch.tensor(selected_idx)
-        cropped_img_arr = torch.cat(object_crop_1x_list, dim = 0)
-        scores_clip, indices_clip = get_clip_preds(cropped_img_arr, self.clip_model, self.text_features)
 
-        bg_boxes = bg_boxes[selected_idx]
-        bg_scores = scores_clip.squeeze(1).to("cpu")
-        bg_classes = indices_clip.squeeze(1).to("cpu")
+        selected_idx = torch.tensor(selected_idx, dtype = torch.int64)
+        if len(object_crop_1x_list) > 0:
+            crop_images = torch.cat(object_crop_1x_list, dim = 0)
+        else:
+            crop_images = torch.zeros((0, 3, 1, 1), device = self.device)
+        return crop_images, bg_boxes[selected_idx]
+
+    def encode_crops(self, crop_images_list):
+        """
+        CLIP embeddings of the crops of several images, encoded in a single batch.
 
-        combined_rcnn_boxes = torch.cat([known_boxes, bg_boxes], dim = 0)
-        combined_rcnn_scores = torch.cat([known_scores, bg_scores], dim = 0)
-        combined_rcnn_classes = torch.cat([known_classes, bg_classes], dim = 0)
+        Returns:
+            list[Tensor]: per image, the (N, D) normalized embeddings of its crops, or None if no image has a crop
+        """
+        num_crops = [len(crop_images) for crop_images in crop_images_list]
+        if sum(num_crops) == 0:  # no background box to classify
+            return [None] * len(crop_images_list)
+        crop_images = torch.cat([crop_images for crop_images in crop_images_list if len(crop_images) > 0], dim = 0)
+        return list(encode_clip_images(crop_images, self.clip_model).split(num_crops))
 
-        image, image_src = prepare_image_for_GDINO(inputs[0])
-        image = image.repeat(len(text_prompt_list), 1, 1, 1)
-        with torch.no_grad():
-            output = self.gdino_model(image, captions = text_prompt_list)
+    def classify_crops(self, crop_features_list, vocabularies = None):
+        """
+        CLIP top-1 class of the crop embeddings of several images, against `self.text_features` or the text features
+        of the vocabulary of each image.
+
+        Returns:
+            list[tuple[Tensor, Tensor]]: per image, the (N,) scores and (N,) LVIS classes of its crops, on cpu
+        """
+        if vocabularies is None:
+            vocabularies = [None] * len(crop_features_list)
+
+        clip_preds = []
+        for crop_features, vocabulary in zip(crop_features_list, vocabularies):
+            if crop_features is None or len(crop_features) == 0:
+                clip_preds.append((torch.zeros((0,)), torch.zeros((0,), dtype = torch.int64)))
+                continue
+            text_features = vocabulary.text_features if vocabulary is not None else self.text_features
+            class_index = vocabulary.class_index if vocabulary is not None else self.class_index
+            if class_index is not None:
+                scores_clip, indices_clip = class_index.search(crop_features, 1)
+            elif self._shard_executor is not None:
+                scores_clip, indices_clip = self._classify_crops_sharded(crop_features, text_features)
+            else:
+                scores_clip, indices_clip = classify_clip_features(crop_features, self.clip_model, text_features)
+            clip_preds.append((scores_clip.squeeze(1).to("cpu"), indices_clip.squeeze(1).to("cpu")))
+        return clip_preds
+
+    def _classify_crops_sharded(self, crop_features, text_features):
+        """Same as `classify_clip_features`, with the rows of `text_features` split in blocks scored in parallel."""
+        ranges = shard_ranges(len(text_features), self.vocabulary_shards)
+        partial_preds = list(self._shard_executor.map(
+            lambda shard: classify_clip_features(crop_features, self.clip_model, text_features[shard[0]:shard[1]]),
+            ranges,
+        ))
+        values = torch.cat([values for values, _ in partial_preds], dim = 1)
+        indices = torch.cat([indices + start for (_, indices), (start, _) in zip(partial_preds, ranges)], dim = 1)
+        values, indices, _ = merge_topk(values, indices, 1)
+        return values, indices
+
+    def prefilter_prompts(self, view_features_list, stage_outputs, vocabularies = None):
+        """
+        Prompts of the classes `self.prefilter` selects for every image, from the embeddings of its views and the
+        classes of its RCNN and CLIP detections.
+
+        Returns:
+            text_prompt_lists (list[list[str]])
+            prompt_classes (list[tuple[list[Tensor], Tensor]]): per image, the positive maps of its prompts and the
+                vocabulary ids of their classes, for `run_gdino`
+        """
+        if vocabularies is None:
+            vocabularies = [None] * len(view_features_list)
+
+        text_prompt_lists = []
+        prompt_classes = []
+        for view_features, outputs, vocabulary in zip(view_features_list, stage_outputs, vocabularies):
+            if vocabulary is not None:
+                class_names, text_features = vocabulary.class_names, vocabulary.text_features
+            else:
+                class_names, text_features = MetadataCatalog.get(self.lvis_data_split).thing_classes, self.text_features
+            class_ids = self.prefilter.select(
+                view_features,
+                text_features,
+                torch.cat([outputs["rcnn_classes"], outputs["clip_classes"]]),
+                torch.cat([outputs["rcnn_scores"], outputs["clip_scores"]]),
+            )
+            text_prompt_list, positive_map_list = self.prefilter.prompts(class_names, class_ids)
+            text_prompt_lists.append(text_prompt_list)
+            prompt_classes.append((positive_map_list, class_ids))
+        return text_prompt_lists, prompt_classes
+
+    def run_gdino(
+        self, inputs, text_prompt_lists, topk = 300, backbone_cache = None, vocabularies = None, prompt_classes = None
+    ):
+        """
+        Runs GDINO once on every (image, prompt) pair of the batch, prompt `i` of an image being matched with
+        `self.positive_map_list[i]`, or with that of its vocabulary. For a single image, the image backbone features
+        can be computed once and kept in the dict `backbone_cache` for the next calls on the same image (see
+        `_CachedGDINOBackbone`). The prompts of `prefilter_prompts` are matched with their `prompt_classes` instead,
+        and their labels mapped to vocabulary ids. With `vocabulary_shards` > 1, the prompts of a single image are
+        split into shards run in parallel (see `_run_gdino_sharded`).
+
+        Returns:
+            list[tuple[Tensor, Tensor, Tensor]]: per image, the boxes (original image coordinates), scores and labels
+                of its `topk` best (query, class) pairs, on cpu
+        """
+        if vocabularies is None:
+            vocabularies = [None] * len(inputs)
+        if self._shard_executor is not None and len(inputs) == 1 and len(text_prompt_lists[0]) > 1:
+            positive_map_list, class_ids = self._gdino_classes(
+                vocabularies[0], prompt_classes[0] if prompt_classes is not None else None
+            )
+            boxes, scores, labels = self._run_gdino_sharded(
+                inputs[0], text_prompt_lists[0], positive_map_list, topk, backbone_cache
+            )
+            return [(boxes, scores, labels if class_ids is None else class_ids[labels])]
+
+        images = []
+        captions = []
+        for input, text_prompt_list in zip(inputs, text_prompt_lists):
+            image, _ = prepare_image_for_GDINO(input, device = self.device)
+            images.extend([image[0]] * len(text_prompt_list))
+            captions.extend(text_prompt_list)
+        if len(set(tuple(image.shape) for image in images)) == 1:
+            images = torch.stack(images, dim = 0)
+        else:
+            # GDINO only pads a tensor or list after reading `samples.device`, images of different sizes are padded
+            # here, with the mask of their padding
+            images = nested_tensor_from_tensor_list(images)
 
-        out_logits = output["pred_logits"]  # prediction_logits.shape = (batch, nq, 256)
-        out_bbox = output["pred_boxes"] # prediction_boxes.shape = (batch, nq, 4)
-        prob_to_token = out_logits.sigmoid() # prob_to_token.shape = (batch, nq, 256)
+        backbone = self.gdino_model.backbone
+        if backbone_cache is not None:
+            assert len(inputs) == 1, "the backbone features can only be cached for a single image"
+            self.gdino_model.backbone = _CachedGDINOBackbone(backbone, backbone_cache)
+        try:
+            output = self.gdino_model(images, captions = captions)
+        finally:
+            self.gdino_model.backbone = backbone
+
+        gdino_outputs = []
+        start = 0
+        for input, text_prompt_list, vocabulary in zip(inputs, text_prompt_lists, vocabularies):
+            end = start + len(text_prompt_list)
+            out_logits = output["pred_logits"][start:end]  # prediction_logits.shape = (num_prompts, nq, 256)
+            out_bbox = output["pred_boxes"][start:end] # prediction_boxes.shape = (num_prompts, nq, 4)
+            positive_map_list, class_ids = self._gdino_classes(
+                vocabulary, prompt_classes[len(gdino_outputs)] if prompt_classes is not None else None
+            )
+            boxes, scores, labels = self._gdino_topk(
+                out_logits, out_bbox, input['height'], input['width'], topk, positive_map_list
+            )
+            if class_ids is not None:
+                labels = class_ids[labels]
+            gdino_outputs.append((boxes, scores, labels))
+            start = end
+        return gdino_outputs
+
+    def _gdino_classes(self, vocabulary, prompt_classes = None):
+        """Positive maps of the prompts of an image and vocabulary ids of their labels (None: labels are the ids)."""
+        if prompt_classes is not None:
+            return prompt_classes
+        if vocabulary is not None:
+            return vocabulary.positive_map_list, None
+        return self.positive_map_list, None
+
+    def _run_gdino_sharded(self, input, text_prompt_list, positive_map_list, topk, backbone_cache = None):
+        """
+        `run_gdino` for one image, with its prompts split into `vocabulary_shards` groups of whole prompts run by
+        parallel GDINO calls, each keeping the `topk` best (query, class) pairs of its classes; `merge_topk` then
+        returns the same top `topk` as `_gdino_topk`. The image backbone features are computed once for all shards.
+        """
+        image, _ = prepare_image_for_GDINO(input, device = self.device)
+        ranges = shard_ranges(len(text_prompt_list), self.vocabulary_shards)
+
+        backbone = self.gdino_model.backbone
+        self.gdino_model.backbone = _CachedGDINOBackbone(backbone, {} if backbone_cache is None else backbone_cache)
+        try:
+            partial_outputs = list(self._shard_executor.map(
+                lambda shard: self._gdino_shard_topk(
+                    image, text_prompt_list[shard[0]:shard[1]], positive_map_list[shard[0]:shard[1]], topk
+                ),
+                ranges,
+            ))
+        finally:
+            self.gdino_model.backbone = backbone
+
+        # shards are whole prompts, the first class of a shard is that of its first prompt
+        prompt_lengths = torch.tensor([len(positive_map) for positive_map in positive_map_list])
+        prompt_offsets = [0] + prompt_lengths.cumsum(0).tolist()
+        num_classes = prompt_offsets[-1]
+        class_offsets = [prompt_offsets[start] for start, _ in ranges]
+        values = torch.cat([values for values, _, _, _ in partial_outputs])
+        queries = torch.cat([queries for _, queries, _, _ in partial_outputs])
+        labels = torch.cat([labels + offset for (_, _, labels, _), offset in zip(partial_outputs, class_offsets)])
+        boxes = torch.cat([boxes for _, _, _, boxes in partial_outputs])
+
+        # index of the (query, class) pair in the flattened (nq, num_classes) matrix of `_gdino_topk`
+        scores, _, positions = merge_topk(values, queries * num_classes + labels, topk)
+        h, w = input['height'], input['width']
+        boxes = boxes[positions] * torch.Tensor([w, h, w, h])
+        boxes = box_convert(boxes = boxes, in_fmt = "cxcywh", out_fmt = "xyxy")
+        return boxes, scores, labels[positions]
+
+    @torch.no_grad()  # runs in a shard thread, where the `no_grad` of the caller does not apply
+    def _gdino_shard_topk(self, image, captions, positive_map_list, topk):
+        """Top `topk` (score, query, shard class, cxcywh box) of one shard of prompts."""
+        output = self.gdino_model(image.repeat(len(captions), 1, 1, 1), captions = captions)
+        prob_to_token = output["pred_logits"].sigmoid()
+        prob_to_label = torch.cat([
+            (prob_to_token[i] @ positive_map_list[i].to(prob_to_token.device).T).to("cpu")
+            for i in range(prob_to_token.shape[0])
+        ], dim = 1)
+        values, idxs = torch.topk(prob_to_label.view(-1), min(topk, prob_to_label.numel()), 0)
+        queries = idxs // prob_to_label.shape[1]
+        labels = idxs % prob_to_label.shape[1]
+        boxes = output["pred_boxes"][prompt_of_labels(labels, positive_map_list), queries].to("cpu")
+        return values, queries, labels, boxes
+
+    def _gdino_topk(self, out_logits, out_bbox, h, w, topk, positive_map_list):
+        prob_to_token = out_logits.sigmoid() # prob_to_token.shape = (num_prompts, nq, 256)
 
         prob_to_label_list = []
         for i in range(prob_to_token.shape[0]):
             # (nq, 256) @ (num_categories, 256).T -> (nq, num_categories)
-            curr_prob_to_label = prob_to_token[i] @ self.positive_map_list[i].to(prob_to_token.device).T
+            curr_prob_to_label = prob_to_token[i] @ positive_map_list[i].to(prob_to_token.device).T
             prob_to_label_list.append(curr_prob_to_label.to("cpu"))
 
         prob_to_label = torch.cat(prob_to_label_list, dim = 1) # shape: (nq, 1203)
         topk_values, topk_idxs = torch.topk(
-            prob_to_label.view(-1), 300, 0
+            prob_to_label.view(-1), min(topk, prob_to_label.numel()), 0
         )
         #topk_idxs contains the index of the flattened tensor. We need to convert it to the index in the original tensor
         scores = topk_values # Shape: (300,)
         topk_boxes = topk_idxs // prob_to_label.shape[1] # to determine the index in 'num_query' dimension. Shape: (300,)
         labels = topk_idxs % prob_to_label.shape[1] # to determine the index in 'num_category' dimension. Shape: (300,)
-        topk_boxes_batch_idx = labels // self.length # to determine the index in 'batch_size' dimension. Shape: (300,)
+        # to determine the index in 'batch_size' dimension. Shape: (300,)
+        topk_boxes_batch_idx = prompt_of_labels(labels, positive_map_list)
         combined_box_index = torch.stack((topk_boxes_batch_idx, topk_boxes), dim=1)
         boxes = out_bbox[combined_box_index[:, 0], combined_box_index[:, 1]].to("cpu") # Shape: (300, 4)
-        h, w = inputs[0]['height'], inputs[0]['width']
         boxes = boxes * torch.Tensor([w, h, w, h])
         boxes = box_convert(boxes = boxes, in_fmt = "cxcywh", out_fmt = "xyxy")
+        return boxes, scores, labels
 
-        boxes = torch.cat([combined_rcnn_boxes, boxes], dim = 0)
-        scores = torch.cat([combined_rcnn_scores, scores], dim = 0)
-        labels = torch.cat([combined_rcnn_classes, labels], dim = 0)
+    def encode_sam(self, inputs):
+        """
+        Runs the SAM image encoder on a batch of images, which SAM pads to the same square size.
 
-        labels = labels.to(torch.int64)
+        Returns:
+            image_embeddings (Tensor): (B, 256, 64, 64)
+            sam_images (list[Tensor]): the resized images, whose size `refine_boxes_with_sam` needs
+        """
+        sam_images = []
+        for input in inputs:
+            curr_image = self.resize_transform.apply_image(input["original_image"])
+            sam_images.append(torch.as_tensor(curr_image, device = self.sam.device).permute(2, 0, 1).contiguous())
 
-        # Standardize the combined scores of RCNN and GDINO 
-        scaler = MinMaxScaler()
-        scores = scaler.fit_transform(scores.reshape(-1, 1)).reshape(-1)
-        scores = torch.tensor(scores, dtype = combined_rcnn_scores.dtype)
+        image_embeddings = self.sam.image_encoder(
+            torch.stack([self.sam.preprocess(sam_image) for sam_image in sam_images], dim = 0)
+        )
+        return image_embeddings, sam_images
 
-        #SAM
-        boxes = boxes.to(self.sam.device)
-        curr_image = cv2.imread(inputs[0]['file_name'])
-        curr_image = cv2.cvtColor(curr_image, cv2.COLOR_BGR2RGB)
+    def refine_boxes_with_sam(self, image_embeddings, sam_image, boxes, img_shape):
+        """
+        Same as `self.sam(batched_input, multimask_output = False)` for the box prompts `boxes` (original image
+        coordinates) of one image whose embedding is already computed.
 
-        img_shape = curr_image.shape[:2] # (h, w)
-        curr_image = self.resize_transform.apply_image(curr_image)
-        curr_image = torch.as_tensor(curr_image, device = self.sam.device).permute(2, 0, 1).contiguous()
+        Returns:
+            sam_boxes (Tensor): (N, 4) boxes of the SAM masks, on the SAM device
+            sam_scores (Tensor): (N,) predicted IoU of the masks, on cpu
+        """
+        if len(boxes) == 0:
+            return torch.zeros((0, 4), dtype = torch.int64, device = self.sam.device), torch.zeros((0,))
 
-        sam_box_prompts = self.resize_transform.apply_boxes_torch(boxes, img_shape)
+        sam_box_prompts = self.resize_transform.apply_boxes_torch(boxes.to(self.sam.device), img_shape)
 
-        batched_input = [
-            {
-                "image": curr_image,
-                "boxes": sam_box_prompts,
-                "original_size": img_shape,
-            }
-        ]
-
-        batched_output = self.sam(batched_input, multimask_output = False)
-        sam_masks = batched_output[0]['masks']
+        sparse_embeddings, dense_embeddings = self.sam.prompt_encoder(
+            points = None, boxes = sam_box_prompts, masks = None
+        )
+        low_res_masks, sam_scores = self.sam.mask_decoder(
+            image_embeddings = image_embeddings,
+            image_pe = self.sam.prompt_encoder.get_dense_pe(),
+            sparse_prompt_embeddings = sparse_embeddings,
+            dense_prompt_embeddings = dense_embeddings,
+            multimask_output = False,
+        )
+        sam_masks = self.sam.postprocess_masks(low_res_masks, sam_image.shape[-2:], img_shape) > self.sam.mask_threshold
         sam_refined_boxes = batched_mask_to_box(sam_masks.clone().detach()).squeeze(1)
-        sam_scores = batched_output[0]['iou_predictions']
-        sam_scores = sam_scores.squeeze(1).to("cpu")
-
-        # Standardize the SAM scores
-        scaler_sam = MinMaxScaler()
-        sam_scores = scaler_sam.fit_transform(sam_scores.reshape(-1, 1)).reshape(-1)
-        sam_scores = torch.tensor(sam_scores, dtype = scores.dtype)
-        
-        scores = scores * sam_scores
-        topk_scores, topk_idxs = torch.topk(scores, 300)
+        return sam_refined_boxes, sam_scores.squeeze(1).to("cpu")
 
-        boxes = sam_refined_boxes[topk_idxs]
-        labels = labels[topk_idxs]
-        scores = topk_scores
+    def visualize(self, input, instances, out_dir, confidence_threshold, vocabulary = None):
+        """Saves the image of `input` and its detections with a score >= `confidence_threshold` to `out_dir`."""
+        score_mask = instances.scores >= confidence_threshold
 
-        if visualize:
-            result = Instances((h, w))
-            score_mask = scores >= confidence_threshold
-            boxes_vis = boxes[score_mask]
-            scores_vis = scores[score_mask]
-            labels_vis = labels[score_mask]
-
-            result.pred_boxes = Boxes(boxes_vis)
-            result.scores = scores_vis
-            result.pred_classes = labels_vis
+        result = Instances(instances.image_size)
+        result.pred_boxes = Boxes(instances.pred_boxes.tensor[score_mask])
+        result.scores = instances.scores[score_mask]
+        result.pred_classes = instances.pred_classes[score_mask]
 
+        if vocabulary is not None:
+            meta_data = Metadata(thing_classes = vocabulary.class_names)
+        else:
             meta_data = MetadataCatalog.get(self.lvis_data_split)
-            Path(f"{out_dir}/output_images").mkdir(parents=True, exist_ok=True)
+        Path(f"{out_dir}/output_images").mkdir(parents=True, exist_ok=True)
 
-            im = cv2.imread(inputs[0]['file_name'])
-            im = cv2.cvtColor(im, cv2.COLOR_BGR2RGB)
+        im = input["original_image"]
 
-            Path(f"{out_dir}/raw_images").mkdir(parents=True, exist_ok=True)
-            cv2.imwrite(f"{out_dir}/raw_images/{inputs[0]['file_name'].split('/')[-1]}", im[:, :, ::-1])
+        Path(f"{out_dir}/raw_images").mkdir(parents=True, exist_ok=True)
+        cv2.imwrite(f"{out_dir}/raw_images/{input['file_name'].split('/')[-1]}", im[:, :, ::-1])
 
-            v = BBoxVisualizer(im, meta_data, scale = 1.2)
-            out = v.draw_instance_predictions(result)
-            f_name = inputs[0]['file_name'].split('/')[-1]
-            cv2.imwrite(f"{out_dir}/output_images/{f_name}", out.get_image()[:, :, ::-1])
+        v = BBoxVisualizer(im, meta_data, scale = 1.2)
+        out = v.draw_instance_predictions(result)
+        f_name = input['file_name'].split('/')[-1]
+        cv2.imwrite(f"{out_dir}/output_images/{f_name}", out.get_image()[:, :, ::-1])
 
-        result = Instances((h, w))
-        result.pred_boxes = Boxes(boxes)
-        result.scores = scores
-        result.pred_classes = labels
-
-        final_outputs = []
-        curr_output = {}
-        curr_output['instances'] = result
-        final_outputs.append(curr_output)
-
-        return final_outputs
-
-    def prepare_inputs(self, image_path: str, image_format: str = "BGR"):
+    def prepare_inputs(self, image_path: str, image_format: str = "BGR", image: np.ndarray | None = None):
+        """
+        The image is decoded once, from `image_path` or given as the RGB array `image`; "original_image" keeps it in RGB
+        for GDINO, SAM and the visualization.
+        """
         data_dict = {}
         inputs = []
 
-        img = read_image(image_path, format = image_format)
+        if image is None:
+            image = read_image(image_path, format = "RGB")
+        data_dict["original_image"] = image
+        img = image[:, :, ::-1] if image_format == "BGR" else image
         orig_height = img.shape[0]
         orig_width = img.shape[1]
         data_dict["file_name"] = os.path.abspath(image_path)
@@ -282,13 +834,320 @@ class NOD:
 
         return inputs
 
+    def _get_vocabulary_builder(self):
+        if self.vocabulary_builder is None:
+            self.vocabulary_builder = VocabularyBuilder(
+                self.clip_model,
+                open_clip.get_tokenizer(self.clip_model_name),
+                self.gdino_model.tokenizer,
+                self.device,
+                self.length,
+                coco_to_lvis = self.coco_to_lvis,
+                lvis_classes = MetadataCatalog.get(self.lvis_data_split).thing_classes,
+            )
+            self.vocabulary_builder.add_embeddings(
+                MetadataCatalog.get(self.lvis_data_split).thing_classes, self.text_features
+            )
+        return self.vocabulary_builder
+
+    def build_vocabulary(self, class_names: list[str], synonyms: dict | None = None, class_index: str | None = None):
+        """
+        Returns a `Vocabulary` of `class_names` for `infer`; its SigLIP embeddings and GDINO prompts are cached, and
+        those of the LVIS classes are already known. With `class_index` ("exact", "ivfpq" or "hierarchical", see
+        `class_index.py`), the crops are classified with an index of its embeddings, for vocabularies of tens of
+        thousands of classes.
+        """
+        vocabulary = self._get_vocabulary_builder().build(class_names, synonyms)
+        if class_index is not None and getattr(vocabulary.class_index, "kind", None) != class_index:
+            vocabulary.class_index = build_class_index(class_index, vocabulary.text_features, self.clip_model)
+        return vocabulary
+
+    def open_vocabulary_store(self, path: str):
+        """
+        Returns the `VocabularyStore` saved at `path` (empty if there is none yet), to add, remove or rename classes
+        without re-encoding the others; `store.vocabulary()` is then passed to `infer`.
+        """
+        return VocabularyStore(self._get_vocabulary_builder(), path)
+
+    def session(self, image_path: str, image: np.ndarray | None = None):
+        """Returns a `NODSession` of the image, to query it with several prompts."""
+        return NODSession(self, image_path, image = image)
+
+    def video_stream(
+        self, text_prompt_list: list[str] | None = None, vocabulary: Vocabulary | None = None, **kwargs
+    ):
+        """
+        Returns a `NODVideoStream` (see `video_stream.py`) to detect on the frames of a video in order, running the
+        whole pipeline only on keyframes; `kwargs` are its keyframe and skipping settings.
+        """
+        return NODVideoStream(self, text_prompt_list = text_prompt_list, vocabulary = vocabulary, **kwargs)
+
     def infer_multiple_images(
         self,
-        img_dir: Path,
+        img_dir,
         text_prompt_list: list[str] = ["dog ."],
         visualize: bool = True,
         out_dir: Path | None = None,
         confidence_threshold: float = 0.5,
+        vocabulary: Vocabulary | None = None,
+        num_prefetch: int = 4,
+        ordered: bool = True,
+    ):
+        """
+        Yields (path, Instances) for every image of `img_dir`, as `infer` returns them: `img_dir` is a directory, a glob
+        pattern, a manifest file (.txt, one path per line) or any iterable of paths, read lazily (see
+        `iter_image_paths`). Up to `num_prefetch` next images are read and decoded by a pool of threads while the models
+        run on the current one. With `ordered=False`, the images are processed and yielded as soon as they are decoded
+        instead of in the order of `img_dir`, so that a slow read does not hold back the next images.
+        """
+        paths = iter(iter_image_paths(img_dir))
+        with ThreadPoolExecutor(max(1, num_prefetch), thread_name_prefix = "image_prefetch") as executor:
+            pending = OrderedDict()  # future -> path, in the order of `img_dir`
+
+            def prefetch():
+                while len(pending) < max(1, num_prefetch):
+                    path = next(paths, None)
+                    if path is None:
+                        return
+                    pending[executor.submit(self._read_prefetched_image, path)] = path
+
+            prefetch()
+            while len(pending) > 0:
+                if ordered:
+                    future = next(iter(pending))
+                else:
+                    future = next(iter(wait(pending, return_when = FIRST_COMPLETED).done))
+                path = pending.pop(future)
+                image, image_digest = future.result()
+                prefetch()
+                output = self.infer(
+                    str(path), text_prompt_list, visualize, out_dir, confidence_threshold, image = image,
+                    vocabulary = vocabulary, image_digest = image_digest,
+                )
+                yield path, output[0]["instances"]
+
+    def _read_prefetched_image(self, path):
+        """Decoded RGB image of `path` and, with a `self.result_cache`, the hash of its file, in a prefetch thread."""
+        image_digest = file_digest(path) if self.result_cache is not None else None
+        return read_image(str(path), "RGB"), image_digest
+
+
+IMAGE_SUFFIXES = {".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff", ".webp"}
+
+
+def iter_image_paths(source):
+    """
+    Paths of the images of `source`: the image files of a directory (sorted), the matches of a glob pattern (sorted),
+    the lines of a manifest file (.txt), or the items of any other iterable of paths.
+    """
+    if isinstance(source, (str, Path)):
+        if Path(source).is_dir():
+            return (path for path in sorted(Path(source).iterdir()) if path.suffix.lower() in IMAGE_SUFFIXES)
+        if any(char in str(source) for char in "*?["):
+            return (Path(path) for path in sorted(glob.glob(str(source), recursive = True)))
+        if Path(source).suffix.lower() == ".txt":
+            return _manifest_paths(source)
+        return iter([Path(source)])
+    return (Path(path) for path in source)
+
+
+def _manifest_paths(manifest):
+    """Paths listed in a manifest file, relative ones being relative to its directory."""
+    root = Path(manifest).parent
+    with open(manifest, "r") as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                yield root / line
+
+
+class _CachedGDINOBackbone(nn.Module):
+    """
+    Stands in for the backbone of GDINO (image backbone and position encoding) while GDINO runs on copies of one image,
+    one per prompt: the features of one copy are computed on the first call, kept in `cache`, and repeated for every
+    prompt of this and the next calls.
+    """
+
+    def __init__(self, backbone, cache):
+        super().__init__()
+        self.backbone = backbone
+        self.cache = cache
+        # vocabulary shards call it concurrently, the features are computed by the first one
+        self._lock = threading.Lock()
+
+    def __getitem__(self, idx):
+        # GDINO calls the position encoding `backbone[1]` directly for its extra feature levels
+        return self.backbone[idx]
+
+    def forward(self, samples):
+        with self._lock:
+            if "features" not in self.cache:
+                features, poss = self.backbone(NestedTensor(samples.tensors[:1], samples.mask[:1]))
+                self.cache["features"] = features
+                self.cache["poss"] = poss
+
+        batch_size = len(samples.tensors)
+        features = [
+            NestedTensor(feature.tensors.repeat(batch_size, 1, 1, 1), feature.mask.repeat(batch_size, 1, 1))
+            for feature in self.cache["features"]
+        ]
+        # new lists, as GDINO appends the position encodings of its extra levels to them
+        poss = [pos.repeat(batch_size, 1, 1, 1) for pos in self.cache["poss"]]
+        return features, poss
+
+
+class NODSession:
+    """
+    Interactive queries of one image. The image-level results are computed on the first query and reused by the next
+    ones: the RCNN detections, the CLIP embeddings of the background crops, the GDINO backbone features, the SAM image
+    embedding and the SAM refinement of the RCNN and CLIP boxes. A query with new prompts then only runs the GDINO text
+    encoder, fusion and decoder, the SAM mask decoder on the GDINO boxes and the fusion; a query with the same prompts
+    and another threshold only filters the fused detections of the previous query.
+
+        session = nod_model.session("image.jpg")
+        instances = session.query(["license plate ."], score_threshold = 0.2)[0]["instances"]
+        instances = session.query(vocabulary = nod_model.build_vocabulary(["traffic light"]))[0]["instances"]
+    """
+
+    # fused detections kept for the most recent prompt lists / vocabularies
+    max_cached_queries = 8
+
+    def __init__(self, nod_model, image_path, image = None):
+        self.nod_model = nod_model
+        self.input = nod_model.prepare_inputs(image_path, image = image)[0]
+        self.image_size = (self.input["height"], self.input["width"])
+        self._image_outputs = None
+        self._gdino_backbone_cache = {}
+        self._queries = OrderedDict()
+
+    def _compute_image_outputs(self):
+        nod_model = self.nod_model
+        profiler = nod_model.profiler
+
+        rcnn_outputs = nod_model.run_rcnn([self.input])[0]
+        profiler.mark("rcnn", num_boxes = len(rcnn_outputs["rcnn_boxes"]) + len(rcnn_outputs["bg_boxes"]))
+
+        crop_images, crop_boxes = nod_model.extract_crops(self.input, rcnn_outputs.pop("bg_boxes"))
+        profiler.mark("crop_extraction", num_crops = len(crop_boxes))
+
+        rcnn_outputs["clip_boxes"] = crop_boxes
+        rcnn_outputs["clip_features"] = nod_model.encode_crops([crop_images])[0]
+        profiler.mark("clip_encode", num_crops = len(crop_boxes))
+
+        if nod_model.prefilter is not None:
+            rcnn_outputs["view_features"] = nod_model.prefilter.encode_views([self.input["original_image"]])[0]
+            profiler.mark("prefilter_encode")
+
+        image_embeddings, sam_images = nod_model.encode_sam([self.input])
+        rcnn_outputs["sam_image_embeddings"] = image_embeddings
+        rcnn_outputs["sam_image"] = sam_images[0]
+        profiler.mark("sam_encoder")
+
+        # the SAM refinement of a box does not depend on the other boxes, so that of the RCNN and CLIP boxes is reused
+        boxes = torch.cat([rcnn_outputs["rcnn_boxes"], rcnn_outputs["clip_boxes"]], dim = 0)
+        rcnn_outputs["sam_boxes"], rcnn_outputs["sam_scores"] = nod_model.refine_boxes_with_sam(
+            image_embeddings, sam_images[0], boxes, self.image_size
+        )
+        profiler.mark("sam_decoder", num_prompts = len(boxes))
+        return rcnn_outputs
+
+    @torch.no_grad()
+    def query(
+        self,
+        text_prompt_list: list[str] | None = None,
+        score_threshold: float = 0.0,
+        vocabulary: Vocabulary | None = None,
     ):
-        for img_file in img_dir.iterdir():
-            self.infer(str(img_file), text_prompt_list, visualize, out_dir, confidence_threshold)
+        """
+        Args:
+            text_prompt_list, vocabulary: as for `NOD.infer`, the prompts of `vocabulary` are used when it is given;
+                one of them is needed unless the pipeline has a prefilter, which ignores `text_prompt_list`
+        Returns:
+            list[dict]: as `NOD.infer`, one dict with key "instances", the detections with a score >= `score_threshold`
+        """
+        if vocabulary is not None:
+            # the vocabulary is kept with its detections, so that its id is not reused while it is a key
+            key = id(vocabulary)
+        elif self.nod_model.prefilter is not None:
+            key = ()  # the prompts of the prefilter, whatever `text_prompt_list`
+        elif text_prompt_list is None:
+            raise ValueError("NODSession.query needs a text_prompt_list or a vocabulary")
+        else:
+            key = tuple(text_prompt_list)
+        if key in self._queries:
+            self._queries.move_to_end(key)
+            instances = self._queries[key][1]
+        else:
+            instances = self._run_query(text_prompt_list, vocabulary)
+            self._queries[key] = (vocabulary, instances)
+            if len(self._queries) > self.max_cached_queries:
+                self._queries.popitem(last = False)
+
+        return [{"instances": instances[instances.scores >= score_threshold]}]
+
+    def _run_query(self, text_prompt_list, vocabulary):
+        nod_model = self.nod_model
+        profiler = nod_model.profiler
+        profiler.start_image(self.input["file_name"])
+
+        if self._image_outputs is None:
+            self._image_outputs = self._compute_image_outputs()
+        image_outputs = self._image_outputs
+
+        rcnn_boxes, rcnn_scores, rcnn_classes, keep = nod_model.map_known_classes(
+            image_outputs["rcnn_boxes"], image_outputs["rcnn_scores"], image_outputs["rcnn_coco_classes"], vocabulary
+        )
+        clip_scores, clip_classes = nod_model.classify_crops([image_outputs["clip_features"]], [vocabulary])[0]
+        profiler.mark("clip_classify", num_crops = len(clip_scores))
+
+        if vocabulary is not None:
+            text_prompt_list = vocabulary.text_prompt_list
+        prompt_classes = None
+        if nod_model.prefilter is not None:
+            detections = {
+                "rcnn_classes": rcnn_classes, "rcnn_scores": rcnn_scores,
+                "clip_classes": clip_classes, "clip_scores": clip_scores,
+            }
+            text_prompt_lists, prompt_classes = nod_model.prefilter_prompts(
+                [image_outputs["view_features"]], [detections], [vocabulary]
+            )
+            text_prompt_list = text_prompt_lists[0]
+            profiler.mark("prefilter", num_classes = len(prompt_classes[0][1]))
+        gdino_boxes, gdino_scores, gdino_classes = nod_model.run_gdino(
+            [self.input], [text_prompt_list], backbone_cache = self._gdino_backbone_cache, vocabularies = [vocabulary],
+            prompt_classes = prompt_classes,
+        )[0]
+        profiler.mark("gdino", num_prompts = len(text_prompt_list), num_boxes = len(gdino_boxes))
+
+        gdino_sam_boxes, gdino_sam_scores = nod_model.refine_boxes_with_sam(
+            image_outputs["sam_image_embeddings"], image_outputs["sam_image"], gdino_boxes, self.image_size
+        )
+        profiler.mark("sam_decoder", num_prompts = len(gdino_boxes))
+
+        # cached SAM outputs of the known RCNN detections the vocabulary keeps, and of all the CLIP boxes
+        keep = torch.cat([keep, torch.ones(len(image_outputs["clip_boxes"]), dtype = torch.bool)])
+        stage_outputs = {
+            "rcnn_boxes": rcnn_boxes,
+            "rcnn_scores": rcnn_scores,
+            "rcnn_classes": rcnn_classes,
+            "clip_boxes": image_outputs["clip_boxes"],
+            "clip_scores": clip_scores,
+            "clip_classes": clip_classes,
+            "gdino_boxes": gdino_boxes,
+            "gdino_scores": gdino_scores,
+            "gdino_classes": gdino_classes,
+            "sam_boxes": torch.cat(
+                [image_outputs["sam_boxes"][keep.to(gdino_sam_boxes.device)], gdino_sam_boxes], dim = 0
+            ),
+            "sam_scores": torch.cat([image_outputs["sam_scores"][keep], gdino_sam_scores], dim = 0),
+        }
+        boxes, scores, labels = fuse_stage_outputs(stage_outputs, topk = 300)
+
+        result = Instances(self.image_size)
+        result.pred_boxes = Boxes(boxes)
+        result.scores = scores
+        result.pred_classes = labels
+        profiler.mark("fusion", num_candidates = len(stage_outputs["sam_scores"]), num_kept = len(boxes))
+
+        profiler.end_image()
+        return result
@@ -0,0 +1,95 @@
+"""
+Pre-filtering of the vocabulary before GDINO.
+
+GDINO runs once per prompt of `class_len_per_prompt` classes, i.e. 15 times per image for the 1203 LVIS classes, while
+an image only contains a handful of them. `ClassPrefilter` scores every class of the vocabulary for the image with what
+is cheap or already computed: the SigLIP embeddings of the whole image and of a grid of tiles against the class text
+features (the best view of each class is kept), and the scores of the RCNN and CLIP detections of the class. Only the
+`topk` best classes are packed into prompts, e.g. a single prompt for `topk` <= `class_len_per_prompt`, and the labels
+of GDINO are mapped back to the ids of the full vocabulary, so the rest of the pipeline is unchanged.
+
+`prefilter_report.py` measures the recall of the ground-truth classes and the GDINO latency for several `topk`.
+"""
+import numpy as np
+import torch
+from PIL import Image
+
+from utils import build_text_prompt, clip_class_probs, encode_clip_images
+
+
+class ClassPrefilter:
+    def __init__(self, clip_model, preprocess, tokenizer, class_len_per_prompt, topk=64, grid_size=2, device="cuda"):
+        """
+        Args:
+            preprocess: the SigLIP image transform of `load_clip_model`
+            tokenizer: `gdino_model.tokenizer`
+            topk (int): number of classes GDINO is prompted with
+            grid_size (int): the image is also scored as `grid_size` x `grid_size` tiles, for the small objects (0: no
+                tiles)
+        """
+        self.clip_model = clip_model
+        self.preprocess = preprocess
+        self.tokenizer = tokenizer
+        self.class_len_per_prompt = class_len_per_prompt
+        self.topk = topk
+        self.grid_size = grid_size
+        self.device = device
+
+    def image_views(self, image):
+        """The RGB `image` and its tiles, preprocessed for SigLIP: (1 + grid_size ** 2, 3, H, W)."""
+        views = [image]
+        height, width = image.shape[:2]
+        for row in range(self.grid_size):
+            for col in range(self.grid_size):
+                views.append(image[
+                    row * height // self.grid_size:(row + 1) * height // self.grid_size,
+                    col * width // self.grid_size:(col + 1) * width // self.grid_size,
+                ])
+        return torch.stack([self.preprocess(Image.fromarray(np.ascontiguousarray(view))) for view in views], dim = 0)
+
+    def encode_views(self, images):
+        """
+        SigLIP embeddings of the views of several RGB images, encoded in a single batch; they do not depend on the
+        vocabulary, so `NODSession` keeps them.
+
+        Returns:
+            list[Tensor]: per image, the (1 + grid_size ** 2, D) normalized embeddings of its views
+        """
+        views = [self.image_views(image) for image in images]
+        view_features = encode_clip_images(torch.cat(views, dim = 0).to(self.device), self.clip_model)
+        return list(view_features.split([len(image_views) for image_views in views]))
+
+    def select(self, view_features, text_features, detection_classes=None, detection_scores=None):
+        """
+        Args:
+            view_features (Tensor): embeddings of `encode_views` of one image
+            text_features (Tensor): (num_classes, D) SigLIP embeddings of the vocabulary
+            detection_classes, detection_scores (Tensor): classes (vocabulary ids) and scores of the RCNN and CLIP
+                detections of the image, whose classes score at least as much as their best detection
+        Returns:
+            Tensor: the sorted ids of the `topk` classes of highest score
+        """
+        scores = clip_class_probs(view_features, self.clip_model, text_features).max(dim = 0).values
+        scores = scores.float().to("cpu").numpy()
+        if detection_classes is not None:
+            detection_classes = detection_classes.long()
+            valid = detection_classes >= 0  # known RCNN classes without an LVIS class are -1
+            np.maximum.at(scores, detection_classes[valid].numpy(), detection_scores[valid].float().numpy())
+        topk = min(self.topk, len(scores))
+        return torch.from_numpy(scores).topk(topk).indices.sort().values
+
+    def prompts(self, class_names, class_ids):
+        """
+        GDINO prompts and positive maps of the classes `class_ids` of the vocabulary `class_names`, split as in
+        `get_text_prompt_list_for_g_dino`. Label `i` of the concatenated positive maps is the class `class_ids[i]`.
+        """
+        classes = [class_names[class_id].lower().replace("_", " ") for class_id in class_ids.tolist()]
+        length = self.class_len_per_prompt
+
+        text_prompt_list = []
+        positive_map_list = []
+        for start in range(0, len(classes), length):
+            captions, positive_map = build_text_prompt(classes[start:start + length], self.tokenizer)
+            text_prompt_list.append(captions)
+            positive_map_list.append(positive_map)
+        return text_prompt_list, positive_map_list
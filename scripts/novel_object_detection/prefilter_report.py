@@ -0,0 +1,178 @@
+"""
+Recall and latency of the GDINO vocabulary pre-filter (see `prefilter.py`) on LVIS val.
+
+On the first `--num-images` images of `lvis_data_split` (`params.json`), the RCNN, CLIP and the SigLIP embeddings of
+the image views run once per image; GDINO then runs with the whole vocabulary and with the `k` classes selected by the
+pre-filter, for every `k` of `--topk`. Reported for each:
+- class recall: fraction of the ground-truth (image, class) pairs whose class is prompted, an upper bound of the recall
+  of GDINO;
+- GDINO box recall: fraction of the ground-truth boxes matched (IoU >= `--iou-threshold`) by at least one of the top-300
+  GDINO detections of their class;
+- the number of prompts, the p50 latency of GDINO and its speedup over the whole vocabulary,
+and the p50 latency of the pre-filter itself (SigLIP on the views and class selection).
+
+Usage, from the project root, with the checkpoints set in `params.json`:
+    python scripts/novel_object_detection/prefilter_report.py --num-images 500 --topk 16 32 64 128
+The AP of a given `k` is measured by `main.py` with `prefilter_topk` set to `k` in `params.json`.
+"""
+import os
+import sys
+import json
+import argparse
+import time
+
+proj_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../"))
+sys.path.append(proj_path)
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+outputs_dir = os.path.normpath(os.path.join(script_dir, "../../outputs/"))
+
+import numpy as np
+import torch
+
+from collections import OrderedDict
+from pathlib import Path
+from tqdm import tqdm
+from detectron2.data import MetadataCatalog, get_detection_dataset_dicts
+from detectron2.structures import BoxMode
+from torchvision.ops import box_iou
+
+from main import build_model_registry, lvis_data_split, class_len_per_prompt, model_load_workers
+from benchmark import build_param_dict
+from datasets.gt_index import register_lvis_from_gt_index
+from prefilter import ClassPrefilter
+from nod_model import NOD
+
+
+def _now():
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    return time.perf_counter()
+
+
+def ground_truth(record):
+    """(G, 4) xyxy boxes and (G,) classes of the annotations of a dataset dict."""
+    annotations = record.get("annotations", [])
+    boxes = [BoxMode.convert(ann["bbox"], ann["bbox_mode"], BoxMode.XYXY_ABS) for ann in annotations]
+    classes = [ann["category_id"] for ann in annotations]
+    return torch.tensor(boxes, dtype = torch.float32).reshape(-1, 4), torch.tensor(classes, dtype = torch.int64)
+
+
+def box_recall_hits(gt_boxes, gt_classes, boxes, labels, iou_threshold):
+    """Number of ground-truth boxes matched by at least one detection of their class."""
+    if len(gt_boxes) == 0 or len(boxes) == 0:
+        return 0
+    ious = box_iou(gt_boxes, boxes.float())
+    ious[gt_classes[:, None] != labels[None, :]] = 0
+    return int((ious >= iou_threshold).any(dim = 1).sum())
+
+
+def run_report(args):
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    if lvis_data_split != "lvis_v1_val_subset":  # builtin split, as in `main.py`
+        register_lvis_from_gt_index(lvis_data_split)
+    dataset = get_detection_dataset_dicts(names = lvis_data_split, filter_empty = False)[:args.num_images]
+
+    registry = build_model_registry(device)
+    registry.preload(max_workers = model_load_workers)
+    models = (registry["gdino"], *registry["rcnn"], *registry["clip"][:3], registry["sam"])
+    text_prompt_list, param_dict = build_param_dict(models, outputs_dir, class_len_per_prompt, device, lvis_data_split)
+
+    prefilter = ClassPrefilter(
+        param_dict["clip_model"], param_dict["preprocess"], models[0].tokenizer, class_len_per_prompt,
+        max(args.topk), args.grid_size, device,
+    )
+    param_dict["prefilter"] = prefilter
+    nod_model = NOD(param_dict, models[0])
+    class_names = MetadataCatalog.get(lvis_data_split).thing_classes
+
+    settings = [0] + sorted(args.topk)  # 0: the whole vocabulary
+    stats = {k: {"class_hits": 0, "box_hits": 0, "num_prompts": [], "gdino_ms": []} for k in settings}
+    num_gt_classes = 0
+    num_gt_boxes = 0
+    prefilter_ms = []
+
+    for record in tqdm(dataset):
+        input = nod_model.prepare_inputs(record["file_name"])[0]
+        outputs = nod_model.run_rcnn([input])[0]
+        _, rcnn_scores, rcnn_classes, _ = nod_model.map_known_classes(
+            outputs["rcnn_boxes"], outputs["rcnn_scores"], outputs["rcnn_coco_classes"]
+        )
+        crop_images, _ = nod_model.extract_crops(input, outputs["bg_boxes"])
+        clip_scores, clip_classes = nod_model.classify_crops(nod_model.encode_crops([crop_images]))[0]
+        detection_classes = torch.cat([rcnn_classes, clip_classes])
+        detection_scores = torch.cat([rcnn_scores, clip_scores])
+
+        start = _now()
+        view_features = prefilter.encode_views([input["original_image"]])[0]
+        prefilter.topk = max(args.topk)
+        prefilter.select(view_features, nod_model.text_features, detection_classes, detection_scores)
+        prefilter_ms.append((_now() - start) * 1000)
+
+        gt_boxes, gt_classes = ground_truth(record)
+        gt_class_set = set(gt_classes.tolist())
+        num_gt_classes += len(gt_class_set)
+        num_gt_boxes += len(gt_boxes)
+
+        for k in settings:
+            if k == 0:
+                prompts, prompt_classes = text_prompt_list, None
+                stats[k]["class_hits"] += len(gt_class_set)
+            else:
+                prefilter.topk = k
+                class_ids = prefilter.select(
+                    view_features, nod_model.text_features, detection_classes, detection_scores
+                )
+                prompts, positive_map_list = prefilter.prompts(class_names, class_ids)
+                prompt_classes = [(positive_map_list, class_ids)]
+                stats[k]["class_hits"] += len(gt_class_set & set(class_ids.tolist()))
+
+            start = _now()
+            boxes, _, labels = nod_model.run_gdino([input], [prompts], prompt_classes = prompt_classes)[0]
+            stats[k]["gdino_ms"].append((_now() - start) * 1000)
+            stats[k]["num_prompts"].append(len(prompts))
+            stats[k]["box_hits"] += box_recall_hits(gt_boxes, gt_classes, boxes, labels, args.iou_threshold)
+
+    full_p50 = float(np.percentile(stats[0]["gdino_ms"], 50))
+    report = OrderedDict([
+        ("num_images", len(dataset)),
+        ("prefilter_p50_ms", float(np.percentile(prefilter_ms, 50))),
+        ("settings", []),
+    ])
+    for k in settings:
+        gdino_p50 = float(np.percentile(stats[k]["gdino_ms"], 50))
+        report["settings"].append(OrderedDict([
+            ("topk", k if k > 0 else len(class_names)),
+            ("class_recall", stats[k]["class_hits"] / max(num_gt_classes, 1)),
+            ("gdino_box_recall", stats[k]["box_hits"] / max(num_gt_boxes, 1)),
+            ("mean_num_prompts", float(np.mean(stats[k]["num_prompts"]))),
+            ("gdino_p50_ms", gdino_p50),
+            ("gdino_speedup", full_p50 / gdino_p50),
+        ]))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Recall and latency of the GDINO vocabulary pre-filter on LVIS val")
+    parser.add_argument("--num-images", type=int, default=500)
+    parser.add_argument("--topk", type=int, nargs="+", default=[16, 32, 64, 128], help="numbers of classes to prompt")
+    parser.add_argument("--grid-size", type=int, default=2, help="tiles per side scored besides the whole image")
+    parser.add_argument("--iou-threshold", type=float, default=0.5)
+    parser.add_argument("--output", type=str, default=os.path.join(outputs_dir, "prefilter_report.json"))
+    args = parser.parse_args()
+
+    report = run_report(args)
+    print("prefilter p50: {:.1f} ms on {} images".format(report["prefilter_p50_ms"], report["num_images"]))
+    print("{:>8}{:>14}{:>14}{:>10}{:>14}{:>10}".format(
+        "topk", "class_recall", "box_recall", "prompts", "gdino_p50_ms", "speedup"
+    ))
+    for row in report["settings"]:
+        print("{:>8}{:>14.3f}{:>14.3f}{:>10.1f}{:>14.1f}{:>9.1f}x".format(
+            row["topk"], row["class_recall"], row["gdino_box_recall"], row["mean_num_prompts"], row["gdino_p50_ms"],
+            row["gdino_speedup"],
+        ))
+
+    Path(os.path.dirname(args.output)).mkdir(parents=True, exist_ok=True)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=4)
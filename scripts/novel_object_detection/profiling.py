@@ -0,0 +1,177 @@
+"""
+Per-stage latency and memory of the NOD pipeline.
+
+The pipeline is a fixed sequence of stages (RCNN, crop extraction, CLIP encoding, GDINO, SAM encoder, SAM decoder,
+fusion, visualization), so it is instrumented with marks: `StageProfiler.mark(stage)` is called at the end of every
+stage and records the time since the previous mark, the peak GPU memory allocated in between and the candidate counts
+passed as keyword arguments. Records are kept per image, and exported as a Chrome trace (chrome://tracing or
+https://ui.perfetto.dev) or JSONL, with p50/p95/p99 summaries per stage. A long-running process (the server) keeps only
+the records of its last `max_images` images, so that the summaries are over a rolling window.
+"""
+import itertools
+import json
+import os
+import resource
+import time
+from collections import OrderedDict, deque
+
+import numpy as np
+import torch
+
+
+class StageProfiler:
+    def __init__(self, enabled=True, num_warmup=0, max_images=None):
+        """
+        Args:
+            enabled (bool): when False every method is a no-op, so the pipeline can call them unconditionally
+            num_warmup (int): the first `num_warmup` images are exported but left out of the summaries
+            max_images (int): only the records of the last `max_images` images are kept (None: all)
+        """
+        self.enabled = enabled
+        self.num_warmup = num_warmup
+        self.images = deque(maxlen=max_images)
+        self.num_images = 0  # images recorded so far, including those out of the window
+        self._origin = time.perf_counter()
+        self._current = None
+        self._last = None
+
+    def _now(self):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        return time.perf_counter()
+
+    def start_image(self, image_id):
+        if not self.enabled:
+            return
+        if torch.cuda.is_available():
+            torch.cuda.reset_peak_memory_stats()
+        self._last = self._now()
+        self._current = {"image_id": image_id, "start": self._last - self._origin, "stages": []}
+
+    def mark(self, stage, **counts):
+        """Ends `stage`, which started at the previous mark (or at `start_image()`)."""
+        if not self.enabled or self._current is None:
+            return
+        now = self._now()
+        record = {
+            "stage": stage,
+            "start": self._last - self._origin,
+            "duration": now - self._last,
+            # ru_maxrss is in KB on Linux; it is the peak of the process so far, not of this stage only
+            "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        }
+        if torch.cuda.is_available():
+            record["peak_gpu_mem_mb"] = torch.cuda.max_memory_allocated() / 2 ** 20
+            torch.cuda.reset_peak_memory_stats()
+        record.update(counts)
+        self._current["stages"].append(record)
+        self._last = self._now()
+
+    def end_image(self):
+        if not self.enabled or self._current is None:
+            return
+        self._current["duration"] = self._now() - self._origin - self._current["start"]
+        self.images.append(self._current)
+        self.num_images += 1
+        self._current = None
+
+    def _num_warmup_kept(self):
+        """Number of warm-up images still at the start of `self.images`."""
+        return max(0, self.num_warmup - (self.num_images - len(self.images)))
+
+    def summary(self):
+        """
+        Returns:
+            OrderedDict: stage (and "total") -> count, mean / p50 / p95 / p99 / max wall time in ms, max peak GPU
+            memory in MB and mean of every candidate count
+        """
+        durations = OrderedDict()
+        extras = OrderedDict()
+        for image in itertools.islice(self.images, self._num_warmup_kept(), None):
+            for record in image["stages"]:
+                durations.setdefault(record["stage"], []).append(record["duration"])
+                extras.setdefault(record["stage"], []).append(record)
+            durations.setdefault("total", []).append(image["duration"])
+
+        summary = OrderedDict()
+        for stage, values in durations.items():
+            values = np.asarray(values) * 1000
+            stats = OrderedDict([
+                ("count", len(values)),
+                ("mean_ms", float(values.mean())),
+                ("p50_ms", float(np.percentile(values, 50))),
+                ("p95_ms", float(np.percentile(values, 95))),
+                ("p99_ms", float(np.percentile(values, 99))),
+                ("max_ms", float(values.max())),
+            ])
+            records = extras.get(stage, [])
+            if any("peak_gpu_mem_mb" in record for record in records):
+                stats["max_peak_gpu_mem_mb"] = max(record.get("peak_gpu_mem_mb", 0) for record in records)
+            count_names = [name for name in records[0] if name not in _RECORD_FIELDS] if records else []
+            for name in count_names:
+                stats["mean_" + name] = float(np.mean([record.get(name, 0) for record in records]))
+            summary[stage] = stats
+        return summary
+
+    def format_summary(self):
+        columns = ["stage", "count", "mean_ms", "p50_ms", "p95_ms", "p99_ms", "max_ms", "max_peak_gpu_mem_mb"]
+        lines = ["".join("{:>16}".format(column) for column in columns)]
+        for stage, stats in self.summary().items():
+            values = [stage] + [stats.get(column, float("nan")) for column in columns[1:]]
+            lines.append("".join(
+                "{:>16}".format(value) if isinstance(value, (str, int)) else "{:>16.2f}".format(value)
+                for value in values
+            ))
+        return "\n".join(lines)
+
+    def export_jsonl(self, path):
+        """One line per image with the records of its stages; times in ms."""
+        with open(path, "w") as f:
+            num_warmup = self._num_warmup_kept()
+            for idx, image in enumerate(self.images):
+                line = OrderedDict([
+                    ("image_id", image["image_id"]),
+                    ("warmup", idx < num_warmup),
+                    ("total_ms", image["duration"] * 1000),
+                    ("stages", [_to_ms(record) for record in image["stages"]]),
+                ])
+                f.write(json.dumps(line) + "\n")
+
+    def export_chrome_trace(self, path):
+        """Chrome trace event format: one complete ("X") event per image and per stage, nested on the same track."""
+        pid = os.getpid()
+        events = []
+        for image in self.images:
+            events.append({
+                "name": "image {}".format(image["image_id"]), "cat": "image", "ph": "X", "pid": pid, "tid": 0,
+                "ts": image["start"] * 1e6, "dur": image["duration"] * 1e6,
+            })
+            for record in image["stages"]:
+                events.append({
+                    "name": record["stage"], "cat": "stage", "ph": "X", "pid": pid, "tid": 0,
+                    "ts": record["start"] * 1e6, "dur": record["duration"] * 1e6,
+                    "args": {
+                        name: value for name, value in record.items() if name not in ("stage", "start", "duration")
+                    },
+                })
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f)
+
+    def export(self, out_dir, prefix="stage_profile"):
+        """Writes `<prefix>.jsonl`, `<prefix>_trace.json` and `<prefix>_summary.json` to `out_dir`."""
+        if not self.enabled:
+            return
+        self.export_jsonl(os.path.join(out_dir, prefix + ".jsonl"))
+        self.export_chrome_trace(os.path.join(out_dir, prefix + "_trace.json"))
+        with open(os.path.join(out_dir, prefix + "_summary.json"), "w") as f:
+            json.dump(self.summary(), f, indent=4)
+
+
+_RECORD_FIELDS = ("stage", "start", "duration", "max_rss_mb", "peak_gpu_mem_mb")
+
+
+def _to_ms(record):
+    record = OrderedDict(record)
+    record["start_ms"] = record.pop("start") * 1000
+    record["duration_ms"] = record.pop("duration") * 1000
+    return record
@@ -0,0 +1,78 @@
+import argparse
+import os
+import sys
+import json
+
+proj_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../"))
+sys.path.append(proj_path)
+
+os.environ['DETECTRON2_DATASETS'] = "path/to/datasets"
+
+from detectron2.evaluation.coco_evaluation import instances_to_coco_json
+from detectron2.structures import Instances, Boxes
+from evaluate_results_from_predictions import eval_predictions
+from lvis_eval_utils import load_class_subsets
+from stage_outputs import FUSION_VARIANTS, StageOutputCache, fuse_stage_outputs
+from tqdm import tqdm
+
+
+def refuse_predictions(stage_cache, fusion_kwargs, topk=300):
+    """
+    Re-applies the score fusion to the cached stage outputs of every image, in the predictions format of
+    `CustomEvaluator.process()`.
+    """
+    predictions = []
+    for image_id in tqdm(stage_cache.image_ids()):
+        (h, w), stage_outputs = stage_cache.load(image_id)
+        boxes, scores, labels = fuse_stage_outputs(stage_outputs, topk=topk, **fusion_kwargs)
+
+        result = Instances((h, w))
+        result.pred_boxes = Boxes(boxes)
+        result.scores = scores
+        result.pred_classes = labels
+
+        predictions.append({"image_id": image_id, "instances": instances_to_coco_json(result, image_id)})
+    return predictions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Evaluate fusion variants from the stage outputs cached by main.py (`stage_cache_dir`), "
+                    "without loading any model"
+    )
+    parser.add_argument("--cache-dir", type=str, required=True)
+    parser.add_argument("--lvis-data-split", type=str, default="lvis_v1_val")
+    parser.add_argument(
+        "--variants", type=str, nargs="+", default=["full"], choices=list(FUSION_VARIANTS.keys()),
+        help="fusion variants of `stage_outputs.FUSION_VARIANTS` to evaluate",
+    )
+    parser.add_argument("--topk", type=int, default=300, help="detections kept per image after fusion")
+    parser.add_argument("--num-workers", type=int, default=0, help="evaluate the categories in a process pool")
+    parser.add_argument(
+        "--class-subsets",
+        type=str,
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "class_subsets.json"),
+        help="json file with the named subsets of classes to report results for",
+    )
+    parser.add_argument("--output", type=str, default="", help="json file to save the results of every variant")
+
+    args = parser.parse_args()
+
+    stage_cache = StageOutputCache(args.cache_dir)
+    class_subsets = load_class_subsets(args.class_subsets)
+    print("Number of cached images: ", len(stage_cache.image_ids()))
+
+    all_results = {}
+    for variant in args.variants:
+        print("Fusion variant: ", variant)
+        predictions = refuse_predictions(stage_cache, FUSION_VARIANTS[variant], topk=args.topk)
+        all_results[variant] = eval_predictions(
+            predictions, args.lvis_data_split, class_subsets, num_workers=args.num_workers
+        )
+
+    for variant, results in all_results.items():
+        print(variant, json.dumps({metric: round(value, 2) for metric, value in results["bbox"].items()}))
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(all_results, f, indent=4)
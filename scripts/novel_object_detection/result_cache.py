@@ -0,0 +1,179 @@
+"""
+On-disk cache of the final detections of images seen before.
+
+Production traffic contains exact duplicates of images, for which the pipeline would recompute the same detections.
+`ResultCache` keeps the detections of an image under a key that hashes its bytes (`file_digest`, `array_digest`)
+together with a fingerprint of everything else the detections depend on: the configuration the cache is created with
+(e.g. `params.json`) and the prompts or vocabulary of the request. The entries are uncompressed `.npz` files in
+`cache_dir`, evicted least recently used first when their total size exceeds `max_bytes`; the most recent entries are
+also kept decoded in memory, so that a repeated request is answered without reading the disk. `NOD.infer` and the
+evaluation loop of `evaluation.py` use it when `param_dict["result_cache"]` is set.
+
+Entries are written to a temporary file renamed into place, so that an interrupted run never leaves a truncated entry,
+and their access order survives restarts through the modification times of the files.
+"""
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from detectron2.structures import Instances, Boxes
+
+
+def fingerprint(*values):
+    """Short hash of json-serializable `values` (other objects are hashed by their `str`)."""
+    data = json.dumps(values, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """Hash of the bytes of the file at `path`."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def bytes_digest(data):
+    """Hash of encoded image bytes, the same as `file_digest` of a file with these bytes."""
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def array_digest(array):
+    """Hash of a decoded image, its shape and dtype included."""
+    array = np.ascontiguousarray(array)
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update("{}{}".format(array.shape, array.dtype).encode("utf-8"))
+    digest.update(memoryview(array).cast("B"))
+    return digest.hexdigest()
+
+
+class ResultCache:
+    def __init__(self, cache_dir, max_bytes=10 << 30, config=None, max_memory_entries=256):
+        """
+        Args:
+            cache_dir (str): directory of the entries, created if needed
+            max_bytes (int): total size of the entries on disk above which the least recently used are evicted
+            config: json-serializable settings the detections depend on, part of every key
+            max_memory_entries (int): most recently used entries also kept in memory
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.config_fingerprint = fingerprint(config)
+        self.max_memory_entries = max_memory_entries
+        os.makedirs(cache_dir, exist_ok=True)
+
+        self.hits = 0
+        self.misses = 0
+        self.memory_hits = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()  # key -> Instances
+
+        # key -> size of the entries on disk, least recently used first
+        entries = []
+        for file_name in os.listdir(cache_dir):
+            if file_name.endswith(".npz"):
+                stat = os.stat(os.path.join(cache_dir, file_name))
+                entries.append((stat.st_mtime, file_name[:-len(".npz")], stat.st_size))
+        self._entries = OrderedDict((key, size) for _, key, size in sorted(entries))
+        self.num_bytes = sum(self._entries.values())
+
+    def key(self, image_digest, *request):
+        """Key of the detections of an image, given the hash of its bytes and the settings of the request."""
+        return fingerprint(image_digest, self.config_fingerprint, *request)
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, "{}.npz".format(key))
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def get(self, key):
+        """
+        Returns the cached `Instances` of `key` (shared, not to be modified), or None. A hit marks the entry as the most
+        recently used.
+        """
+        with self._lock:
+            if key in self._memory:
+                self._memory.move_to_end(key)
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self.memory_hits += 1
+                return self._memory[key]
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+
+        try:
+            with np.load(self.path(key)) as data:
+                instances = Instances(tuple(data["image_size"].tolist()))
+                instances.pred_boxes = Boxes(torch.from_numpy(data["boxes"]))
+                instances.scores = torch.from_numpy(data["scores"])
+                instances.pred_classes = torch.from_numpy(data["classes"])
+            os.utime(self.path(key))
+        except FileNotFoundError:  # evicted meanwhile by another process sharing the directory
+            with self._lock:
+                self.num_bytes -= self._entries.pop(key, 0)
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+            self._remember(key, instances)
+        return instances
+
+    def put(self, key, instances):
+        """Stores the `Instances` of `key` ("pred_boxes", "scores", "pred_classes"), then evicts down to `max_bytes`."""
+        instances = instances.to("cpu")
+        tmp_path = "{}.{}.tmp".format(self.path(key), threading.get_ident())
+        with open(tmp_path, "wb") as f:
+            np.savez(
+                f,
+                image_size=np.asarray(instances.image_size, dtype=np.int64),
+                boxes=instances.pred_boxes.tensor.numpy(),
+                scores=instances.scores.numpy(),
+                classes=instances.pred_classes.numpy(),
+            )
+        os.replace(tmp_path, self.path(key))
+        size = os.path.getsize(self.path(key))
+
+        with self._lock:
+            self.num_bytes += size - self._entries.pop(key, 0)
+            self._entries[key] = size
+            self._remember(key, instances)
+            while self.num_bytes > self.max_bytes and len(self._entries) > 1:
+                old_key, old_size = self._entries.popitem(last=False)
+                self._memory.pop(old_key, None)
+                self.num_bytes -= old_size
+                self.evictions += 1
+                try:
+                    os.remove(self.path(old_key))
+                except FileNotFoundError:
+                    pass
+
+    def _remember(self, key, instances):
+        self._memory[key] = instances
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_memory_entries:
+            self._memory.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return OrderedDict([
+                ("hits", self.hits),
+                ("misses", self.misses),
+                ("memory_hits", self.memory_hits),
+                ("hit_rate", self.hits / max(1, self.hits + self.misses)),
+                ("entries", len(self._entries)),
+                ("bytes", self.num_bytes),
+                ("evictions", self.evictions),
+            ])
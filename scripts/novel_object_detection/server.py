@@ -0,0 +1,422 @@
+"""
+Long-running local inference server of the NOD pipeline.
+
+`inference_single_image.py` loads the four models for every invocation. The server loads them once, runs a warm-up
+image, and then serves detections over HTTP/1.1 (keep-alive) on a TCP port or a Unix socket:
+
+    POST /detect?prompt=dog%20.&prompt=cat%20.&score_threshold=0.3    body: the encoded image (jpg, png, ...)
+    POST /detect?class=license%20plate&class=traffic%20cone
+    GET  /stats
+
+The prompts are optional (the whole LVIS vocabulary by default, as in `main.py`); with `class` parameters the request
+has its own vocabulary (see `vocabulary.py`) and the class ids index it. The response is JSON:
+    {"height": h, "width": w, "detections": [{"box": [x1, y1, x2, y2], "score": s, "class_id": c, "class_name": n}],
+     "batch_size": b, "queue_ms": q, "inference_ms": t}
+
+Images are decoded by the connection threads. `DynamicBatcher` then groups the requests received within
+`--max-wait-ms` of the first pending one (at most `--max-batch-size`) and runs them through `NOD.infer_batch`, so
+that every stage (RCNN, CLIP, GDINO, SAM encoder) runs once per batch instead of once per request. With
+`--result-cache`, the request of an image already seen with the same prompts is answered from the cache, before the
+image is decoded (see `result_cache.py`).
+
+Usage, from the project root, with the checkpoints set in `params.json`:
+    python scripts/novel_object_detection/server.py --port 8000
+    python scripts/novel_object_detection/server.py --unix-socket /tmp/nod.sock
+or, on CPU with the random-weight models of `benchmark.py`:
+    python scripts/novel_object_detection/server.py --benchmark-models
+`load_generator.py` is a client of the server and sends it concurrent requests.
+"""
+import os
+import sys
+import json
+import argparse
+import itertools
+import logging
+import queue
+import socketserver
+import threading
+import time
+
+proj_path = os.path.abspath(os.path.join(os.path.dirname(__file__), "../../"))
+sys.path.append(proj_path)
+
+script_dir = os.path.dirname(os.path.abspath(__file__))
+
+outputs_dir = os.path.normpath(os.path.join(script_dir, "../../outputs/server"))
+
+import numpy as np
+import torch
+
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import urlparse, parse_qs
+from detectron2.data import MetadataCatalog
+
+from main import (
+    build_model_registry, build_result_cache, params, lvis_data_split, class_len_per_prompt, model_load_workers
+)
+from benchmark import DATASET_NAME, load_benchmark_models, build_param_dict
+from datasets.synthetic_lvis import register_synthetic_lvis
+from utils import decode_image
+from result_cache import bytes_digest
+from profiling import StageProfiler
+from nod_model import NOD
+
+logger = logging.getLogger(__name__)
+
+
+class DynamicBatcher:
+    """
+    Groups the items submitted from concurrent threads into batches, processed one after the other by a single
+    worker thread: a batch starts with the oldest pending item and closes when it has `max_batch_size` items, or
+    `max_wait_ms` after that item was submitted (items already queued by then are still added). A lone item thus
+    waits at most `max_wait_ms`, and under load the batches fill up without waiting.
+    """
+
+    def __init__(self, process_batch, max_batch_size=4, max_wait_ms=10.0):
+        """
+        Args:
+            process_batch (callable): list of items -> list of results, in the same order
+        """
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self.num_requests = 0
+        self.num_batches = 0
+        self.batch_sizes = OrderedDict()
+        self._thread = threading.Thread(target=self._run, name="dynamic_batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, item):
+        """Returns a future of the result of `item`, with the batch size and the time it waited in the queue."""
+        future = Future()
+        self._queue.put((item, future, time.perf_counter()))
+        return future
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def stats(self):
+        with self._lock:
+            return OrderedDict([
+                ("num_requests", self.num_requests),
+                ("num_batches", self.num_batches),
+                ("mean_batch_size", self.num_requests / self.num_batches if self.num_batches else 0.0),
+                ("batch_sizes", OrderedDict((str(size), count) for size, count in sorted(self.batch_sizes.items()))),
+            ])
+
+    def _next_batch(self):
+        first = self._queue.get()
+        if first is None:
+            return None
+        batch = [first]
+        deadline = first[2] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            try:
+                timeout = deadline - time.perf_counter()
+                entry = self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait()
+            except queue.Empty:
+                break
+            if entry is None:  # close() was called, finish this batch first
+                self._queue.put(None)
+                break
+            batch.append(entry)
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            start = time.perf_counter()
+            with self._lock:
+                self.num_requests += len(batch)
+                self.num_batches += 1
+                self.batch_sizes[len(batch)] = self.batch_sizes.get(len(batch), 0) + 1
+            try:
+                results = self.process_batch([item for item, _, _ in batch])
+            except Exception as e:
+                logger.exception("Batch of {} failed".format(len(batch)))
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            for result, (_, future, submitted) in zip(results, batch):
+                future.set_result((result, len(batch), (start - submitted) * 1000))
+
+
+def load_nod(benchmark_models, device, profiler, vocabulary_shards = 1, result_cache = None):
+    """Returns the NOD pipeline, its default prompts and the dataset whose class names are the labels."""
+    if benchmark_models:
+        register_synthetic_lvis(DATASET_NAME, os.path.normpath(os.path.join(outputs_dir, "../benchmark/data")))
+        models, _ = load_benchmark_models(device)
+        data_split = DATASET_NAME
+    else:
+        registry = build_model_registry(device)
+        registry.preload(max_workers = model_load_workers)
+        models = (registry["gdino"], *registry["rcnn"], *registry["clip"][:3], registry["sam"])
+        data_split = lvis_data_split
+
+    text_prompt_list, param_dict = build_param_dict(models, outputs_dir, class_len_per_prompt, device, data_split)
+    param_dict["profiler"] = profiler
+    param_dict["vocabulary_shards"] = vocabulary_shards
+    param_dict["result_cache"] = result_cache
+    return NOD(param_dict, models[0]), text_prompt_list, data_split
+
+
+class NODService:
+    """Runs the requests of the HTTP handler through a warm `NOD` pipeline, batched by a `DynamicBatcher`."""
+
+    def __init__(self, nod_model, text_prompt_list, class_names, max_batch_size, max_wait_ms, score_threshold):
+        self.nod_model = nod_model
+        self.text_prompt_list = text_prompt_list
+        self.class_names = class_names
+        self.score_threshold = score_threshold
+        self.batcher = DynamicBatcher(self._process_batch, max_batch_size, max_wait_ms)
+
+    def _process_batch(self, requests):
+        start = time.perf_counter()
+        vocabularies = [
+            self.nod_model.build_vocabulary(request["classes"]) if request["classes"] else None for request in requests
+        ]
+        outputs = self.nod_model.infer_batch(
+            [request["name"] for request in requests],
+            [request["prompts"] or self.text_prompt_list for request in requests],
+            visualize = False,
+            images = [request["image"] for request in requests],
+            vocabularies = vocabularies,
+        )
+        inference_ms = (time.perf_counter() - start) * 1000
+        for request, output in zip(requests, outputs):
+            if request["cache_key"] is not None:
+                self.nod_model.result_cache.put(request["cache_key"], output["instances"])
+        return [
+            self._to_json(
+                output["instances"].to("cpu"),
+                request["score_threshold"],
+                inference_ms,
+                vocabulary.class_names if vocabulary is not None else self.class_names,
+            )
+            for request, output, vocabulary in zip(requests, outputs, vocabularies)
+        ]
+
+    def _to_json(self, instances, score_threshold, inference_ms, class_names):
+        if score_threshold is None:
+            score_threshold = self.score_threshold
+        keep = instances.scores >= score_threshold
+        boxes = instances.pred_boxes.tensor[keep].tolist()
+        scores = instances.scores[keep].tolist()
+        classes = instances.pred_classes[keep].tolist()
+
+        height, width = instances.image_size
+        return OrderedDict([
+            ("height", height),
+            ("width", width),
+            ("detections", [
+                OrderedDict([
+                    ("box", box), ("score", score), ("class_id", class_id), ("class_name", class_names[class_id]),
+                ])
+                for box, score, class_id in zip(boxes, scores, classes)
+            ]),
+            ("inference_ms", inference_ms),
+        ])
+
+    def _cache_key(self, image_digest, prompts, classes):
+        vocabulary = self.nod_model.build_vocabulary(classes) if classes else None
+        return self.nod_model.result_cache_key(
+            None, None, prompts or self.text_prompt_list, vocabulary, image_digest = image_digest
+        )
+
+    def cached_response(self, image_digest, prompts=None, score_threshold=None, classes=None):
+        """
+        Response of an image whose encoded bytes hash to `image_digest`, from the result cache of the pipeline, or None
+        when it is not cached (or there is no cache). The image does not need to be decoded.
+        """
+        if self.nod_model.result_cache is None:
+            return None
+        instances = self.nod_model.result_cache.get(self._cache_key(image_digest, prompts, classes))
+        if instances is None:
+            return None
+        class_names = self.nod_model.build_vocabulary(classes).class_names if classes else self.class_names
+        response = self._to_json(instances, score_threshold, 0.0, class_names)
+        response["batch_size"] = 0
+        response["queue_ms"] = 0.0
+        return response
+
+    def detect(self, image, name, prompts=None, score_threshold=None, classes=None, image_digest=None):
+        """
+        Blocks until the batch of this request is processed; returns its JSON-serializable response. With the
+        `image_digest` of its encoded bytes, the detections are added to the result cache of the pipeline.
+        """
+        cache_key = None
+        if self.nod_model.result_cache is not None and image_digest is not None:
+            cache_key = self._cache_key(image_digest, prompts, classes)
+        future = self.batcher.submit({
+            "image": image, "name": name, "prompts": prompts, "score_threshold": score_threshold, "classes": classes,
+            "cache_key": cache_key,
+        })
+        response, batch_size, queue_ms = future.result()
+        response["batch_size"] = batch_size
+        response["queue_ms"] = queue_ms
+        return response
+
+    def stats(self):
+        stats = self.batcher.stats()
+        if self.nod_model.vocabulary_builder is not None:
+            stats["vocabulary_caches"] = self.nod_model.vocabulary_builder.stats()
+        if self.nod_model.profiler.enabled:
+            stats["stages"] = self.nod_model.profiler.summary()
+        if self.nod_model.result_cache is not None:
+            stats["result_cache"] = self.nod_model.result_cache.stats()
+        return stats
+
+
+class NODRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, so that a client does not pay a connection per request
+
+    def do_GET(self):
+        if urlparse(self.path).path != "/stats":
+            self._send_json(404, {"error": "unknown path {}".format(self.path)})
+            return
+        self._send_json(200, self.server.service.stats())
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if url.path != "/detect":
+            self._send_json(404, {"error": "unknown path {}".format(url.path)})
+            return
+
+        query = parse_qs(url.query)
+        image_digest = bytes_digest(body)
+        try:
+            score_threshold = float(query["score_threshold"][0]) if "score_threshold" in query else None
+            response = self.server.service.cached_response(
+                image_digest, query.get("prompt"), score_threshold, query.get("class")
+            )
+            if response is not None:  # an image seen before, answered without decoding it
+                self._send_json(200, response)
+                return
+            image = decode_image(body, format = "RGB")
+        except Exception as e:
+            self._send_json(400, {"error": "invalid request: {}".format(e)})
+            return
+
+        name = query.get("name", ["request_{}.jpg".format(next(self.server.request_ids))])[0]
+        try:
+            response = self.server.service.detect(
+                image, name, query.get("prompt"), score_threshold, query.get("class"), image_digest = image_digest
+            )
+        except Exception as e:
+            self._send_json(500, {"error": "inference failed: {}".format(e)})
+            return
+        self._send_json(200, response)
+
+    def _send_json(self, status, content):
+        body = json.dumps(content).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # the client address of a Unix socket is an empty string, so `address_string()` can not be used
+        logger.debug(format % args)
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.remove(self.server_address)
+        socketserver.UnixStreamServer.server_bind(self)
+
+
+def warm_up(service, image_size=(480, 640)):
+    """
+    One request through every stage, so that the first client does not pay for lazy CUDA/cuDNN initialization, then a
+    batch of two images of different sizes, as the batcher groups them, so that a failure of the padding of mixed sizes
+    stops the server at startup instead of failing every batch of requests.
+    """
+    image = np.full((image_size[0], image_size[1], 3), 114, dtype = np.uint8)
+    start = time.perf_counter()
+    service.detect(image, "warmup.jpg")
+    logger.info("Warm-up request done in {:.2f}s".format(time.perf_counter() - start))
+
+    start = time.perf_counter()
+    service.nod_model.infer_batch(
+        ["warmup_0.jpg", "warmup_1.jpg"],
+        [service.text_prompt_list] * 2,
+        visualize = False,
+        images = [image, np.ascontiguousarray(image.transpose(1, 0, 2))],
+    )
+    logger.info("Warm-up batch of mixed sizes done in {:.2f}s".format(time.perf_counter() - start))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="NOD inference server with dynamic batching")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--unix-socket", type=str, default="", help="serve on this Unix socket instead of a port")
+    parser.add_argument("--max-batch-size", type=int, default=4)
+    parser.add_argument("--max-wait-ms", type=float, default=10.0, help="how long a request waits for others")
+    parser.add_argument("--score-threshold", type=float, default=0.0, help="default minimum score of the detections")
+    parser.add_argument("--benchmark-models", action="store_true", help="random-weight CPU models of benchmark.py")
+    parser.add_argument("--profile", action="store_true", help="report the latency of every stage in /stats")
+    parser.add_argument(
+        "--profile-window", type=int, default=1000, help="number of the last requests the /stats latencies are over"
+    )
+    parser.add_argument(
+        "--vocabulary-shards", type=int, default=1, help="parallel shards of the prompts of single-image batches"
+    )
+    parser.add_argument(
+        "--result-cache", type=str, default="",
+        help="directory of a disk cache of the detections, answering repeated images without running the pipeline",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level = logging.INFO)
+    Path(outputs_dir).mkdir(parents=True, exist_ok=True)
+
+    device = "cpu" if args.benchmark_models or not torch.cuda.is_available() else "cuda"
+    nod_model, text_prompt_list, data_split = load_nod(
+        args.benchmark_models,
+        device,
+        StageProfiler(enabled = args.profile, num_warmup = 2, max_images = args.profile_window),
+        args.vocabulary_shards,
+        # keyed as the other entry points, so that they share the cache, but with the random-weight models
+        build_result_cache(params, args.result_cache, {"benchmark_models": True} if args.benchmark_models else None),
+    )
+    service = NODService(
+        nod_model,
+        text_prompt_list,
+        MetadataCatalog.get(data_split).thing_classes,
+        args.max_batch_size,
+        args.max_wait_ms,
+        args.score_threshold,
+    )
+    warm_up(service)
+
+    if args.unix_socket:
+        server = ThreadingUnixHTTPServer(args.unix_socket, NODRequestHandler)
+        address = args.unix_socket
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), NODRequestHandler)
+        address = "http://{}:{}".format(args.host, args.port)
+    server.service = service
+    server.request_ids = itertools.count()
+
+    logger.info("Serving on {}".format(address))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.batcher.close()
@@ -0,0 +1,35 @@
+"""
+Vocabulary sharding of the class-dependent stages of one image.
+
+The GDINO prompts (chunks of `class_len_per_prompt` classes) and the row blocks of the SigLIP `text_features` are
+independent of each other: `NOD` can run them as shards in a pool of threads, each keeping the top-k of its own
+classes, and merge the partial results with `merge_topk`. The top-k of a union is in the union of the top-k of its
+parts, so the merge is exact: it returns the values of `torch.topk` on the whole score matrix, in the same descending
+order.
+"""
+import torch
+
+
+def shard_ranges(num_items, num_shards):
+    """Splits `range(num_items)` into at most `num_shards` contiguous (start, end) ranges of balanced sizes."""
+    num_shards = max(1, min(num_shards, num_items))
+    bounds = [num_items * shard // num_shards for shard in range(num_shards + 1)]
+    return [(start, end) for start, end in zip(bounds[:-1], bounds[1:]) if end > start]
+
+
+def merge_topk(values, indices, k):
+    """
+    Top-`k` along the last dimension of candidates gathered from the partial top-k of several shards.
+
+    Args:
+        values (Tensor): (..., M) scores of the candidates
+        indices (Tensor): (..., M) their indices in the whole score matrix, which break ties (smallest first)
+    Returns:
+        values, indices (Tensor): (..., k) the top-k, in descending order
+        positions (Tensor): (..., k) their positions among the candidates, to gather other per-candidate data
+    """
+    k = min(k, values.shape[-1])
+    order = indices.argsort(dim = -1)
+    _, rank = torch.sort(values.gather(-1, order), dim = -1, descending = True, stable = True)
+    positions = order.gather(-1, rank[..., :k])
+    return values.gather(-1, positions), indices.gather(-1, positions), positions
@@ -0,0 +1,122 @@
+"""
+Raw per-stage outputs of the NOD pipeline, their score fusion, and an on-disk cache of them.
+
+`inference_gdino` runs four models per image: Mask-RCNN (known classes), CLIP on the crops of the RCNN background
+boxes, Grounding DINO (top-300 over the whole vocabulary) and SAM on the union of all these boxes. The fusion of their
+outputs is cheap, so the raw outputs of every stage can be cached once and the fusion (or a stage ablation) re-applied
+offline, see `refuse_from_cache.py`.
+
+Stage outputs of one image are a dict of tensors, rows of the SAM outputs following the order of `SOURCES`:
+    rcnn_boxes, rcnn_scores, rcnn_classes      known-class RCNN detections (LVIS contiguous ids)
+    clip_boxes, clip_scores, clip_classes      RCNN background boxes with their CLIP top-1 class
+    gdino_boxes, gdino_scores, gdino_classes   Grounding DINO top-k detections
+    sam_boxes, sam_scores                      SAM refined boxes and predicted IoU of every box above
+Boxes are (x1, y1, x2, y2) in original image coordinates.
+"""
+import os
+from collections import OrderedDict
+
+import numpy as np
+import torch
+from sklearn.preprocessing import MinMaxScaler
+
+SOURCES = ("rcnn", "clip", "gdino")
+
+# name -> kwargs of `fuse_stage_outputs()`; "full" is the fusion used by `inference_gdino`
+FUSION_VARIANTS = OrderedDict([
+    ("full", dict(sources=("rcnn", "clip", "gdino"), use_sam=True)),
+    ("no_sam", dict(sources=("rcnn", "clip", "gdino"), use_sam=False)),
+    ("no_gdino", dict(sources=("rcnn", "clip"), use_sam=True)),
+    ("no_gdino_no_sam", dict(sources=("rcnn", "clip"), use_sam=False)),
+    ("no_clip", dict(sources=("rcnn", "gdino"), use_sam=True)),
+    ("gdino_only", dict(sources=("gdino",), use_sam=True)),
+    ("gdino_only_no_sam", dict(sources=("gdino",), use_sam=False)),
+])
+
+
+def fuse_stage_outputs(stage_outputs, sources=SOURCES, use_sam=True, topk=300):
+    """
+    Score fusion of `inference_gdino`: the scores of the selected `sources` are MinMax-normalized together, multiplied
+    by the MinMax-normalized SAM IoU predictions of the same boxes (which are replaced by the SAM refined boxes), and
+    the `topk` highest are kept. With `use_sam=False` the normalized scores and the original boxes are used directly.
+
+    Returns:
+        boxes, scores, labels of the `topk` fused detections
+    """
+    keep = torch.cat([
+        torch.full((len(stage_outputs[source + "_scores"]),), source in sources, dtype=torch.bool)
+        for source in SOURCES
+    ])
+
+    boxes = torch.cat([stage_outputs[source + "_boxes"] for source in sources], dim = 0)
+    scores = torch.cat([stage_outputs[source + "_scores"] for source in sources], dim = 0)
+    labels = torch.cat([stage_outputs[source + "_classes"] for source in sources], dim = 0)
+
+    labels = labels.to(torch.int64)
+
+    # Standardize the combined scores of RCNN and GDINO
+    scaler = MinMaxScaler()
+    dtype = scores.dtype
+    scores = scaler.fit_transform(scores.reshape(-1, 1)).reshape(-1)
+    scores = torch.tensor(scores, dtype = dtype)
+
+    if use_sam:
+        boxes = stage_outputs["sam_boxes"][keep.to(stage_outputs["sam_boxes"].device)]
+
+        # Standardize the SAM scores
+        scaler_sam = MinMaxScaler()
+        sam_scores = stage_outputs["sam_scores"][keep]
+        sam_scores = scaler_sam.fit_transform(sam_scores.reshape(-1, 1)).reshape(-1)
+        sam_scores = torch.tensor(sam_scores, dtype = scores.dtype)
+
+        scores = scores * sam_scores
+
+    topk_scores, topk_idxs = torch.topk(scores, min(topk, len(scores)))
+
+    return boxes[topk_idxs.to(boxes.device)], topk_scores, labels[topk_idxs]
+
+
+class StageOutputCache:
+    """
+    Stage outputs stored as one compressed `<image_id>.npz` file per image in `cache_dir`. Class ids and SAM boxes
+    (integer pixel coordinates) are stored as int32, everything else keeps its dtype so the fusion is reproduced
+    exactly.
+    """
+
+    int32_fields = ("rcnn_classes", "clip_classes", "gdino_classes", "sam_boxes")
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def path(self, image_id):
+        return os.path.join(self.cache_dir, "{}.npz".format(image_id))
+
+    def __contains__(self, image_id):
+        return os.path.isfile(self.path(image_id))
+
+    def image_ids(self):
+        return sorted(int(f[:-len(".npz")]) for f in os.listdir(self.cache_dir) if f.endswith(".npz"))
+
+    def save(self, image_id, image_size, stage_outputs):
+        arrays = {"image_size": np.asarray(image_size, dtype=np.int64)}
+        for name, value in stage_outputs.items():
+            value = value.detach().to("cpu").numpy()
+            arrays[name] = value.astype(np.int32) if name in self.int32_fields else value
+
+        # write to a temporary file first so that an interrupted run never leaves a truncated entry
+        tmp_path = self.path(image_id) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez_compressed(f, **arrays)
+        os.replace(tmp_path, self.path(image_id))
+
+    def load(self, image_id):
+        """Returns (height, width) and the stage outputs of `image_id`."""
+        with np.load(self.path(image_id)) as data:
+            image_size = tuple(data["image_size"].tolist())
+            stage_outputs = {
+                name: torch.from_numpy(data[name].astype(np.int64) if name in self.int32_fields else data[name])
+                for name in data.files
+                if name != "image_size"
+            }
+        return image_size, stage_outputs
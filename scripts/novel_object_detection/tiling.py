@@ -0,0 +1,90 @@
+"""
+Tiled inference of images much larger than the input sizes of the models.
+
+Every stage resizes its input (800/1333 for RCNN and GDINO, 1024 for SAM), so a 4K image is seen at a third of its
+resolution and its small objects are lost, while upscaling the inputs would grow the memory of every stage with the
+image. `NOD.infer_tiled` instead splits the image into overlapping windows of at most `tile_size` pixels
+(`tile_windows`), runs the pipeline on batches of windows, each at the usual input sizes so that the memory of a batch
+does not depend on the image, and merges the detections with `merge_tile_detections`:
+- a detection touching a side of its window that is inside the image is cut by the window: it is dropped, the object
+  is whole in a neighbouring window when it is smaller than the overlap;
+- the whole image, at the usual resolution, is one more view for the objects larger than the overlap, which no
+  window contains;
+- the detections of all views, in image coordinates, are merged by class-wise NMS.
+"""
+import math
+
+import torch
+from torchvision.ops.boxes import batched_nms
+
+
+def _tile_starts(length, tile_size, overlap):
+    if length <= tile_size:
+        return [0]
+    num_tiles = math.ceil((length - tile_size) / (tile_size - overlap)) + 1
+    # the windows are spread evenly, so that the overlaps are at least `overlap` and the last window ends at the border
+    return [round(idx * (length - tile_size) / (num_tiles - 1)) for idx in range(num_tiles)]
+
+
+def tile_windows(height, width, tile_size, overlap):
+    """
+    Returns:
+        list[tuple[int, int, int, int]]: (x0, y0, x1, y1) windows of at most `tile_size` pixels covering the image,
+            overlapping by at least `overlap` pixels
+    """
+    if not 0 <= overlap < tile_size:
+        raise ValueError("The tile overlap must be in [0, tile_size), got {}".format(overlap))
+    return [
+        (x0, y0, min(x0 + tile_size, width), min(y0 + tile_size, height))
+        for y0 in _tile_starts(height, tile_size, overlap)
+        for x0 in _tile_starts(width, tile_size, overlap)
+    ]
+
+
+def inside_window(boxes, window, image_size, margin=4):
+    """
+    (N,) mask of the `boxes` (in image coordinates) that do not touch a side of `window` inside the image, i.e. that
+    the window does not cut.
+    """
+    x0, y0, x1, y1 = window
+    height, width = image_size
+    keep = torch.ones(len(boxes), dtype=torch.bool, device=boxes.device)
+    if x0 > 0:
+        keep &= boxes[:, 0] > x0 + margin
+    if y0 > 0:
+        keep &= boxes[:, 1] > y0 + margin
+    if x1 < width:
+        keep &= boxes[:, 2] < x1 - margin
+    if y1 < height:
+        keep &= boxes[:, 3] < y1 - margin
+    return keep
+
+
+def merge_tile_detections(detections, windows, image_size, iou_threshold=0.5, max_detections=1000, margin=4):
+    """
+    Args:
+        detections (list[tuple[Tensor, Tensor, Tensor]]): boxes (in window coordinates), scores and labels of every
+            view; the view of a window equal to the whole image is kept whole
+        windows (list[tuple[int, int, int, int]]): (x0, y0, x1, y1) of every view
+        image_size (tuple[int, int]): (height, width) of the image
+    Returns:
+        boxes, scores, labels of at most `max_detections` detections, in image coordinates, by descending score
+    """
+    height, width = image_size
+    all_boxes, all_scores, all_labels = [], [], []
+    for (boxes, scores, labels), window in zip(detections, windows):
+        offset = torch.tensor([window[0], window[1], window[0], window[1]], dtype=torch.float32)
+        boxes = boxes.to("cpu").float() + offset
+        keep = inside_window(boxes, window, image_size, margin)
+        all_boxes.append(boxes[keep])
+        all_scores.append(scores.to("cpu").float()[keep])
+        all_labels.append(labels.to("cpu")[keep])
+
+    boxes = torch.cat(all_boxes)
+    scores = torch.cat(all_scores)
+    labels = torch.cat(all_labels).to(torch.int64)
+    boxes[:, 0::2] = boxes[:, 0::2].clamp(0, width)
+    boxes[:, 1::2] = boxes[:, 1::2].clamp(0, height)
+
+    keep = batched_nms(boxes, scores, labels, iou_threshold)[:max_detections]
+    return boxes[keep], scores[keep], labels[keep]
@@ -1,3 +1,4 @@
+import io
 import numpy as np
 import matplotlib.colors as mcolors
 import torch
@@ -7,6 +8,7 @@ import matplotlib as mpl
 import random
 
 from detectron2.data import MetadataCatalog
+from scripts.label_space import LabelMap
 from torch import nn
 from detectron2.utils.visualizer import _create_text_labels, Visualizer
 from typing import List
@@ -167,46 +169,33 @@ def get_text_prompt_list_for_g_dino(lvis_data_split, tokenizer, class_len_per_pr
     text_prompt_list = []
     positive_map_list = []
     for lvis_classes_subset in lvis_classes_split:
-        captions, cat2tokenspan = build_captions_and_token_span(lvis_classes_subset, True)
-        tokenspanlist = [cat2tokenspan[cat] for cat in lvis_classes_subset]
-        positive_map = create_positive_map_from_span(tokenizer(captions), tokenspanlist) # shape: (num_categories, 256)
+        captions, positive_map = build_text_prompt(lvis_classes_subset, tokenizer)
         positive_map_list.append(positive_map)
 
         text_prompt_list.append(captions)
 
     return text_prompt_list, positive_map_list
 
-def get_coco_to_lvis_mapping(cfg, lvis_data_split):
+def build_text_prompt(classes, tokenizer):
+    """GDINO prompt of a chunk of (lower case) class names, and its (num_categories, 256) positive map."""
+    captions, cat2tokenspan = build_captions_and_token_span(classes, True)
+    tokenspanlist = [cat2tokenspan[cat] for cat in classes]
+    positive_map = create_positive_map_from_span(tokenizer(captions), tokenspanlist) # shape: (num_categories, 256)
+    return captions, positive_map
 
-    # covert coco_meta_data thing class idx to lvis idx
-    coco_to_lvis = {}
-    not_found_list = []
-    found_list = []
+def get_coco_to_lvis_mapping(cfg, lvis_data_split):
+    """
+    `LabelMap` of the COCO thing class ids to the LVIS class ids of the same name (-1 if none), with the hand-made
+    entries below for the COCO classes LVIS names differently.
+    """
     coco_meta_data = MetadataCatalog.get("coco_2017_train")
     lvis_metadata = MetadataCatalog.get(lvis_data_split)
     lvis_classes = lvis_metadata.get("thing_classes")
 
-    for idx, coco_class in enumerate(coco_meta_data.thing_classes):
-        if coco_class in lvis_classes:
-            lvis_idx = lvis_classes.index(coco_class)
-            coco_to_lvis[idx] = lvis_idx
-            found_list.append(coco_class)
-        else:
-            coco_class = "_".join(coco_class.split(" "))
-            if coco_class in lvis_classes:
-                lvis_idx = lvis_classes.index(coco_class)
-                coco_to_lvis[idx] = lvis_idx
-                found_list.append(coco_class)
-            else:
-                not_found_list.append(coco_class)
-                coco_to_lvis[idx] = -1
-        
-
-    name_to_idx = {}
-    for name in not_found_list:
-        name = name.replace("_", " ")
-        name_to_idx[name] = coco_meta_data.thing_classes.index(name)
-
+    # covert coco_meta_data thing class idx to lvis idx, the LVIS names use "_" instead of spaces
+    coco_to_lvis = LabelMap.from_names(
+        coco_meta_data.thing_classes, lvis_classes, normalize = lambda name: name.replace(" ", "_")
+    )
 
     # initially idx 52 could not be mapped, i.e. "hot dog" in coco
     # mapped idx 52 to 168, i.e. "bun" in lvis
@@ -238,14 +227,28 @@ def get_coco_to_lvis_mapping(cfg, lvis_data_split):
     return coco_to_lvis
 
 def get_clip_preds(img, clip_model, text_features):
+    return classify_clip_features(encode_clip_images(img, clip_model), clip_model, text_features)
 
+def encode_clip_images(img, clip_model):
+    """Normalized CLIP embeddings of a batch of preprocessed images, which do not depend on the vocabulary."""
     with torch.no_grad(), torch.cuda.amp.autocast():
         img_features = clip_model.encode_image(img) 
         img_features = F.normalize(img_features, dim=-1)
 
-        text_probs = torch.sigmoid(img_features @ text_features.T * clip_model.logit_scale.exp() + clip_model.logit_bias) # shape: torch.Size([N, 1203])
+    return img_features
+
+def clip_class_probs(img_features, clip_model, text_features):
+    """(N, num_classes) SigLIP sigmoid scores of the image embeddings `img_features` against `text_features`."""
+    with torch.no_grad(), torch.cuda.amp.autocast():
+        logits = img_features @ text_features.T * clip_model.logit_scale.exp() + clip_model.logit_bias
+        return torch.sigmoid(logits) # shape: torch.Size([N, 1203])
+
+def classify_clip_features(img_features, clip_model, text_features, k=1):
+    """Top-`k` sigmoid scores and classes of the image embeddings `img_features` against `text_features`."""
+    with torch.no_grad(), torch.cuda.amp.autocast():
+        text_probs = clip_class_probs(img_features, clip_model, text_features)
 
-        values, indices = text_probs.topk(1)
+        values, indices = text_probs.topk(k)
 
     return values, indices
 
@@ -357,4 +360,12 @@ def read_image(file_name, format=None):
 
         # work around this bug: https://github.com/python-pillow/Pillow/issues/3973
         image = _apply_exif_orientation(image)
-        return convert_PIL_to_numpy(image, format)
\ No newline at end of file
+        return convert_PIL_to_numpy(image, format)
+
+def decode_image(data, format=None):
+    """
+    Same as `read_image`, for the encoded bytes of an image (e.g. the body of a request) instead of a file.
+    """
+    image = Image.open(io.BytesIO(data))
+    image = _apply_exif_orientation(image)
+    return convert_PIL_to_numpy(image, format)
@@ -0,0 +1,239 @@
+"""
+Detection on video streams, reusing the results of the previous frames.
+
+Consecutive frames of a camera are nearly identical, yet `NOD.infer` would run GDINO with every prompt of the
+vocabulary and the SAM ViT-H encoder on each of them. `NODVideoStream` runs the full pipeline only on keyframes, and
+cheaper passes in between:
+- keyframe, every `keyframe_interval` frames or when the frame differs from the last processed one by more than
+  `scene_change_threshold`: `NOD.infer_batch` with the whole vocabulary. The classes of its detections scored at least
+  `hypothesis_threshold` are the class hypotheses of the next frames;
+- intermediate frame: GDINO is prompted with the hypotheses only (a single prompt for up to `class_len_per_prompt`
+  classes). The raw GDINO detections of the previous frame are added to those of this frame as GDINO candidates, with
+  their GDINO score and class, and SAM snaps their boxes to the objects that moved a little. Only the detections of
+  the GDINO run of a frame are carried to the next one, not those it received, so that a box lasts at most one frame
+  after GDINO last found it and the fused scores of a frame never feed the fusion of the next;
+- frame differing from the last processed one by less than `skip_threshold`: no stage runs, the previous detections are
+  returned.
+The RCNN, CLIP and the SAM image encoder still run on every frame that is not skipped; only GDINO is cheaper.
+The frame difference is the mean absolute difference of small grayscale thumbnails, in [0, 1].
+"""
+import os
+
+import cv2
+import numpy as np
+import torch
+from detectron2.data import MetadataCatalog
+from detectron2.structures import Instances, Boxes
+
+from stage_outputs import fuse_stage_outputs
+
+
+def read_video_frames(video_path):
+    """Decoded RGB frames of a video file, one at a time."""
+    capture = cv2.VideoCapture(str(video_path))
+    try:
+        while True:
+            ok, frame = capture.read()
+            if not ok:
+                break
+            yield np.ascontiguousarray(frame[:, :, ::-1])
+    finally:
+        capture.release()
+
+
+def frame_thumbnail(frame, size=64):
+    """Grayscale thumbnail of an RGB frame, with values in [0, 1], to compare frames cheaply."""
+    gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+    return cv2.resize(gray, (size, size), interpolation = cv2.INTER_AREA).astype(np.float32) / 255
+
+
+class NODVideoStream:
+    """
+    Detections of the frames of one video, in order:
+
+        stream = nod_model.video_stream(vocabulary = vocabulary)
+        for frame in read_video_frames("camera.mp4"):
+            instances = stream.process(frame)[0]["instances"]
+        print(stream.stats)
+    """
+
+    def __init__(
+        self,
+        nod_model,
+        text_prompt_list = None,
+        vocabulary = None,
+        keyframe_interval = 30,
+        scene_change_threshold = 0.1,
+        skip_threshold = 0.005,
+        hypothesis_threshold = 0.3,
+        max_hypotheses = 64,
+        max_propagated_boxes = 100,
+    ):
+        """
+        Args:
+            text_prompt_list, vocabulary: as for `NOD.infer`, the prompts of the keyframes
+            keyframe_interval (int): at most this many frames between two keyframes
+            scene_change_threshold, skip_threshold (float): frame differences above which a frame is a keyframe, and
+                below which its stages are skipped
+            hypothesis_threshold (float): score of the keyframe detections whose classes the next frames look for
+            max_hypotheses (int): at most this many classes, the best scored
+            max_propagated_boxes (int): at most this many GDINO detections of a frame, the best scored, added to the
+                candidates of the next one
+        """
+        self.nod_model = nod_model
+        self.vocabulary = vocabulary
+        self.text_prompt_list = vocabulary.text_prompt_list if vocabulary is not None else text_prompt_list
+        self.keyframe_interval = keyframe_interval
+        self.scene_change_threshold = scene_change_threshold
+        self.skip_threshold = skip_threshold
+        self.hypothesis_threshold = hypothesis_threshold
+        self.max_hypotheses = max_hypotheses
+        self.max_propagated_boxes = max_propagated_boxes
+
+        if vocabulary is not None:
+            self.class_names = vocabulary.class_names
+        else:
+            self.class_names = MetadataCatalog.get(nod_model.lvis_data_split).thing_classes
+
+        self.num_frames = 0
+        self.stats = {"keyframes": 0, "intermediate_frames": 0, "skipped_frames": 0}
+        self._frames_since_keyframe = 0
+        self._last_thumbnail = None
+        self._last_instances = None
+        self._last_gdino = None  # raw (boxes, scores, classes) of the GDINO run of the last processed frame
+        self._hypotheses = None  # (text_prompt_list, positive_map_list, class_ids) of the last keyframe classes
+
+    def _frame_difference(self, thumbnail):
+        if self._last_thumbnail is None:
+            return float("inf")
+        return float(np.abs(thumbnail - self._last_thumbnail).mean())
+
+    @torch.no_grad()
+    def process(self, frame, visualize = False, out_dir = None, confidence_threshold = 0.5):
+        """
+        Args:
+            frame (np.ndarray): the next RGB frame
+        Returns:
+            list[dict]: as `NOD.infer`, one dict with key "instances"
+        """
+        frame_name = "frame_{:06d}.jpg".format(self.num_frames)
+        self.num_frames += 1
+
+        thumbnail = frame_thumbnail(frame)
+        difference = self._frame_difference(thumbnail)
+        if self._last_instances is not None and difference < self.skip_threshold:
+            self.stats["skipped_frames"] += 1
+            self._frames_since_keyframe += 1
+            instances = self._last_instances
+        else:
+            keyframe = (
+                self._hypotheses is None
+                or self._frames_since_keyframe + 1 >= self.keyframe_interval
+                or difference >= self.scene_change_threshold
+            )
+            if keyframe:
+                instances = self._process_keyframe(frame, frame_name)
+                self.stats["keyframes"] += 1
+                self._frames_since_keyframe = 0
+            else:
+                instances = self._process_intermediate_frame(frame, frame_name)
+                self.stats["intermediate_frames"] += 1
+                self._frames_since_keyframe += 1
+            self._last_thumbnail = thumbnail
+            self._last_instances = instances
+
+        if visualize:
+            input = {"original_image": frame, "file_name": os.path.abspath(frame_name)}
+            self.nod_model.visualize(input, instances, out_dir, confidence_threshold, self.vocabulary)
+        return [{"instances": instances}]
+
+    def _process_keyframe(self, frame, frame_name):
+        output = self.nod_model.infer_batch(
+            [frame_name],
+            [self.text_prompt_list],
+            visualize = False,
+            images = [frame],
+            vocabularies = [self.vocabulary],
+            return_stage_outputs = True,
+        )[0]
+        instances = output["instances"]
+        stage_outputs = output["stage_outputs"]
+        self._last_gdino = self._top_gdino(
+            stage_outputs["gdino_boxes"], stage_outputs["gdino_scores"], stage_outputs["gdino_classes"]
+        )
+
+        # the classes of the confident detections, the best scored first
+        confident = instances.scores >= self.hypothesis_threshold
+        classes = instances.pred_classes[confident][instances.scores[confident].argsort(descending = True)]
+        class_ids = []
+        for class_id in classes.tolist():
+            if class_id not in class_ids:
+                class_ids.append(class_id)
+        class_ids = class_ids[:self.max_hypotheses]
+
+        if len(class_ids) == 0:
+            self._hypotheses = None
+        else:
+            text_prompt_list, positive_map_list = self.nod_model._get_vocabulary_builder().text_prompts(
+                [self.class_names[class_id] for class_id in class_ids]
+            )
+            self._hypotheses = (text_prompt_list, positive_map_list, torch.tensor(class_ids, dtype = torch.int64))
+        return instances
+
+    def _process_intermediate_frame(self, frame, frame_name):
+        nod_model = self.nod_model
+        profiler = nod_model.profiler
+        input = nod_model.prepare_inputs(frame_name, image = frame)[0]
+        image_size = (input["height"], input["width"])
+        profiler.start_image(input["file_name"])
+
+        outputs = nod_model.run_rcnn([input])[0]
+        outputs["rcnn_boxes"], outputs["rcnn_scores"], outputs["rcnn_classes"], _ = nod_model.map_known_classes(
+            outputs["rcnn_boxes"], outputs["rcnn_scores"], outputs.pop("rcnn_coco_classes"), self.vocabulary
+        )
+        profiler.mark("rcnn", num_boxes = len(outputs["rcnn_boxes"]) + len(outputs["bg_boxes"]))
+
+        crop_images, outputs["clip_boxes"] = nod_model.extract_crops(input, outputs.pop("bg_boxes"))
+        profiler.mark("crop_extraction", num_crops = len(outputs["clip_boxes"]))
+        outputs["clip_scores"], outputs["clip_classes"] = nod_model.classify_crops(
+            nod_model.encode_crops([crop_images]), [self.vocabulary]
+        )[0]
+        profiler.mark("clip_encode", num_crops = len(outputs["clip_boxes"]))
+
+        # GDINO only looks for the classes of the last keyframe
+        text_prompt_list, positive_map_list, class_ids = self._hypotheses
+        gdino_boxes, gdino_scores, gdino_classes = nod_model.run_gdino(
+            [input], [text_prompt_list], vocabularies = [self.vocabulary],
+            prompt_classes = [(positive_map_list, class_ids)],
+        )[0]
+        profiler.mark("gdino", num_prompts = len(text_prompt_list), num_boxes = len(gdino_boxes))
+
+        # the GDINO detections of the previous frame are candidates too, with their GDINO scores and classes, and SAM
+        # refines their boxes on this frame; only those of this frame are carried to the next one
+        previous_boxes, previous_scores, previous_classes = self._last_gdino
+        self._last_gdino = self._top_gdino(gdino_boxes, gdino_scores, gdino_classes)
+        outputs["gdino_boxes"] = torch.cat([gdino_boxes, previous_boxes.to(gdino_boxes)], dim = 0)
+        outputs["gdino_scores"] = torch.cat([gdino_scores, previous_scores.to(gdino_scores)], dim = 0)
+        outputs["gdino_classes"] = torch.cat([gdino_classes, previous_classes.to(gdino_classes)], dim = 0)
+
+        image_embeddings, sam_images = nod_model.encode_sam([input])
+        profiler.mark("sam_encoder")
+        boxes = torch.cat([outputs["rcnn_boxes"], outputs["clip_boxes"], outputs["gdino_boxes"]], dim = 0)
+        outputs["sam_boxes"], outputs["sam_scores"] = nod_model.refine_boxes_with_sam(
+            image_embeddings, sam_images[0], boxes, image_size
+        )
+        profiler.mark("sam_decoder", num_prompts = len(boxes))
+
+        boxes, scores, labels = fuse_stage_outputs(outputs, topk = 300)
+        instances = Instances(image_size)
+        instances.pred_boxes = Boxes(boxes)
+        instances.scores = scores
+        instances.pred_classes = labels
+        profiler.mark("fusion", num_candidates = len(outputs["sam_scores"]), num_kept = len(instances))
+        profiler.end_image()
+        return instances
+
+    def _top_gdino(self, boxes, scores, classes):
+        """The `max_propagated_boxes` best scored GDINO detections of a frame, on cpu."""
+        top = scores.argsort(descending = True)[:self.max_propagated_boxes]
+        return boxes[top].to("cpu"), scores[top].to("cpu"), classes[top].to("cpu")
@@ -0,0 +1,443 @@
+"""
+Detection vocabularies chosen at run time.
+
+The class space of the pipeline is fixed when the models are loaded, to the LVIS classes of `lvis_data_split`: the GDINO
+prompts and positive maps of `get_text_prompt_list_for_g_dino`, the SigLIP `text_features` of `load_clip_model` and
+the COCO -> LVIS mapping of the known RCNN classes. `VocabularyBuilder` builds the same three for any list of class
+names, as a `Vocabulary` that `NOD.infer` / `NOD.infer_batch` / `NODSession.query` accept per image.
+
+`VocabularyStore` is a persistent vocabulary edited in place (classes added, removed or renamed), which only recomputes
+the embeddings of the new classes and the GDINO prompts of the chunks that changed.
+
+The expensive part is the SigLIP embedding of a class (every template for every synonym), so embeddings are kept in a
+size-bounded LRU cache keyed by class name and synonyms, and the GDINO prompt and positive map of a chunk of classes in
+another one keyed by the chunk: a vocabulary costs one encoding of the classes never seen before, and nothing when it
+is requested again. The LVIS embeddings computed at load time are added to the cache, so that subsets of LVIS are free.
+"""
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+from collections import OrderedDict
+
+import torch
+from detectron2.data import MetadataCatalog
+
+from load_models import encode_class_synonyms
+from utils import build_text_prompt
+
+SYNONYMS_FILE = "lvis_original_class_to_synonyms.pkl"
+
+
+class LRUCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key):
+        """Returns the value of `key`, or None, and marks it as the most recently used."""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        return OrderedDict([
+            ("size", len(self)), ("max_size", self.max_size), ("hits", self.hits), ("misses", self.misses)
+        ])
+
+
+class Vocabulary:
+    """
+    Class space of one request. Labels of the detections are indices in `class_names`.
+
+    Attributes:
+        class_names (list[str])
+        text_prompt_list (list[str]): GDINO prompts of consecutive chunks of `class_len_per_prompt` classes
+        positive_map_list (list[Tensor]): (num_classes_of_the_chunk, 256) positive map of every prompt
+        class_len_per_prompt (int)
+        text_features (Tensor): (num_classes, D) normalized SigLIP embeddings
+        coco_to_vocab (Tensor): (num_coco_classes,) index in `class_names` of every COCO class of the RCNN, -1 for the
+            classes which are not in the vocabulary (their RCNN detections are dropped)
+        class_index: optional index of `text_features` (see `class_index.py`) the crops are classified with, for large
+            vocabularies
+        fingerprint (str): hash of the classes, synonyms and prompt chunks, which identifies the vocabulary in the
+            keys of a `ResultCache`
+    """
+
+    def __init__(
+        self, class_names, text_prompt_list, positive_map_list, class_len_per_prompt, text_features, coco_to_vocab
+    ):
+        self.class_names = class_names
+        self.text_prompt_list = text_prompt_list
+        self.positive_map_list = positive_map_list
+        self.class_len_per_prompt = class_len_per_prompt
+        self.text_features = text_features
+        self.coco_to_vocab = coco_to_vocab
+        self.class_index = None
+        self.fingerprint = _fingerprint(class_names, [len(positive_map) for positive_map in positive_map_list])
+
+    def __len__(self):
+        return len(self.class_names)
+
+
+def _fingerprint(*values):
+    return hashlib.blake2b(repr(values).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _normalized_name(class_name):
+    return class_name.lower().replace("_", " ").strip()
+
+
+class VocabularyBuilder:
+    def __init__(
+        self,
+        clip_model,
+        clip_tokenizer,
+        gdino_tokenizer,
+        device,
+        class_len_per_prompt,
+        coco_to_lvis=None,
+        lvis_classes=None,
+        max_cached_classes=10000,
+        max_cached_prompts=1024,
+        max_cached_vocabularies=64,
+        synonyms_file=SYNONYMS_FILE,
+    ):
+        """
+        Args:
+            clip_tokenizer: `open_clip.get_tokenizer()` of `clip_model`
+            gdino_tokenizer: `gdino_model.tokenizer`
+            coco_to_lvis (LabelMap), lvis_classes (list[str]): the mapping of `get_coco_to_lvis_mapping`, whose
+                hand-made entries are reused when the vocabulary contains the LVIS class a COCO class is mapped to
+            synonyms_file (str): pickle of class name -> synonyms (LVIS), used when a request gives no synonyms
+        """
+        self.clip_model = clip_model
+        self.clip_tokenizer = clip_tokenizer
+        self.gdino_tokenizer = gdino_tokenizer
+        self.device = device
+        self.class_len_per_prompt = class_len_per_prompt
+        self.coco_to_lvis = coco_to_lvis or {}
+        self.lvis_classes = lvis_classes or []
+
+        self.embeddings = LRUCache(max_cached_classes)
+        self.prompts = LRUCache(max_cached_prompts)
+        self.vocabularies = LRUCache(max_cached_vocabularies)
+
+        self.class_names_to_synonyms = {}
+        if os.path.isfile(synonyms_file):
+            with open(synonyms_file, "rb") as f:
+                self.class_names_to_synonyms = pickle.load(f)
+
+    def synonyms(self, class_name):
+        """Synonyms of the LVIS class `class_name` (with "_" or spaces), or the name itself for other classes."""
+        for name in (class_name, class_name.replace(" ", "_")):
+            if name in self.class_names_to_synonyms:
+                return list(self.class_names_to_synonyms[name])
+        return [class_name]
+
+    def add_embeddings(self, class_names, text_features):
+        """Adds embeddings computed with the default synonyms, e.g. the LVIS `text_features` of `load_clip_model`."""
+        for class_name, text_feature in zip(class_names, text_features):
+            self.embeddings.put((class_name, tuple(self.synonyms(class_name))), text_feature)
+
+    def class_embeddings(self, class_names, synonyms=None):
+        """
+        Args:
+            synonyms (dict[str, list[str]]): synonyms of some of the classes, instead of the default ones
+        Returns:
+            Tensor: (len(class_names), D) SigLIP embeddings, only the classes missing from the cache are encoded
+        """
+        synonyms = synonyms or {}
+        keys = [
+            (class_name, tuple(synonyms.get(class_name) or self.synonyms(class_name))) for class_name in class_names
+        ]
+        embeddings = [self.embeddings.get(key) for key in keys]
+
+        missing = [idx for idx, embedding in enumerate(embeddings) if embedding is None]
+        if len(missing) > 0:
+            new_embeddings = encode_class_synonyms(
+                self.clip_model, self.clip_tokenizer, [list(keys[idx][1]) for idx in missing], self.device
+            )
+            for idx, embedding in zip(missing, new_embeddings):
+                self.embeddings.put(keys[idx], embedding)
+                embeddings[idx] = embedding
+        return torch.stack(embeddings, dim=0)
+
+    def text_prompts(self, class_names):
+        """GDINO prompts and positive maps of `class_names`, split as in `get_text_prompt_list_for_g_dino`."""
+        classes = [_normalized_name(class_name) for class_name in class_names]
+        length = self.class_len_per_prompt
+
+        text_prompt_list = []
+        positive_map_list = []
+        for start in range(0, len(classes), length):
+            chunk = tuple(classes[start:start + length])
+            prompt = self.prompts.get(chunk)
+            if prompt is None:
+                prompt = build_text_prompt(list(chunk), self.gdino_tokenizer)
+                self.prompts.put(chunk, prompt)
+            text_prompt_list.append(prompt[0])
+            positive_map_list.append(prompt[1])
+        return text_prompt_list, positive_map_list
+
+    def coco_to_vocab(self, class_names):
+        """
+        Index in `class_names` of every COCO class: the LVIS class it is mapped to by `coco_to_lvis` if the vocabulary
+        has it, else the COCO class itself, else -1.
+        """
+        name_to_idx = {}
+        for idx, class_name in enumerate(class_names):
+            name_to_idx.setdefault(_normalized_name(class_name), idx)
+
+        coco_classes = MetadataCatalog.get("coco_2017_train").thing_classes
+        coco_to_vocab = torch.full((len(coco_classes),), -1, dtype=torch.int64)
+        for coco_idx, coco_class in enumerate(coco_classes):
+            candidates = [coco_class]
+            lvis_idx = self.coco_to_lvis.get(coco_idx, -1)
+            if 0 <= lvis_idx < len(self.lvis_classes):
+                candidates.insert(0, self.lvis_classes[lvis_idx])
+            for candidate in candidates:
+                if _normalized_name(candidate) in name_to_idx:
+                    coco_to_vocab[coco_idx] = name_to_idx[_normalized_name(candidate)]
+                    break
+        return coco_to_vocab
+
+    def build(self, class_names, synonyms=None):
+        """
+        Args:
+            class_names (list[str]): e.g. ["license plate", "traffic cone"]
+            synonyms (dict[str, list[str]]): optional synonyms of some classes for SigLIP, e.g. {"car": ["car", "auto"]}
+        Returns:
+            Vocabulary
+        """
+        class_names = list(class_names)
+        if len(class_names) == 0:
+            raise ValueError("A vocabulary needs at least one class")
+        key = (tuple(class_names), tuple(sorted((name, tuple(value)) for name, value in (synonyms or {}).items())))
+        vocabulary = self.vocabularies.get(key)
+        if vocabulary is None:
+            text_prompt_list, positive_map_list = self.text_prompts(class_names)
+            vocabulary = Vocabulary(
+                class_names,
+                text_prompt_list,
+                positive_map_list,
+                self.class_len_per_prompt,
+                self.class_embeddings(class_names, synonyms),
+                self.coco_to_vocab(class_names),
+            )
+            vocabulary.fingerprint = _fingerprint(key, vocabulary.fingerprint)
+            self.vocabularies.put(key, vocabulary)
+        return vocabulary
+
+    def stats(self):
+        return OrderedDict([
+            ("embeddings", self.embeddings.stats()),
+            ("prompts", self.prompts.stats()),
+            ("vocabularies", self.vocabularies.stats()),
+        ])
+
+
+class VocabularyStore:
+    """
+    Vocabulary extended over time, persisted with `save()`. Its classes are kept in prompt chunks of at most
+    `class_len_per_prompt` classes, and an edit only touches what it changes:
+    - `add` encodes the new classes only and appends them to the last chunk (rebuilt) or to new chunks;
+    - `remove` drops rows of the embeddings and rebuilds the chunks that contained the classes, which are then shorter;
+    - `rename` encodes the renamed classes and rebuilds their chunks.
+    The class ids are the positions in `class_names`, which are those of the chunks in order; a removal shifts the ids
+    of the next classes. `num_encoded` and `num_prompts_built` count the work done since the store was opened.
+    """
+
+    format_version = 1
+
+    def __init__(self, builder, path=None):
+        """
+        Args:
+            builder (VocabularyBuilder): encodes the classes (with its embedding cache) and tokenizes the prompts
+            path (str): file the store is loaded from if it exists, and saved to
+        """
+        self.builder = builder
+        self.path = path
+        self.class_names = []
+        self.synonyms = {}  # synonyms given for some classes, instead of the default ones of the builder
+        self.text_features = None
+        self.chunks = []  # dicts with the "classes", "caption" and "positive_map" of every prompt
+        self.num_encoded = 0
+        self.num_prompts_built = 0
+        self._vocabulary = None
+        if path is not None and os.path.isfile(path):
+            self._load(path)
+
+    def __len__(self):
+        return len(self.class_names)
+
+    def __contains__(self, class_name):
+        return class_name in self.class_names
+
+    def _load(self, path):
+        state = torch.load(path, map_location="cpu")
+        if state["format_version"] != self.format_version:
+            raise ValueError(
+                "{} has format version {}, expected {}".format(path, state["format_version"], self.format_version)
+            )
+        if state["class_len_per_prompt"] != self.builder.class_len_per_prompt:
+            raise ValueError("{} has {} classes per prompt, the builder {}".format(
+                path, state["class_len_per_prompt"], self.builder.class_len_per_prompt
+            ))
+        self.class_names = state["class_names"]
+        self.synonyms = state["synonyms"]
+        self.text_features = state["text_features"].to(self.builder.device)
+        self.chunks = state["chunks"]
+
+    def save(self, path=None):
+        """Writes the store to a temporary file renamed over `path`, so that readers never see a partial file."""
+        path = path or self.path
+        state = {
+            "format_version": self.format_version,
+            "class_len_per_prompt": self.builder.class_len_per_prompt,
+            "class_names": self.class_names,
+            "synonyms": self.synonyms,
+            "text_features": self.text_features.to("cpu") if self.text_features is not None else None,
+            "chunks": self.chunks,
+        }
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".vocabulary_store_")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                torch.save(state, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+
+    def _encode(self, class_names):
+        self.num_encoded += len(class_names)
+        return self.builder.class_embeddings(class_names, self.synonyms)
+
+    def _build_chunk(self, classes):
+        self.num_prompts_built += 1
+        caption, positive_map = build_text_prompt(
+            [_normalized_name(class_name) for class_name in classes], self.builder.gdino_tokenizer
+        )
+        return {"classes": classes, "caption": caption, "positive_map": positive_map}
+
+    def add(self, class_names, synonyms=None):
+        """
+        Args:
+            class_names (list[str]): new classes, appended in this order
+            synonyms (dict[str, list[str]]): optional synonyms of some of them, for SigLIP
+        """
+        class_names = list(class_names)
+        for class_name in class_names:
+            if class_name in self.class_names or class_names.count(class_name) > 1:
+                raise ValueError("{} is already in the vocabulary".format(class_name))
+        if len(class_names) == 0:
+            return
+        self.synonyms.update({name: list(value) for name, value in (synonyms or {}).items() if name in class_names})
+
+        embeddings = self._encode(class_names)
+        self.text_features = embeddings if self.text_features is None else torch.cat([self.text_features, embeddings])
+        self.class_names += class_names
+
+        length = self.builder.class_len_per_prompt
+        pending = class_names
+        if len(self.chunks) > 0 and len(self.chunks[-1]["classes"]) < length:
+            room = length - len(self.chunks[-1]["classes"])
+            self.chunks[-1] = self._build_chunk(self.chunks[-1]["classes"] + pending[:room])
+            pending = pending[room:]
+        for start in range(0, len(pending), length):
+            self.chunks.append(self._build_chunk(pending[start:start + length]))
+        self._vocabulary = None
+
+    def remove(self, class_names):
+        removed = set(class_names)
+        for class_name in removed:
+            if class_name not in self.class_names:
+                raise KeyError("{} is not in the vocabulary".format(class_name))
+
+        keep = torch.tensor([class_name not in removed for class_name in self.class_names])
+        self.text_features = self.text_features[keep.to(self.text_features.device)]
+        self.class_names = [class_name for class_name in self.class_names if class_name not in removed]
+        for class_name in removed:
+            self.synonyms.pop(class_name, None)
+
+        chunks = []
+        for chunk in self.chunks:
+            classes = [class_name for class_name in chunk["classes"] if class_name not in removed]
+            if len(classes) == len(chunk["classes"]):
+                chunks.append(chunk)
+            elif len(classes) > 0:
+                chunks.append(self._build_chunk(classes))
+        self.chunks = chunks
+        self._vocabulary = None
+
+    def rename(self, renames, synonyms=None):
+        """
+        Args:
+            renames (dict[str, str]): old name -> new name; the classes keep their ids
+            synonyms (dict[str, list[str]]): optional synonyms of the new names, for SigLIP
+        """
+        for old_name, new_name in renames.items():
+            if old_name not in self.class_names:
+                raise KeyError("{} is not in the vocabulary".format(old_name))
+            if new_name in self.class_names and new_name not in renames:
+                raise ValueError("{} is already in the vocabulary".format(new_name))
+        if len(renames) == 0:
+            return
+        for old_name in renames:
+            self.synonyms.pop(old_name, None)
+        self.synonyms.update(
+            {name: list(value) for name, value in (synonyms or {}).items() if name in renames.values()}
+        )
+
+        positions = [self.class_names.index(old_name) for old_name in renames]
+        self.class_names = [renames.get(class_name, class_name) for class_name in self.class_names]
+        # a copy: the vocabularies already returned keep their embeddings
+        self.text_features = self.text_features.clone()
+        self.text_features[torch.tensor(positions, device=self.text_features.device)] = self._encode(
+            [self.class_names[position] for position in positions]
+        ).to(self.text_features)
+
+        self.chunks = [
+            self._build_chunk([renames.get(class_name, class_name) for class_name in chunk["classes"]])
+            if any(class_name in renames for class_name in chunk["classes"]) else chunk
+            for chunk in self.chunks
+        ]
+        self._vocabulary = None
+
+    def vocabulary(self):
+        """The `Vocabulary` of the current classes, for `NOD.infer`."""
+        if len(self.class_names) == 0:
+            raise ValueError("The vocabulary store is empty")
+        if self._vocabulary is None:
+            self._vocabulary = Vocabulary(
+                list(self.class_names),
+                [chunk["caption"] for chunk in self.chunks],
+                [chunk["positive_map"] for chunk in self.chunks],
+                self.builder.class_len_per_prompt,
+                self.text_features,
+                self.builder.coco_to_vocab(self.class_names),
+            )
+            synonyms = sorted((name, tuple(value)) for name, value in self.synonyms.items())
+            self._vocabulary.fingerprint = _fingerprint(synonyms, self._vocabulary.fingerprint)
+        return self._vocabulary
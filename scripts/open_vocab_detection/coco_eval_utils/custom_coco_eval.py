@@ -23,9 +23,153 @@ from detectron2.evaluation.coco_evaluation import COCOEvaluator
 from detectron2.structures import Boxes, BoxMode, pairwise_iou
 from detectron2.utils.file_io import PathManager
 from detectron2.utils.logger import create_small_table
+from datasets.gt_index import load_coco_api
+from scripts.label_space import LabelMap, remap_category_ids
 from .coco_ovd_split import categories_seen, categories_unseen
+from .fast_ap50_eval import evaluate_ap50
 
 class CustomCOCOEvaluator(COCOEvaluator):
+    def __init__(
+        self,
+        dataset_name,
+        tasks=None,
+        distributed=True,
+        output_dir=None,
+        *,
+        max_dets_per_image=None,
+        use_fast_impl=True,
+        kpt_oks_sigmas=(),
+        use_gt_index=True,
+        fast_ap50=False,
+    ):
+        """
+        Same as `COCOEvaluator.__init__`, except that `self._coco_api` is built from the binary ground-truth index of
+        `datasets.gt_index` (box-only) when `use_gt_index` is True, instead of parsing the json file.
+        With `fast_ap50`, only the box AP50 (all areas, `max_dets_per_image` detections) of all, seen and unseen
+        classes is computed, by `evaluate_ap50()` instead of `COCOeval`.
+        """
+        self._logger = logging.getLogger(__name__)
+        self._distributed = distributed
+        self._output_dir = output_dir
+        self._use_fast_impl = use_fast_impl
+
+        if max_dets_per_image is None:
+            max_dets_per_image = [1, 10, 100]
+        else:
+            max_dets_per_image = [1, 10, max_dets_per_image]
+        self._max_dets_per_image = max_dets_per_image
+
+        if tasks is not None and isinstance(tasks, CfgNode):
+            kpt_oks_sigmas = (
+                tasks.TEST.KEYPOINT_OKS_SIGMAS if not kpt_oks_sigmas else kpt_oks_sigmas
+            )
+            self._logger.warn(
+                "COCO Evaluator instantiated using config, this is deprecated behavior."
+                " Please pass in explicit arguments instead."
+            )
+            self._tasks = None  # Infering it from predictions should be better
+        else:
+            self._tasks = tasks
+
+        self._cpu_device = torch.device("cpu")
+        self._fast_ap50 = fast_ap50
+
+        self._metadata = MetadataCatalog.get(dataset_name)
+        if not hasattr(self._metadata, "json_file"):
+            self._logger.info(f"'{dataset_name}' is not registered by `register_coco_instances`. Converting it.")
+            cache_path = os.path.join(output_dir, f"{dataset_name}_coco_format.json")
+            self._metadata.json_file = cache_path
+            convert_to_coco_json(dataset_name, cache_path)
+
+        self._json_file = PathManager.get_local_path(self._metadata.json_file)
+        self._coco_api = load_coco_api(
+            self._json_file, use_gt_index=use_gt_index and "segm" not in (self._tasks or ())
+        )
+
+        # Test set json files do not contain annotations (evaluation must be
+        # performed using the COCO evaluation server).
+        self._do_evaluation = "annotations" in self._coco_api.dataset
+        if self._do_evaluation:
+            self._kpt_oks_sigmas = kpt_oks_sigmas
+
+    def _eval_predictions(self, predictions, img_ids=None):
+        """
+        Reload the full json before evaluating masks, the ground-truth index only has boxes.
+        """
+        if self._fast_ap50:
+            return self._eval_predictions_ap50(predictions, img_ids)
+
+        coco_results = list(itertools.chain(*[x["instances"] for x in predictions]))
+        tasks = self._tasks or self._tasks_from_predictions(coco_results)
+        if "segm" in tasks and hasattr(self._coco_api, "gt_index"):
+            self._logger.info("Loading {} for mask evaluation ...".format(self._json_file))
+            with contextlib.redirect_stdout(io.StringIO()):
+                self._coco_api = COCO(self._json_file)
+        return super()._eval_predictions(predictions, img_ids)
+
+    def _eval_predictions_ap50(self, predictions, img_ids=None):
+        """
+        Fast evaluation mode: box AP at IoU 0.5 only, per category and averaged over all, seen and unseen classes.
+        """
+        self._logger.info("Preparing results for COCO format ...")
+        coco_results = list(itertools.chain(*[x["instances"] for x in predictions]))
+
+        # unmap the category ids for COCO
+        if hasattr(self._metadata, "thing_dataset_id_to_contiguous_id"):
+            dataset_id_to_contiguous_id = self._metadata.thing_dataset_id_to_contiguous_id
+            remap_category_ids(coco_results, LabelMap(dataset_id_to_contiguous_id).inverse())
+
+        if not self._do_evaluation:
+            self._logger.info("Annotations are not available for evaluation.")
+            return
+
+        self._logger.info("Evaluating predictions with the fast AP50 evaluation ...")
+        img_ids = img_ids if img_ids is not None else self._coco_api.getImgIds()
+        cat_ids = sorted(self._coco_api.getCatIds())
+        precision = evaluate_ap50(
+            self._coco_api, coco_results, img_ids, cat_ids, max_dets=self._max_dets_per_image[-1]
+        )
+        self._results["bbox"] = self._derive_ap50_results(precision, cat_ids)
+
+    def _derive_ap50_results(self, precision, cat_ids):
+        """
+        Same AP50 numbers as `_derive_coco_results`, from the (recall, category) precision of `evaluate_ap50()`.
+        Seen and unseen classes are taken from `coco_ovd_split` by category id.
+        """
+        valid = precision > -1
+        ap50 = np.full(len(cat_ids), float("nan"))
+        ap50[valid.any(axis=0)] = precision[:, valid.any(axis=0)].mean(axis=0) * 100
+
+        seen_ids = set([x['id'] for x in categories_seen])
+        unseen_ids = set([x['id'] for x in categories_unseen])
+        is_seen = np.array([cat_id in seen_ids for cat_id in cat_ids], dtype=bool)
+        is_unseen = np.array([cat_id in unseen_ids for cat_id in cat_ids], dtype=bool)
+
+        results = {
+            "AP50": float(np.nanmean(ap50)) if valid.any() else float("nan"),
+            "AP50-seen": float(np.mean(ap50[is_seen])),
+            "AP50-unseen": float(np.mean(ap50[is_unseen])),
+        }
+        self._logger.info("Evaluation results for bbox (AP50 only): \n" + create_small_table(results))
+
+        class_names = [cat["name"] for cat in self._coco_api.loadCats(cat_ids)]
+        results_per_category50 = [("{}".format(name), float(ap)) for name, ap in zip(class_names, ap50)]
+
+        N_COLS = min(6, len(results_per_category50) * 2)
+        results_flatten = list(itertools.chain(*results_per_category50))
+        results_2d = itertools.zip_longest(*[results_flatten[i::N_COLS] for i in range(N_COLS)])
+        table = tabulate(
+            results_2d,
+            tablefmt="pipe",
+            floatfmt=".3f",
+            headers=["category", "AP50"] * (N_COLS // 2),
+            numalign="left",
+        )
+        self._logger.info("Per-category bbox AP50: \n" + table)
+
+        results.update({"AP50-" + name: ap for name, ap in results_per_category50})
+        return results
+
     def _derive_coco_results(self, coco_eval, iou_type, class_names=None):
         """
         Additionally plot mAP for 'seen classes' and 'unseen classes'
@@ -0,0 +1,184 @@
+"""
+Vectorized COCO box AP at a single IoU threshold.
+
+The COCO-OVD numbers tracked during development are AP50-seen / AP50-unseen, which only need the precision at IoU 0.5
+for the "all" area range and 100 detections per image. `COCOeval` computes and accumulates 10 IoU thresholds x 4 area
+ranges x 3 max detections in Python loops over every (image, category) pair before `_derive_coco_results` reads index
+0. `evaluate_ap50()` computes only that slice, with the same matching and accumulation rules as `COCOeval`, so its
+precision equals `coco_eval.eval["precision"][0, :, :, 0, -1]`.
+"""
+import numpy as np
+
+from scripts.box_matching import bbox_iou, last_argmax
+
+
+def evaluate_ap50(coco_gt, coco_results, img_ids, cat_ids, max_dets=100, iou_thr=0.5, max_batch_elements=2 ** 23):
+    """
+    Args:
+        coco_gt (COCO): ground truth; boxes are read from `coco_gt.gt_index` when it was built from the
+            binary ground-truth index of `datasets.gt_index`
+        coco_results (list[dict]): detections in the COCO json format, with dataset category ids
+        img_ids, cat_ids (list[int]): images and categories to evaluate, as `COCOeval.params.imgIds/catIds`
+        max_dets (int): maximum number of detections per image and category
+
+    Returns:
+        precision (ndarray): (num_recalls, num_cats) interpolated precision at the 101 COCO recall thresholds,
+            -1 for categories without non-crowd gts
+    """
+    img_ids = np.asarray(sorted(img_ids), dtype=np.int64)
+    cat_ids = np.asarray(sorted(cat_ids), dtype=np.int64)
+    num_imgs, num_cats = len(img_ids), len(cat_ids)
+    rec_thrs = np.linspace(0.0, 1.00, int(np.round((1.00 - 0.0) / 0.01)) + 1, endpoint=True)
+
+    gt = _gt_arrays(coco_gt)
+    dt = _dt_arrays(coco_results)
+
+    # `COCOeval` only looks at the (image, category) pairs of `img_ids` x `cat_ids`
+    gt_keep = np.isin(gt["image_id"], img_ids) & np.isin(gt["category_id"], cat_ids)
+    dt_keep = np.isin(dt["image_id"], img_ids) & np.isin(dt["category_id"], cat_ids)
+    gt = {name: values[gt_keep] for name, values in gt.items()}
+    dt = {name: values[dt_keep] for name, values in dt.items()}
+
+    gt_keys = np.searchsorted(cat_ids, gt["category_id"]) * num_imgs + np.searchsorted(img_ids, gt["image_id"])
+    dt_keys = np.searchsorted(cat_ids, dt["category_id"]) * num_imgs + np.searchsorted(img_ids, dt["image_id"])
+
+    # gts in annotation order with crowd (ignored) gts last, dts by decreasing score (stable), as in `evaluateImg`
+    gt_order = np.lexsort((gt["iscrowd"], gt_keys))
+    dt_order = np.lexsort((np.arange(len(dt_keys)), -dt["score"], dt_keys))
+    gt = {name: values[gt_order] for name, values in gt.items()}
+    dt = {name: values[dt_order] for name, values in dt.items()}
+    gt_keys, dt_keys = gt_keys[gt_order], dt_keys[dt_order]
+
+    # keep the `max_dets` highest scored detections of every (image, category)
+    dt_rank = np.arange(len(dt_keys)) - np.searchsorted(dt_keys, dt_keys, side="left")
+    dt = {name: values[dt_rank < max_dets] for name, values in dt.items()}
+    dt_keys = dt_keys[dt_rank < max_dets]
+
+    dt_matched, dt_ignored = _match(gt, gt_keys, dt, dt_keys, iou_thr, max_batch_elements)
+
+    # accumulate per category: concatenation in image order, then stable sort by decreasing score
+    precision = -np.ones((len(rec_thrs), num_cats))
+    dt_cats = dt_keys // num_imgs
+    num_gt = np.bincount(gt_keys[gt["iscrowd"] == 0] // num_imgs, minlength=num_cats)
+    dt_cat_offsets = np.searchsorted(dt_cats, np.arange(num_cats + 1))
+    for cat_idx in np.flatnonzero(num_gt):
+        ds, de = dt_cat_offsets[cat_idx], dt_cat_offsets[cat_idx + 1]
+        order = np.argsort(-dt["score"][ds:de], kind="mergesort")
+        matched, ignored = dt_matched[ds:de][order], dt_ignored[ds:de][order]
+        precision[:, cat_idx] = _interpolated_precision(
+            matched & ~ignored, ~matched & ~ignored, num_gt[cat_idx], rec_thrs
+        )
+
+    return precision
+
+
+def _gt_arrays(coco_gt):
+    gt_index = getattr(coco_gt, "gt_index", None)
+    if gt_index is not None:
+        return {
+            "image_id": np.asarray(gt_index.ann_image_ids, dtype=np.int64),
+            "category_id": np.asarray(gt_index.ann_category_ids, dtype=np.int64),
+            "bbox": np.asarray(gt_index.ann_bboxes, dtype=np.float64).reshape(-1, 4),
+            "iscrowd": np.asarray(gt_index.ann_iscrowd, dtype=bool),
+        }
+
+    anns = coco_gt.dataset.get("annotations", [])
+    return {
+        "image_id": np.array([ann["image_id"] for ann in anns], dtype=np.int64),
+        "category_id": np.array([ann["category_id"] for ann in anns], dtype=np.int64),
+        "bbox": np.array([ann["bbox"] for ann in anns], dtype=np.float64).reshape(-1, 4),
+        "iscrowd": np.array([ann.get("iscrowd", 0) for ann in anns], dtype=bool),
+    }
+
+
+def _dt_arrays(coco_results):
+    return {
+        "image_id": np.array([dt["image_id"] for dt in coco_results], dtype=np.int64),
+        "category_id": np.array([dt["category_id"] for dt in coco_results], dtype=np.int64),
+        "bbox": np.array([dt["bbox"] for dt in coco_results], dtype=np.float64).reshape(-1, 4),
+        "score": np.array([dt["score"] for dt in coco_results], dtype=np.float64),
+    }
+
+
+def _match(gt, gt_keys, dt, dt_keys, iou_thr, max_batch_elements):
+    """
+    Greedy matching of `COCOeval.evaluateImg` for every (image, category) pair with both gts and dts, batched over
+    pairs and looping over the detection rank only. Non-crowd gts can be matched once, crowd gts any number of times
+    and only when no non-crowd gt is available; ties go to the last gt with the highest IoU.
+    Returns, per detection, whether it is matched and whether it is matched to a crowd gt (ignored).
+    """
+    dt_matched = np.zeros(len(dt_keys), dtype=bool)
+    dt_ignored = np.zeros(len(dt_keys), dtype=bool)
+
+    pair_keys = np.intersect1d(gt_keys, dt_keys)
+    if len(pair_keys) == 0:
+        return dt_matched, dt_ignored
+
+    gs, ge = np.searchsorted(gt_keys, pair_keys, side="left"), np.searchsorted(gt_keys, pair_keys, side="right")
+    ds, de = np.searchsorted(dt_keys, pair_keys, side="left"), np.searchsorted(dt_keys, pair_keys, side="right")
+
+    # process pairs of similar size together to limit padding
+    pair_order = np.argsort(-(de - ds) * (ge - gs), kind="mergesort")
+    start = 0
+    while start < len(pair_order):
+        max_size = (de - ds)[pair_order[start]] * (ge - gs)[pair_order[start]]
+        end = min(len(pair_order), start + max(1, max_batch_elements // max(max_size, 1)))
+        batch = pair_order[start:end]
+        _match_batch(gt, dt, gs[batch], ge[batch], ds[batch], de[batch], iou_thr, dt_matched, dt_ignored)
+        start = end
+
+    return dt_matched, dt_ignored
+
+
+def _match_batch(gt, dt, gs, ge, ds, de, iou_thr, dt_matched, dt_ignored):
+    num_gts, num_dts = ge - gs, de - ds
+    max_gts, max_dts = num_gts.max(), num_dts.max()
+
+    gt_idx = gs[:, None] + np.arange(max_gts)[None, :]
+    gt_valid = np.arange(max_gts)[None, :] < num_gts[:, None]
+    gt_idx = np.where(gt_valid, gt_idx, 0)
+    dt_idx = ds[:, None] + np.arange(max_dts)[None, :]
+    dt_valid = np.arange(max_dts)[None, :] < num_dts[:, None]
+    dt_idx = np.where(dt_valid, dt_idx, 0)
+
+    gt_crowd = gt["iscrowd"][gt_idx] & gt_valid
+    ious = bbox_iou(dt["bbox"][dt_idx], gt["bbox"][gt_idx], gt_crowd)  # (P, D, G)
+    ious = np.where(gt_valid[:, None, :], ious, -1)
+
+    thr = min(iou_thr, 1 - 1e-10)
+    gt_taken = np.zeros(gt_idx.shape, dtype=bool)
+    pair_matched = np.zeros(dt_idx.shape, dtype=bool)
+    pair_ignored = np.zeros(dt_idx.shape, dtype=bool)
+    rows = np.arange(len(gs))
+    for d in range(max_dts):
+        iou = ious[:, d, :]
+        candidates = (iou >= thr) & gt_valid & (~gt_taken | gt_crowd) & dt_valid[:, d:d + 1]
+        match_regular, has_regular = last_argmax(iou, candidates & ~gt_crowd)
+        match_crowd, has_crowd = last_argmax(iou, candidates & gt_crowd)
+        match = np.where(has_regular, match_regular, match_crowd)
+        has_match = has_regular | has_crowd
+        gt_taken[rows[has_match], match[has_match]] = True
+        pair_matched[:, d] = has_match
+        pair_ignored[:, d] = has_crowd & ~has_regular
+
+    dt_matched[dt_idx[dt_valid]] = pair_matched[dt_valid]
+    dt_ignored[dt_idx[dt_valid]] = pair_ignored[dt_valid]
+
+
+def _interpolated_precision(tps, fps, num_gt, rec_thrs):
+    """Precision of `COCOeval.accumulate` at `rec_thrs` for one category; tps, fps sorted by decreasing score."""
+    precision = np.zeros(len(rec_thrs))
+    if len(tps) == 0:
+        return precision
+
+    tp_sum = np.cumsum(tps).astype(dtype=np.float64)
+    fp_sum = np.cumsum(fps).astype(dtype=np.float64)
+    rc = tp_sum / num_gt
+    pr = tp_sum / (fp_sum + tp_sum + np.spacing(1))
+    # Replace each precision value with the maximum precision value to the right of that recall level
+    pr = np.maximum.accumulate(pr[::-1])[::-1]
+
+    inds = np.searchsorted(rc, rec_thrs, side="left")
+    valid = inds < len(pr)
+    precision[valid] = pr[inds[valid]]
+    return precision
@@ -75,6 +75,10 @@ def inference_gdino(model, inputs, text_prompt, param_dict):
         box_predictor.test_nms_thresh = 0.5
         box_predictor.test_score_thresh = 0.0001
 
+    # only the boxes, scores and classes are used: without `mask_on`, `StandardROIHeads` skips the mask pooling and the
+    # mask head, the boxes are the same
+    rcnn_model.roi_heads.mask_on = not param_dict.get("rcnn_box_only", True)
+
     outputs = rcnn_model(inputs)
     rcnn_boxes = outputs[0]["instances"].pred_boxes.tensor.to("cpu") # format: (x1, y1, x2, y2)
     rcnn_scores = outputs[0]["instances"].scores.to("cpu")
@@ -120,7 +124,7 @@ def inference_gdino(model, inputs, text_prompt, param_dict):
     bg_scores = scores_clip.squeeze(1).to("cpu")
     bg_classes = indices_clip.squeeze(1).to("cpu")
 
-    bg_classes = torch.tensor( [ovd_id_to_coco_id[i.item()] for i in bg_classes] )
+    bg_classes = ovd_id_to_coco_id(bg_classes)
 
     combined_rcnn_boxes = torch.cat([known_boxes, bg_boxes], dim = 0)
     combined_rcnn_scores = torch.cat([known_scores, bg_scores], dim = 0)
@@ -157,7 +161,7 @@ def inference_gdino(model, inputs, text_prompt, param_dict):
     boxes = boxes * torch.Tensor([w, h, w, h])
     boxes = box_convert(boxes = boxes, in_fmt = "cxcywh", out_fmt = "xyxy")
 
-    labels = torch.tensor( [ovd_id_to_coco_id[i.item()] for i in labels] )
+    labels = ovd_id_to_coco_id(labels)
     
     boxes = torch.cat([combined_rcnn_boxes, boxes], dim = 0)
     scores = torch.cat([combined_rcnn_scores, scores], dim = 0)
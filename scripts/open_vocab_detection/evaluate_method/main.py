@@ -21,6 +21,9 @@ cfg_file = params["cfg_file"]
 rcnn_weight_dir = params["rcnn_weight_dir"]
 sam_checkpoint = params["sam_checkpoint"]
 gdino_checkpoint = params["gdino_checkpoint"]
+fast_ap50_eval = params["fast_ap50_eval"]
+model_load_workers = params["model_load_workers"]
+rcnn_box_only = params["rcnn_box_only"]
 
 os.environ['DETECTRON2_DATASETS'] = detectron2_dir
 
@@ -36,7 +39,7 @@ from pathlib import Path
 from detectron2.data import build_detection_test_loader, get_detection_dataset_dicts, DatasetMapper
 from detectron2.evaluation import print_csv_format
 from segment_anything.utils.transforms import ResizeLongestSide
-from tqdm import tqdm
+from scripts.model_registry import ModelRegistry
 
 from datasets.register_coco_ovd_dataset import coco_meta # to register the OVD datasets
 from scripts.open_vocab_detection.coco_eval_utils.custom_coco_eval import CustomCOCOEvaluator
@@ -44,59 +47,71 @@ from scripts.open_vocab_detection.coco_eval_utils.custom_coco_eval import Custom
 warnings.filterwarnings('ignore', category=UserWarning)
 warnings.filterwarnings('ignore', category=FutureWarning)
 
-Path(outputs_dir).mkdir(parents=True, exist_ok=True)
+def build_model_registry(device):
+    """Models of the pipeline, each loaded on first access (see `scripts/model_registry.py`)."""
+    registry = ModelRegistry()
+    registry.register("gdino", lambda: load_model("cfg/GroundingDINO/GDINO.py", gdino_checkpoint).to(device))
+    registry.register("rcnn", lambda: load_fully_supervised_trained_model(cfg_file, rcnn_weight_dir))
+    registry.register("clip", lambda: load_clip_model(device))
+    registry.register("sam", lambda: load_sam_model(device, sam_checkpoint))
+    return registry
 
-device = "cuda" if torch.cuda.is_available() else "cpu"
+def main():
+    Path(outputs_dir).mkdir(parents=True, exist_ok=True)
 
+    device = "cuda" if torch.cuda.is_available() else "cpu"
 
-model = load_model("cfg/GroundingDINO/GDINO.py", gdino_checkpoint)
-model = model.to(device)
+    # the models load in the background while the dataset and the evaluator are prepared
+    registry = build_model_registry(device)
+    registry.preload(max_workers = model_load_workers, wait = False)
 
-rcnn_model, cfg = load_fully_supervised_trained_model(cfg_file, rcnn_weight_dir)
+    ovd_id_to_coco_id = get_ovd_id_to_coco_id()
 
-ovd_id_to_coco_id = get_ovd_id_to_coco_id()
+    test_loader = build_detection_test_loader(
+        dataset = get_detection_dataset_dicts(names = data_split, filter_empty=False),
+        mapper= DatasetMapper(
+            is_train = False,
+            augmentations=[
+                T.ResizeShortestEdge(short_edge_length=800, max_size=1333),
+            ],
+            image_format="BGR",
+        ),
+        num_workers=4,
+    )
 
-clip_model, preprocess, text_features = load_clip_model(device)
+    coco_evaluator = CustomCOCOEvaluator(dataset_name = data_split, fast_ap50 = fast_ap50_eval)
 
-sam = load_sam_model(device, sam_checkpoint)
-resize_transform = ResizeLongestSide(sam.image_encoder.img_size)
+    model = registry["gdino"]
+    rcnn_model, cfg = registry["rcnn"]
+    clip_model, preprocess, text_features = registry["clip"]
+    sam = registry["sam"]
 
-test_loader = build_detection_test_loader(
-    dataset = get_detection_dataset_dicts(names = data_split, filter_empty=False),
-    mapper= DatasetMapper(
-        is_train = False,
-        augmentations=[
-            T.ResizeShortestEdge(short_edge_length=800, max_size=1333),
-        ],
-        image_format="BGR",
-    ),
-    num_workers=4,
-)
+    resize_transform = ResizeLongestSide(sam.image_encoder.img_size)
 
-tokenizer = model.tokenizer
+    tokenizer = model.tokenizer
 
-text_prompt, positive_map = get_text_prompt_for_g_dino(tokenizer)
+    text_prompt, positive_map = get_text_prompt_for_g_dino(tokenizer)
 
-coco_evaluator = CustomCOCOEvaluator(dataset_name = data_split)
+    param_dict = {}
+    param_dict["visualize"] = visualize
+    param_dict["out_dir"] = outputs_dir
+    param_dict["data_split"] = data_split
+    param_dict["positive_map"] = positive_map
+    param_dict["rcnn_model"] = rcnn_model
+    param_dict["rcnn_box_only"] = rcnn_box_only
 
-param_dict = {}
-param_dict["visualize"] = visualize
-param_dict["out_dir"] = outputs_dir
-param_dict["data_split"] = data_split
-param_dict["positive_map"] = positive_map
-param_dict["rcnn_model"] = rcnn_model
+    param_dict["clip_model"] = clip_model
+    param_dict["preprocess"] = preprocess
+    param_dict["text_features"] = text_features
+    param_dict["device"] = device
 
-param_dict["clip_model"] = clip_model
-param_dict["preprocess"] = preprocess
-param_dict["text_features"] = text_features
-param_dict["device"] = device
+    param_dict["ovd_id_to_coco_id"] = ovd_id_to_coco_id
 
-param_dict["ovd_id_to_coco_id"] = ovd_id_to_coco_id
+    param_dict["sam"] = sam
+    param_dict["resize_transform"] = resize_transform
 
-param_dict["sam"] = sam
-param_dict["resize_transform"] = resize_transform
-
-if __name__ == "__main__":
     results = inference(test_loader, coco_evaluator, model, text_prompt, param_dict)
     print_csv_format(results)
 
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,7 @@ from typing import List
 
 from detectron2.utils.visualizer import _create_text_labels, Visualizer
 from scripts.open_vocab_detection.coco_eval_utils.coco_ovd_split import categories_seen, categories_unseen
+from scripts.label_space import LabelMap
 
 class BBoxVisualizer(Visualizer):
     colors = list(mcolors.BASE_COLORS.keys())
@@ -160,13 +161,9 @@ def get_ovd_id_to_coco_id():
     coco_ovd_classes = seen_names + unseen_names
 
     all_coco_classes = MetadataCatalog.get("coco_2017_val").get("thing_classes")
-    ovd_id_to_coco_id = {}
 
-    for i, coco_class in enumerate(all_coco_classes):
-        if coco_class in coco_ovd_classes:
-            ovd_id_to_coco_id[coco_ovd_classes.index(coco_class)] = i
-
-    return ovd_id_to_coco_id
+    # `LabelMap` of the OVD class ids (seen then unseen classes, the order of the prompts) to the COCO thing class ids
+    return LabelMap.from_names(coco_ovd_classes, all_coco_classes)
 
 def get_text_prompt_for_g_dino(tokenizer):
     seen_names = [x['name'] for x in categories_seen]
@@ -0,0 +1,7 @@
+import os
+import sys
+
+proj_path = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+# the scripts import each other as top-level modules, and the shared helpers as `scripts.*`
+sys.path.append(proj_path)
+sys.path.append(os.path.join(proj_path, "scripts", "novel_object_detection"))
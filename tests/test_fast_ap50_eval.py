@@ -0,0 +1,69 @@
+"""Parity of `evaluate_ap50` with the AP50 slice of `pycocotools.cocoeval.COCOeval`."""
+import contextlib
+import io
+
+import numpy as np
+import pytest
+
+pytest.importorskip("pycocotools")
+from pycocotools.coco import COCO
+from pycocotools.cocoeval import COCOeval
+
+from scripts.open_vocab_detection.coco_eval_utils.fast_ap50_eval import evaluate_ap50
+
+
+def synthetic_coco(rng, num_imgs=15, num_cats=6):
+    """Gts (some crowd) and detections near, on and far from them, with many detections on a few images."""
+    images = [{"id": img_id, "height": 480, "width": 640} for img_id in range(1, num_imgs + 1)]
+    categories = [{"id": cat_id, "name": "class_{}".format(cat_id)} for cat_id in range(1, num_cats + 1)]
+    annotations, results = [], []
+    for img_id in range(1, num_imgs + 1):
+        for _ in range(rng.integers(0, 6)):
+            cat_id = int(rng.integers(1, num_cats + 1))
+            w, h = rng.uniform(5, 200, size=2)
+            box = [float(rng.uniform(0, 640 - w)), float(rng.uniform(0, 480 - h)), float(w), float(h)]
+            annotations.append({
+                "id": len(annotations) + 1, "image_id": img_id, "category_id": cat_id, "bbox": box,
+                "area": float(w * h), "iscrowd": int(rng.random() < 0.15),
+            })
+            for _ in range(rng.integers(0, 4)):
+                jitter = rng.normal(0, 0.2 * min(w, h), size=4)
+                results.append({
+                    "image_id": img_id, "category_id": cat_id, "score": float(rng.random()),
+                    "bbox": [box[0] + jitter[0], box[1] + jitter[1], max(1.0, w + jitter[2]), max(1.0, h + jitter[3])],
+                })
+        for _ in range(rng.integers(0, 5)):
+            w, h = rng.uniform(5, 150, size=2)
+            results.append({
+                "image_id": img_id, "category_id": int(rng.integers(1, num_cats + 1)), "score": float(rng.random()),
+                "bbox": [float(rng.uniform(0, 640 - w)), float(rng.uniform(0, 480 - h)), float(w), float(h)],
+            })
+    return {"images": images, "annotations": annotations, "categories": categories}, results
+
+
+def reference_ap50_precision(gt, results):
+    with contextlib.redirect_stdout(io.StringIO()):
+        coco_gt = COCO()
+        coco_gt.dataset = gt
+        coco_gt.createIndex()
+        coco_eval = COCOeval(coco_gt, coco_gt.loadRes(results), "bbox")
+        coco_eval.evaluate()
+        coco_eval.accumulate()
+    return coco_gt, coco_eval.eval["precision"][0, :, :, 0, -1]
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_matches_cocoeval(seed):
+    gt, results = synthetic_coco(np.random.default_rng(seed))
+    coco_gt, reference = reference_ap50_precision(gt, results)
+
+    precision = evaluate_ap50(coco_gt, results, coco_gt.getImgIds(), coco_gt.getCatIds())
+    np.testing.assert_allclose(precision, reference, atol=1e-6)
+
+
+def test_small_batches_match_cocoeval():
+    gt, results = synthetic_coco(np.random.default_rng(0))
+    coco_gt, reference = reference_ap50_precision(gt, results)
+
+    precision = evaluate_ap50(coco_gt, results, coco_gt.getImgIds(), coco_gt.getCatIds(), max_batch_elements=16)
+    np.testing.assert_allclose(precision, reference, atol=1e-6)
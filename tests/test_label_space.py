@@ -0,0 +1,49 @@
+"""Dense label remapping of `LabelMap`: lookups, labels absent from the mapping and the strict evaluator remaps."""
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from scripts.label_space import LabelMap, remap_category_ids
+
+
+def test_maps_like_the_dict():
+    label_map = LabelMap({0: 5, 2: 7, 3: 1})
+    assert label_map(torch.tensor([3, 0, 2, 2])).tolist() == [1, 5, 7, 7]
+    assert label_map(torch.tensor([[0], [3]])).tolist() == [[5], [1]]
+    assert label_map[2] == 7 and label_map.get(1) is None and 1 not in label_map and len(label_map) == 3
+
+
+def test_absent_labels_are_missing():
+    label_map = LabelMap({0: 5, 2: 7}, missing=-1)
+    assert label_map(torch.tensor([1, 2, 9, -3])).tolist() == [-1, 7, -1, -1]
+    assert LabelMap({})(torch.tensor([0, 4])).tolist() == [-1, -1]
+
+
+def test_strict_raises_on_absent_labels():
+    label_map = LabelMap({0: 5, 2: 7})
+    with pytest.raises(KeyError):
+        label_map(torch.tensor([0, 1]), strict=True)
+    with pytest.raises(KeyError):
+        label_map(torch.tensor([2, 9]), strict=True)
+    assert label_map(torch.tensor([0, 2]), strict=True).tolist() == [5, 7]
+
+
+def test_strict_accepts_labels_mapped_to_missing():
+    # COCO classes without an LVIS counterpart are mapped to -1 on purpose
+    label_map = LabelMap.from_names(["person", "hair drier"], ["person", "dog"])
+    assert label_map(torch.tensor([0, 1]), strict=True).tolist() == [0, -1]
+
+
+def test_setitem_and_inverse():
+    label_map = LabelMap({0: 3})
+    label_map[4] = 1
+    assert label_map(torch.tensor([4, 0, 2])).tolist() == [1, 3, -1]
+    assert dict(label_map.inverse().items()) == {3: 0, 1: 4}
+
+
+def test_remap_category_ids_is_strict():
+    results = [{"category_id": 0}, {"category_id": 2}]
+    assert [result["category_id"] for result in remap_category_ids(results, LabelMap({0: 10, 2: 20}))] == [10, 20]
+    with pytest.raises(KeyError):
+        remap_category_ids([{"category_id": 1}], LabelMap({0: 10}))
+    assert remap_category_ids([{"category_id": 1}], LabelMap({0: 10}), strict=False) == [{"category_id": -1}]
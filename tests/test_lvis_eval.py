@@ -0,0 +1,140 @@
+"""Parity of `VectorizedLVISEval` with the reference `lvis.LVISEval` on synthetic LVIS datasets."""
+import copy
+import json
+import logging
+
+import numpy as np
+import pytest
+
+lvis = pytest.importorskip("lvis")
+from lvis import LVIS, LVISEval, LVISResults
+
+from lvis_eval_utils import LVISEvalCustom, VectorizedLVISEval
+
+logging.getLogger("lvis").setLevel(logging.ERROR)
+
+
+@pytest.fixture(autouse=True)
+def numpy_float_alias(monkeypatch):
+    # lvis 0.5.3 accumulates with `np.float`, removed in numpy 1.24 (environment.yml pins 1.23.5)
+    monkeypatch.setattr(np, "float", float, raising=False)
+
+
+def synthetic_lvis(rng, num_imgs=12, num_cats=8):
+    """
+    Ground truth and detections of a small LVIS-like dataset: boxes of every size range, ignored categories
+    (`not_exhaustive_category_ids`), negative categories and detections near, on and far from the gts.
+    """
+    categories = [
+        {"id": cat_id, "name": "class_{}".format(cat_id), "frequency": "rcf"[cat_id % 3]}
+        for cat_id in range(1, num_cats + 1)
+    ]
+    images, annotations, results = [], [], []
+    for img_id in range(1, num_imgs + 1):
+        present = rng.choice(num_cats, size=rng.integers(0, 4), replace=False) + 1
+        absent = np.setdiff1d(np.arange(1, num_cats + 1), present)
+        neg = rng.choice(absent, size=min(len(absent), rng.integers(0, 3)), replace=False)
+        images.append({
+            "id": img_id, "height": 480, "width": 640,
+            "neg_category_ids": neg.tolist(),
+            "not_exhaustive_category_ids": [int(c) for c in present if rng.random() < 0.2],
+        })
+        for cat_id in present:
+            for _ in range(rng.integers(1, 4)):
+                w, h = rng.choice([8.0, 24.0, 60.0, 200.0]) * rng.uniform(0.6, 1.4, size=2)
+                x, y = rng.uniform(0, 640 - w), rng.uniform(0, 480 - h)
+                box = [float(x), float(y), float(w), float(h)]
+                annotations.append({
+                    "id": len(annotations) + 1, "image_id": img_id, "category_id": int(cat_id), "bbox": box,
+                    "area": float(w * h),
+                })
+                for _ in range(rng.integers(0, 3)):  # jittered copies, some matching
+                    jitter = rng.normal(0, 0.15 * min(w, h), size=4)
+                    results.append({
+                        "image_id": img_id, "category_id": int(cat_id), "score": float(rng.random()),
+                        "bbox": [
+                            box[0] + jitter[0], box[1] + jitter[1], max(1.0, w + jitter[2]), max(1.0, h + jitter[3])
+                        ],
+                    })
+        for _ in range(rng.integers(0, 4)):  # false positives of present, negative or unrelated categories
+            w, h = rng.uniform(10, 150, size=2)
+            results.append({
+                "image_id": img_id, "category_id": int(rng.integers(1, num_cats + 1)), "score": float(rng.random()),
+                "bbox": [float(rng.uniform(0, 640 - w)), float(rng.uniform(0, 480 - h)), float(w), float(h)],
+            })
+    gt = {"images": images, "annotations": annotations, "categories": categories}
+    return gt, results
+
+
+def load(tmp_path, gt, results):
+    path = tmp_path / "gt.json"
+    path.write_text(json.dumps(gt))
+    lvis_gt = LVIS(str(path))
+    return lvis_gt, LVISResults(lvis_gt, copy.deepcopy(results))
+
+
+def reference_eval(lvis_gt, lvis_dt):
+    lvis_eval = LVISEval(lvis_gt, lvis_dt, "bbox")
+    lvis_eval.run()
+    return lvis_eval
+
+
+def assert_same_eval(lvis_eval, reference):
+    np.testing.assert_allclose(lvis_eval.eval["precision"], reference.eval["precision"], atol=1e-6)
+    np.testing.assert_allclose(lvis_eval.eval["recall"], reference.eval["recall"], atol=1e-6)
+    assert set(lvis_eval.results) == set(reference.results)
+    for name, value in reference.results.items():
+        np.testing.assert_allclose(lvis_eval.results[name], value, atol=1e-6, err_msg=name)
+
+
+@pytest.mark.parametrize("seed", range(12))
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_matches_lvis_eval(tmp_path, seed, num_workers):
+    gt, results = synthetic_lvis(np.random.default_rng(seed))
+    lvis_gt, lvis_dt = load(tmp_path, gt, results)
+
+    lvis_eval = VectorizedLVISEval(lvis_gt, lvis_dt, "bbox", num_workers=num_workers)
+    lvis_eval.run()
+    assert_same_eval(lvis_eval, reference_eval(lvis_gt, lvis_dt))
+
+
+@pytest.mark.parametrize("num_workers", [0, 2])
+def test_category_without_shared_images(tmp_path, num_workers):
+    """The gts and dts of category 2 are on different images, where the dts are evaluated as negatives."""
+    categories = [{"id": 1, "name": "a", "frequency": "f"}, {"id": 2, "name": "b", "frequency": "r"}]
+    images = [
+        {"id": 1, "height": 100, "width": 100, "neg_category_ids": [], "not_exhaustive_category_ids": []},
+        {"id": 2, "height": 100, "width": 100, "neg_category_ids": [2], "not_exhaustive_category_ids": []},
+    ]
+    annotations = [
+        {"id": 1, "image_id": 1, "category_id": 1, "bbox": [10.0, 10.0, 30.0, 30.0], "area": 900.0},
+        {"id": 2, "image_id": 1, "category_id": 2, "bbox": [50.0, 50.0, 20.0, 20.0], "area": 400.0},
+    ]
+    results = [
+        {"image_id": 1, "category_id": 1, "score": 0.9, "bbox": [11.0, 10.0, 30.0, 30.0]},
+        {"image_id": 2, "category_id": 2, "score": 0.8, "bbox": [50.0, 50.0, 20.0, 20.0]},
+    ]
+    gt = {"images": images, "annotations": annotations, "categories": categories}
+    lvis_gt, lvis_dt = load(tmp_path, gt, results)
+
+    lvis_eval = VectorizedLVISEval(lvis_gt, lvis_dt, "bbox", num_workers=num_workers)
+    lvis_eval.run()
+    reference = reference_eval(lvis_gt, lvis_dt)
+    assert_same_eval(lvis_eval, reference)
+    assert lvis_eval.eval["recall"][0, 1, 0] == 0  # the dt of category 2 is an unmatched false positive
+
+
+def test_subsets_match_evaluations_of_the_subsets(tmp_path):
+    """The metrics of a class subset equal those of an evaluation restricted to its categories."""
+    gt, results = synthetic_lvis(np.random.default_rng(3))
+    lvis_gt, lvis_dt = load(tmp_path, gt, results)
+    subset = [1, 2, 4, 7]
+
+    lvis_eval = LVISEvalCustom(lvis_gt, lvis_dt, "bbox", class_subsets={"subset": subset})
+    lvis_eval.run()
+
+    reference = LVISEval(lvis_gt, lvis_dt, "bbox")
+    reference.params.cat_ids = subset
+    reference.run()
+    for name, value in reference.results.items():
+        np.testing.assert_allclose(lvis_eval.results_subsets["subset"][name], value, atol=1e-6, err_msg=name)
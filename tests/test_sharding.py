@@ -0,0 +1,46 @@
+"""`merge_topk` of the partial top-k of vocabulary shards against `torch.topk` of the whole score matrix."""
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from sharding import shard_ranges, merge_topk
+
+
+@pytest.mark.parametrize("num_items, num_shards", [(10, 3), (7, 7), (5, 8), (1203, 4)])
+def test_shard_ranges_cover_the_items(num_items, num_shards):
+    ranges = shard_ranges(num_items, num_shards)
+    assert len(ranges) == min(num_items, num_shards)
+    assert [start for start, _ in ranges] == [0] + [end for _, end in ranges[:-1]]
+    assert ranges[-1][1] == num_items
+    sizes = [end - start for start, end in ranges]
+    assert max(sizes) - min(sizes) <= 1
+
+
+@pytest.mark.parametrize("seed", range(5))
+@pytest.mark.parametrize("num_shards", [1, 2, 3, 8])
+@pytest.mark.parametrize("k", [1, 10, 300])
+def test_merge_topk_matches_topk(seed, num_shards, k):
+    generator = torch.Generator().manual_seed(seed)
+    scores = torch.rand((4, 500), generator = generator)
+
+    partial_values, partial_indices = [], []
+    for start, end in shard_ranges(scores.shape[1], num_shards):
+        values, indices = torch.topk(scores[:, start:end], min(k, end - start), dim = 1)
+        partial_values.append(values)
+        partial_indices.append(indices + start)
+    values = torch.cat(partial_values, dim = 1)
+    indices = torch.cat(partial_indices, dim = 1)
+
+    merged_values, merged_indices, positions = merge_topk(values, indices, k)
+    expected_values, expected_indices = torch.topk(scores, k, dim = 1)
+    assert torch.equal(merged_values, expected_values)
+    assert torch.equal(merged_indices, expected_indices)
+    assert torch.equal(values.gather(1, positions), merged_values)
+
+
+def test_merge_topk_breaks_ties_by_index():
+    values = torch.tensor([[0.5, 0.9, 0.5, 0.5]])
+    indices = torch.tensor([[7, 3, 2, 5]])
+    merged_values, merged_indices, _ = merge_topk(values, indices, 3)
+    assert merged_values.tolist() == [[0.9, 0.5, 0.5]]
+    assert merged_indices.tolist() == [[3, 2, 5]]